@@ -191,11 +191,22 @@ mimetypes.add_type('application/javascript', '.mjs')
 if __name__ == '__main__':
     if not need_config:
         chat_service.set_system_prompt("character")
-        # 使用 Waitress 作为生产级 WSGI 服务器
-        serve(
+        # 使用 Waitress 作为生产级 WSGI 服务器（线程数、连接上限等见 SERVER_CONFIG）
+        from config import get_server_config
+        from utils.server_utils import server_monitor
+
+        def _flush_writers():
+            # 写出尚在防抖延迟中的记忆存储修改与历史记录缓冲
+            from utils.persist_utils import get_persister
+            get_persister().flush()
+            chat_service.history_manager.flush_all()
+
+        server_monitor.serve(
             app,
             host=app_config.get("host", "127.0.0.1"),
-            port=int(app_config.get("port", 5000))
+            port=int(app_config.get("port", 5000)),
+            config=get_server_config(),
+            on_shutdown=_flush_writers
         )
     else:
         # 配置模式下，也使用 Waitress 以避免开发服务器限制
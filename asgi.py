@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+CABM ASGI 入口
+
+/api/chat/stream 走 asyncio 流式路径：模型输出通过 AsyncOpenAI 异步读取，等待中的流只占用协程；
+记忆检索、工具调用、写记忆与选项生成等阻塞操作放到有界线程池中执行。
+其余页面与接口仍由 Flask（WSGI）应用处理。
+
+运行（需安装 uvicorn 与 a2wsgi，已列入 requirements.txt）：
+    python start.py --asgi
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+"""
+import sys
+import json
+import asyncio
+import logging
+import weakref
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from pathlib import Path
+from typing import Any
+
+# 计算项目根目录
+project_root = Path(__file__).resolve().parent
+sys.path.insert(0, str(project_root))
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    raise ImportError("ASGI 模式需要安装 a2wsgi 与 uvicorn：pip install a2wsgi uvicorn")
+
+from app import app as flask_app, need_config
+from services.config_service import config_service
+
+logger = logging.getLogger("ASGI")
+
+if not need_config:
+    from services.chat_service import chat_service
+    from services.session_service import session_manager, SESSION_COOKIE, SESSION_HEADER
+    from routes.chat_routes import ChatTurn, SSE_DONE, sse_event
+    _worker_threads = int(config_service.get_app_config().get("asgi_worker_threads", 16))
+else:
+    _worker_threads = 4
+
+# 阻塞操作线程池：线程数只取决于同时进行中的阻塞步骤，与在线的流数量无关
+_executor = ThreadPoolExecutor(max_workers=_worker_threads, thread_name_prefix="cabm-async")
+# 各会话的轮次锁（会话被淘汰后随之回收）
+_turn_locks: "weakref.WeakKeyDictionary[Any, asyncio.Lock]" = weakref.WeakKeyDictionary()
+# Flask 应用（非流式页面与接口）：在独立的线程池中并发执行，
+# 不能用 asgiref 的 WsgiToAsgi（默认 thread_sensitive，所有请求串行在同一个线程上）
+_wsgi_app = WSGIMiddleware(flask_app, workers=_worker_threads)
+
+
+async def _offload(func, *args):
+    """
+    在线程池中执行阻塞调用，并带上当前协程的上下文（会话绑定）
+
+    Args:
+        func: 阻塞函数
+        *args: 参数
+
+    Returns:
+        函数返回值
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, lambda: ctx.run(func, *args))
+
+
+def _get_header(scope, name: str) -> str:
+    """读取请求头（不区分大小写），不存在时返回空字符串"""
+    key = name.lower().encode("latin-1")
+    for k, v in scope.get("headers", []):
+        if k == key:
+            return v.decode("latin-1")
+    return ""
+
+
+def _get_session_id(scope):
+    """从请求头或 cookie 中取会话ID"""
+    session_id = _get_header(scope, SESSION_HEADER)
+    if session_id:
+        return session_id
+    cookie = SimpleCookie()
+    try:
+        cookie.load(_get_header(scope, "cookie"))
+    except Exception:
+        return None
+    morsel = cookie.get(SESSION_COOKIE)
+    return morsel.value if morsel else None
+
+
+async def _read_body(receive) -> bytes:
+    """读取完整请求体"""
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ConnectionError("客户端已断开")
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def _send_json(send, status: int, payload: dict) -> None:
+    """发送 JSON 响应"""
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json; charset=utf-8"),
+                    (b"content-length", str(len(body)).encode("latin-1"))]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _watch_disconnect(receive, disconnected: asyncio.Event) -> None:
+    """等待客户端断开"""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            disconnected.set()
+            return
+
+
+async def chat_stream(scope, receive, send) -> None:
+    """
+    异步版 /api/chat/stream：请求与响应格式与 Flask 路由一致
+
+    Args:
+        scope: ASGI scope
+        receive: ASGI receive
+        send: ASGI send
+    """
+    try:
+        data = json.loads((await _read_body(receive)) or b"{}")
+    except ConnectionError:
+        return
+    except Exception:
+        await _send_json(send, 400, {'success': False, 'error': '请求格式错误'})
+        return
+    message = data.get('message', '')
+    mcp_enabled = bool(data.get('mcp_enabled', False))
+    if not message:
+        await _send_json(send, 400, {'success': False, 'error': '消息不能为空'})
+        return
+
+    # 确定会话：current() 在本协程中记录新建的会话ID，初始化（加载历史）放到线程池
+    session_manager.activate(_get_session_id(scope))
+    session_manager.current()
+    session = await _offload(chat_service.get_session)
+    created = session_manager.created_session_id()
+
+    headers = [
+        (b"content-type", b"text/event-stream; charset=utf-8"),
+        (b"cache-control", b"no-cache"),
+        (b"x-accel-buffering", b"no"),
+    ]
+    if created:
+        max_age = int(config_service.get_app_config().get("session_ttl", 6 * 3600))
+        cookie = f"{SESSION_COOKIE}={created}; Max-Age={max_age}; Path=/; HttpOnly; SameSite=Lax"
+        headers.append((b"set-cookie", cookie.encode("latin-1")))
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+
+    disconnected = asyncio.Event()
+    watcher = asyncio.create_task(_watch_disconnect(receive, disconnected))
+
+    async def emit(event: str) -> None:
+        if disconnected.is_set():
+            return
+        try:
+            await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+        except Exception:
+            disconnected.set()
+
+    # 同一会话的回复串行执行：在事件循环上等待该会话的 asyncio.Lock（等待期间客户端断开则放弃）
+    turn_lock = _turn_locks.get(session)
+    if turn_lock is None:
+        turn_lock = _turn_locks[session] = asyncio.Lock()
+    if not await _acquire_turn(turn_lock, disconnected):
+        watcher.cancel()
+        return
+    # ASGI 模式下流式对话只走本接口，拿到 asyncio 锁后 turn_lock 必然空闲；
+    # 仍然持有它，会话淘汰据此跳过进行中的会话
+    held = session.turn_lock.acquire(blocking=False)
+    try:
+        with session_manager.bind(session):
+            await _run_turn(message, mcp_enabled, emit, disconnected)
+    finally:
+        if held:
+            session.turn_lock.release()
+        turn_lock.release()
+        watcher.cancel()
+    if not disconnected.is_set():
+        try:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        except Exception:
+            pass
+
+
+async def _acquire_turn(turn_lock: asyncio.Lock, disconnected: asyncio.Event) -> bool:
+    """
+    等待会话的轮次锁，客户端先断开时放弃等待
+
+    Args:
+        turn_lock: 会话的轮次锁
+        disconnected: 客户端断开事件
+
+    Returns:
+        是否取得了锁
+    """
+    acquire = asyncio.ensure_future(turn_lock.acquire())
+    gone = asyncio.ensure_future(disconnected.wait())
+    try:
+        await asyncio.wait({acquire, gone}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        gone.cancel()
+    if acquire.done() and not acquire.cancelled():
+        if not disconnected.is_set():
+            return True
+        turn_lock.release()
+        return False
+    acquire.cancel()
+    try:
+        await acquire
+    except asyncio.CancelledError:
+        return False
+    # 取消前已经拿到锁
+    turn_lock.release()
+    return False
+
+
+async def _run_turn(message: str, mcp_enabled: bool, emit, disconnected: asyncio.Event) -> None:
+    """
+    执行一次对话轮次（与同步接口共用 ChatTurn 的解析与工具循环逻辑）
+
+    Args:
+        message: 用户消息
+        mcp_enabled: 是否启用MCP
+        emit: 发送一条 SSE 事件的协程函数
+        disconnected: 客户端断开事件
+    """
+    turn = ChatTurn(message, mcp_enabled)
+    try:
+        await _offload(chat_service.add_message, "user", message)
+        await _offload(turn.prepare)
+        while True:
+            if disconnected.is_set():
+                # 客户端断开：不再发起新一轮请求，也不执行待定的工具调用
+                await _offload(turn.cancel)
+                return
+            messages = turn.start_round()
+            await _offload(chat_service.log_request, messages, message)
+            stream = chat_service.chat_completion_async(messages=messages)
+            try:
+                async for chunk in stream:
+                    events, stop = turn.feed(chunk)
+                    for event in events:
+                        await emit(event)
+                    if stop or disconnected.is_set():
+                        break
+            finally:
+                # 立即关闭上游流（断开时不再继续生成）并归还并发名额
+                await stream.aclose()
+            if disconnected.is_set():
+                await _offload(turn.cancel)
+                return
+            for event in await _offload(turn.run_tool):
+                await emit(event)
+
+            # 一次流式完成
+            state = turn.end_round()
+            if state == "next":
+                continue
+            if state == "complete":
+                for event in await _offload(turn.complete):
+                    await emit(event)
+                for event in await _offload(turn.option_events):
+                    await emit(event)
+            await emit(SSE_DONE)
+            return
+    except Exception as e:
+        logger.error(f"异步流式对话失败: {e}")
+        await emit(sse_event({'error': str(e)}))
+        await emit(SSE_DONE)
+
+
+async def _lifespan(receive, send) -> None:
+    """处理启动与关闭事件：关闭时写出缓冲中的记忆与历史记录"""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            if not need_config:
+                await _offload(chat_service.set_system_prompt, "character")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if not need_config:
+                # 写出尚在防抖延迟中的记忆存储修改与历史记录缓冲
+                from utils.persist_utils import get_persister
+                get_persister().flush()
+                chat_service.history_manager.flush_all()
+            _executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send) -> None:
+    """ASGI 应用：流式对话走异步路径，其余请求交给 Flask"""
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if (scope["type"] == "http" and not need_config
+            and scope.get("path") == "/api/chat/stream" and scope.get("method") == "POST"):
+        await chat_stream(scope, receive, send)
+        return
+    await _wsgi_app(scope, receive, send)
+
+
+def serve(host: str, port: int) -> None:
+    """
+    使用 uvicorn 运行 ASGI 应用
+
+    Args:
+        host: 监听地址
+        port: 端口
+    """
+    try:
+        import uvicorn
+    except ImportError:
+        raise ImportError("ASGI 模式需要安装 uvicorn：pip install uvicorn")
+    from utils.server_utils import server_monitor
+    server_monitor.mode = "asgi"
+    uvicorn.run(application, host=host, port=port, log_level="info")
+
+
+if __name__ == '__main__':
+    if not need_config:
+        app_config = config_service.get_app_config()
+        serve(app_config.get("host", "127.0.0.1"), int(app_config.get("port", 5000)))
+    else:
+        serve("127.0.0.1", 5000)
@@ -22,6 +22,7 @@ CHAT_CONFIG = {
 # 流式输出配置
 STREAM_CONFIG = {
     "enable_streaming": True,     # 启用流式输出
+    "heartbeat_interval": 10,     # 模型思考期间无输出时，每隔多少秒发送一次 SSE 心跳注释（写入失败即视为客户端已断开）
 }
 
 # 选项生成配置
@@ -32,6 +33,11 @@ OPTION_CONFIG = {
     "temperature": 0.7,           # 温度参数
     "stream": False,              # 选项生成不使用流式
     'enable_thinking': False,     # 是否启用思考
+    "background_workers": 2,      # 后台生成选项的线程数（回复完成后与写入记忆并行生成）
+    "stream_wait": 3.0,           # 回复完成后最多等待选项的秒数，超时则先结束流，前端再通过 /api/options/<turn_id> 获取
+    "result_ttl": 300,            # 选项结果保留秒数
+    "poll_wait": 0.5,             # /api/options/<turn_id> 单次请求最多等待的秒数（占用请求线程，保持很短，前端按 pending 状态重试）
+    "inline_options": True,       # 在主回复 JSON 中附带 options 字段，省去单独的选项请求；缺失时再调用选项模型
 }
 
 # 记忆模块配置
@@ -43,6 +49,23 @@ MEMORY_CONFIG = {
     "buffer_size": 6,             # 短期缓冲中保留的最近对话轮数
     "token_budget": 512,          # 召回后注入提示的token预算
     "importance_threshold": 0.5,  # 事件持久化的重要性阈值
+    "recall_cache_ttl": 30,       # 召回结果缓存时间（秒），有新记忆写入时立即失效
+    "recall_cache_size": 256,     # 召回结果缓存的最大条目数
+    "prefetch_enabled": True,     # 输入时按草稿预取召回结果
+    "prefetch_min_chars": 4,      # 草稿（去除标点空白后）至少多少字才预取
+    "prefetch_similarity": 0.8,   # 最终消息与草稿的相似度（字二元组Jaccard）达到该值即复用预取结果
+    "prefetch_ttl": 60,           # 预取结果的有效期（秒）
+    "prefetch_max_wait": 0.5,     # 发送时预取仍在进行，最多等待的秒数（排队未开始的任务不等待）
+    "dedup_enabled": True,        # 写入记忆时合并近似重复的对话
+    "dedup_max_distance": 3,      # SimHash指纹汉明距离不超过该值视为近似重复
+    "compact_dead_ratio": 0.2,    # 已删除记忆占比超过该值时在后台压缩索引
+    "max_documents": 5000,        # 每个角色向量记忆的条数上限（0表示不限）
+    "max_bytes": 0,               # 每个角色向量记忆的估算字节上限（0表示不限）
+    "evict_low_watermark": 0.9,   # 超限后淘汰到上限的该比例以下，避免每轮都触发淘汰
+    "evict_to_summary": True,     # 被淘汰的对话压缩成摘要保留，而不是直接丢弃
+    "recency_half_life_days": 30, # 记忆价值中时间衰减的半衰期（天）
+    "persist_debounce_ms": 500,   # 短期缓冲/档案修改后延迟多久合并写盘（毫秒）
+    "persist_max_pending": 32,    # 累计未写盘的修改数达到该值时立即写盘
 }
 
 RAG_CONFIG = {
@@ -104,7 +127,7 @@ SYSTEM_PROMPTS = {
     "default": """你现在是一个虚拟伙伴，可以帮助用户完成操作，也可以进行自然交流。你拥有自己的情感。你必须以严格的 JSON 对象格式输出，必须返回一个对象，字段规范如下：
     - mood: int 必填。当前表情，且必须是其中之一，值为序号，**只写序号**：<[MOODS]>
     - content: string 必填。用 1 到 6 个完整句子回复用户。禁止换行，禁止使用 markdown，禁止使用中文括号（），必须使用正常中文标点（。/，/？/！等），严禁使用空格分隔句子。
-    - note: string 可选。记录对用户的印象、长期目标等。允许与上次内容重复，仅在必要时更新。
+    - note: string 可选。记录对用户的印象、长期目标等。允许与上次内容重复，仅在必要时更新。<[OPTIONS]>
     - tool_request: object 可选。仅当需要调用 MCP 工具时包含，其中：
     { "name": string, "args": object, "reason": string }
     你可以使用 MCP 工具来与用户进行更好的沟通，也可以帮用户完成工作。注意：如果你没发现任何"MCP 工具使用指南"相关信息，请不要执行 MCP 工具。如果此情况下用户要求你使用 MCP 工具，请**明确**告知用户你没有使用 MCP 工具的权限。
@@ -180,6 +203,9 @@ OPTION_SYSTEM_PROMPTS="""
 4. 不要输出解释、提示词或多余文字，只输出选项内容。
 /no_think
 """
+# 主回复 JSON 中的选项字段说明（替换 SYSTEM_PROMPTS 中的 <[OPTIONS]>）
+INLINE_OPTIONS_PROMPT = """
+    - options: string[] 可选。放在最后，给出**用户**接下来可能想说的 3 个简短选项，每个不超过 15 个字，从用户的角度用“我”表述。包含 tool_request 时不要输出该字段。"""
 # 应用配置
 APP_CONFIG = {
     "debug": get_env_var("DEBUG", "False").lower() == "true",
@@ -188,14 +214,58 @@ APP_CONFIG = {
     "static_folder": "static",
     "template_folder": "templates",
     "image_cache_dir": "static/images/cache",
-    "max_history_length": 8,  # 最大对话历史长度（发送给AI的上下文长度）
+    "max_history_length": 8,  # 启动或切换角色时从持久化历史加载的消息条数
+    "context_token_budget": int(get_env_var("CONTEXT_TOKEN_BUDGET", "3000")),  # 发送给AI的对话历史 token 预算（不含系统提示词），超出时从最早的对话轮次开始丢弃
     "max_ai_iterations": 10,  # 单次用户请求内，最多AI-工具迭代轮数（用于避免无限循环）
     "history_dir": "data/history",  # 历史记录存储目录
+    "history_flush_ms": 200,  # 历史记录缓冲的定时写盘间隔（毫秒）
+    "history_flush_records": 16,  # 历史记录缓冲累计多少条时立即写盘
+    "history_fsync_on_assistant": True,  # AI回复完成时是否立即写盘并fsync
+    "history_segment_bytes": 4 * 1024 * 1024,  # 活动历史日志超过该大小后滚动为分段（0表示不分段）
+    "history_segment_compression": get_env_var("HISTORY_SEGMENT_COMPRESSION", "gzip"),  # 旧分段的压缩方式：gzip、zstd或留空不压缩
+    "history_page_limit": 100,  # /api/history 单页最多返回的消息数
+    "history_search_enabled": True,  # 是否维护历史记录全文检索索引（/api/history/search）
+    "history_index_merge_threshold": 2000,  # 检索索引增量达到多少条时在后台合并进基础索引
+    "max_sessions": 64,  # 同时保留的对话会话数（每个浏览器一个会话，超出时淘汰最久未用的）
+    "session_ttl": 6 * 3600,  # 会话空闲超时（秒），超时后从持久化历史重新加载
+    "asgi_worker_threads": 16,  # ASGI 模式下执行阻塞操作（记忆检索、工具调用等）的线程池大小，Flask 接口的线程池同样大小
     "show_logo_splash": get_env_var("SHOW_LOGO_SPLASH", "True").lower() == "true",  # 是否显示启动logo动画
     "auto_open_browser": get_env_var("AUTO_OPEN_BROWSER", "True").lower() == "true",  # 是否自动打开浏览器（会自动使用本地IP地址）
     "clean_assistant_history": get_env_var("CLEAN_ASSISTANT_HISTORY", "True").lower() == "true",  # 已弃用：JSON格式下不再需要清理【】标记
 }
 
+# 服务器配置（start.py 的生产模式，使用 waitress）
+SERVER_CONFIG = {
+    "mode": get_env_var("SERVER_MODE", "production"),  # production（waitress）或 development（Flask开发服务器，--debug 时强制使用）
+    "threads": int(get_env_var("SERVER_THREADS", "16")),  # waitress 工作线程数（每个进行中的流式对话占用一个线程）
+    "connection_limit": int(get_env_var("SERVER_CONNECTION_LIMIT", "200")),  # 最大并发连接数
+    "channel_timeout": 600,  # 连接无数据多少秒后断开；SSE 在模型思考或工具调用时可能长时间无输出
+    "backlog": 1024,  # 监听队列长度
+    "shutdown_timeout": 30,  # 退出时等待进行中的流结束的最长秒数
+    "channel_request_lookahead": 5,  # 处理请求期间继续读取连接，用于及时发现客户端断开（0表示关闭）
+}
+
+# 上游模型调用治理（并发、速率与优先级队列，按服务商+API密钥分别限流）
+GOVERNOR_CONFIG = {
+    "enabled": get_env_var("LLM_GOVERNOR", "True").lower() == "true",  # 是否启用准入控制
+    "max_concurrency": int(get_env_var("LLM_MAX_CONCURRENCY", "8")),  # 每个服务商同时进行中的请求数（流式对话持续占用到流结束）
+    "rate": float(get_env_var("LLM_RATE", "5")),  # 每秒发起的新请求数（令牌桶补充速率，0表示不限速）
+    "burst": 10,  # 令牌桶容量（允许的瞬时突发请求数）
+    "max_queue": 64,  # 每个服务商排队请求总数上限，超出时挤掉低优先级请求或直接拒绝
+    "queue_limits": {"chat": 32, "options": 16, "ingest": 16, "bulk": 8},  # 各优先级的排队上限
+    "max_wait": {"chat": 30, "options": 5, "ingest": 60, "bulk": 300},  # 各优先级最长排队秒数，超时直接失败
+    "cooldown_on_429": 5,  # 收到429且没有Retry-After时暂停发放准入的秒数
+    "client_max_retries": 1,  # OpenAI客户端自动重试次数（429已由治理器退避，重试过多会形成重试风暴）
+    "providers": {},  # 按 host 覆盖以上配置，如 {"api.siliconflow.cn": {"max_concurrency": 16}}
+}
+
+# 存储引擎配置
+STORAGE_CONFIG = {
+    "backend": get_env_var("STORAGE_BACKEND", "file"),  # 持久化后端：file（JSON/JSONL文件）或 sqlite
+    "sqlite_path": get_env_var("SQLITE_PATH", "data/cabm.db"),  # SQLite 数据库文件路径
+    "sqlite_synchronous": "FULL",  # WAL 模式下每次提交都 fsync；改为 NORMAL 则只在检查点 fsync
+}
+
 def get_chat_config():
     """获取对话模型配置"""
     return CHAT_CONFIG.copy()
@@ -206,7 +276,11 @@ def get_image_config():
 
 def get_system_prompt(prompt_type="default"):
     """获取通用提示词"""
-    return SYSTEM_PROMPTS.get(prompt_type, SYSTEM_PROMPTS["default"])
+    prompt = SYSTEM_PROMPTS.get(prompt_type, SYSTEM_PROMPTS["default"])
+    # 主回复附带选项时，在输出规范中加入 options 字段
+    if OPTION_CONFIG.get("enable_option_generation", True) and OPTION_CONFIG.get("inline_options", True):
+        return prompt.replace("<[OPTIONS]>", INLINE_OPTIONS_PROMPT)
+    return prompt.replace("<[OPTIONS]>", "")
 
 def get_random_image_prompt():
     """获取随机图像提示词"""
@@ -217,6 +291,18 @@ def get_app_config():
     """获取应用配置"""
     return APP_CONFIG.copy()
 
+def get_server_config():
+    """获取服务器配置"""
+    return SERVER_CONFIG.copy()
+
+def get_governor_config():
+    """获取上游调用治理配置"""
+    return GOVERNOR_CONFIG.copy()
+
+def get_storage_config():
+    """获取存储引擎配置"""
+    return STORAGE_CONFIG.copy()
+
 def get_stream_config():
     """获取流式输出配置"""
     return STREAM_CONFIG.copy()
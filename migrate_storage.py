@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+存储迁移工具：把文件存储的历史记录、短期缓冲、摘要与档案导入 SQLite 数据库
+用法：python migrate_storage.py [--db data/cabm.db] [--history-dir data/history] [--memory-dir data/memory] [--force]
+迁移完成后在 .env 中设置 STORAGE_BACKEND=sqlite 即可切换到 SQLite 后端；原文件不会被修改或删除。
+角色的向量记忆（<角色ID>_memory.json）仍使用文件存储，无需迁移。
+"""
+
+import sys
+import json
+import argparse
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+def iter_history_records(history_dir: Path, character_id: str):
+    """
+    按时间顺序读取角色的全部历史记录（已滚动的分段 + 活动日志）
+
+    Args:
+        history_dir: 历史记录目录
+        character_id: 角色ID
+    """
+    from utils.history_segments import HistorySegmentStore
+
+    segments = HistorySegmentStore(str(history_dir), compression="")
+    for _, _, _, _, record in segments.iter_range(character_id, 0, segments.total(character_id)):
+        yield record
+    history_file = history_dir / f"{character_id}_history.log"
+    if history_file.exists():
+        with open(history_file, "rb") as f:
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break
+                try:
+                    yield json.loads(raw.decode("utf-8"))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    continue
+
+
+def migrate_history(storage, history_dir: Path, force: bool) -> None:
+    """导入历史记录"""
+    from utils.history_utils import extract_last_assistant_sentence
+
+    character_ids = {p.name[:-len("_history.log")] for p in history_dir.glob("*_history.log")}
+    segment_root = history_dir / "segments"
+    if segment_root.exists():
+        character_ids |= {p.name for p in segment_root.iterdir() if p.is_dir()}
+
+    for character_id in sorted(character_ids):
+        existing = storage.query("SELECT count FROM history_meta WHERE character = ?", (character_id,))
+        if existing and not force:
+            print(f"跳过 {character_id}：数据库中已有 {existing[0]['count']} 条历史记录（使用 --force 覆盖）")
+            continue
+        count, last_timestamp, sentence = 0, None, ""
+        with storage.transaction() as conn:
+            conn.execute("DELETE FROM messages WHERE character = ?", (character_id,))
+            conn.execute("DELETE FROM history_meta WHERE character = ?", (character_id,))
+            for record in iter_history_records(history_dir, character_id):
+                role, content = record.get("role", ""), record.get("content", "")
+                conn.execute(
+                    "INSERT INTO messages(character, seq, ts, role, content) VALUES (?, ?, ?, ?, ?)",
+                    (character_id, count, record.get("timestamp"), role, content)
+                )
+                count += 1
+                last_timestamp = record.get("timestamp") or last_timestamp
+                if role == "assistant":
+                    sentence = extract_last_assistant_sentence(content)
+            conn.execute(
+                "INSERT INTO history_meta(character, count, last_timestamp, last_assistant_sentence) VALUES (?, ?, ?, ?)",
+                (character_id, count, last_timestamp, sentence)
+            )
+        print(f"已迁移 {character_id} 的历史记录：{count} 条")
+
+
+def load_summaries(scope_dir: Path) -> list:
+    """回放 summaries.jsonl 操作日志（或读取旧版 summaries.json），得到现存摘要"""
+    items = {}
+    log_file = scope_dir / "summaries.jsonl"
+    legacy_file = scope_dir / "summaries.json"
+    if log_file.exists():
+        for line in log_file.read_text(encoding="utf-8").splitlines():
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            sid = rec.get("id")
+            if sid is None:
+                continue
+            if rec.get("op") == "add":
+                items[int(sid)] = {"id": int(sid), "text": rec.get("text", ""), "meta": rec.get("meta") or {}}
+            elif rec.get("op") == "meta" and int(sid) in items:
+                items[int(sid)]["meta"].update(rec.get("meta") or {})
+            elif rec.get("op") == "del":
+                items.pop(int(sid), None)
+    elif legacy_file.exists():
+        data = json.loads(legacy_file.read_text(encoding="utf-8"))
+        for i, x in enumerate(data if isinstance(data, list) else []):
+            items[i] = {"id": i, "text": x.get("text", ""), "meta": x.get("meta") or {}}
+    return [items[k] for k in sorted(items)]
+
+
+def migrate_memory(storage, memory_dir: Path, force: bool) -> None:
+    """导入短期缓冲、摘要与档案"""
+    if not memory_dir.exists():
+        return
+    for scope_dir in sorted(p for p in memory_dir.iterdir() if p.is_dir()):
+        scope = scope_dir.name
+        for name in ("buffer", "profile"):
+            path = scope_dir / f"{name}.json"
+            if not path.exists():
+                continue
+            if storage.get_document(scope, name) is not None and not force:
+                print(f"跳过 {scope}/{name}：数据库中已存在")
+                continue
+            storage.put_document(scope, name, json.loads(path.read_text(encoding="utf-8")))
+            print(f"已迁移 {scope}/{name}")
+
+        summaries = load_summaries(scope_dir)
+        if not summaries:
+            continue
+        if storage.load_summaries(scope) and not force:
+            print(f"跳过 {scope}/summaries：数据库中已存在")
+            continue
+        with storage.transaction() as conn:
+            conn.execute("DELETE FROM summaries WHERE scope = ?", (scope,))
+            for it in summaries:
+                conn.execute(
+                    "INSERT INTO summaries(scope, id, text, meta) VALUES (?, ?, ?, ?)",
+                    (scope, it["id"], it["text"], json.dumps(it["meta"], ensure_ascii=False))
+                )
+        print(f"已迁移 {scope}/summaries：{len(summaries)} 条")
+
+
+def main():
+    from config import get_app_config, get_storage_config
+    from utils.sqlite_storage import SQLiteStorage
+
+    parser = argparse.ArgumentParser(description="把文件存储迁移到 SQLite")
+    parser.add_argument("--db", default=get_storage_config().get("sqlite_path", "data/cabm.db"), help="SQLite 数据库路径")
+    parser.add_argument("--history-dir", default=get_app_config().get("history_dir", "data/history"), help="历史记录目录")
+    parser.add_argument("--memory-dir", default="data/memory", help="记忆存储目录")
+    parser.add_argument("--force", action="store_true", help="覆盖数据库中已存在的数据")
+    args = parser.parse_args()
+
+    storage = SQLiteStorage(args.db)
+    migrate_history(storage, Path(args.history_dir), args.force)
+    migrate_memory(storage, Path(args.memory_dir), args.force)
+    print(f"迁移完成：{args.db}")
+    print("在 .env 中设置 STORAGE_BACKEND=sqlite 以启用 SQLite 存储")
+
+
+if __name__ == "__main__":
+    main()
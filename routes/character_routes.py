@@ -25,42 +25,11 @@ bp = Blueprint('character', __name__, url_prefix='')
 # ------------------------------------------------------------------
 # 工具函数
 # ------------------------------------------------------------------
-def _parse_assistant_text(raw: str) -> str:
-    if not raw:
-        return ""
-    try:
-        obj = json.loads(raw)
-        if isinstance(obj, dict):
-            text = obj.get('content')
-            if isinstance(text, str):
-                return text
-        if isinstance(obj, str):
-            return obj
-    except Exception:
-        pass
-    return str(raw)
-
-def _extract_last_sentence(text: str) -> str:
-    import re as _re
-    if not text:
-        return ""
-    text = _re.sub(r"\s+", " ", text).strip()
-    if not text:
-        return ""
-    sentence_endings = ['。', '！', '？', '!', '?', '.', '…', '♪', '...']
-    escaped = ''.join(_re.escape(ch) for ch in sentence_endings)
-    pattern = rf"([^ {escaped}]+(?:[{escaped}]+)?)$"
-    m = _re.search(pattern, text)
-    return m.group(1).strip() if m else text
-
 def _get_last_assistant_sentence_for_character(character_id: str) -> str:
     try:
-        history_messages = chat_service.history_manager.load_history(character_id, count=200, max_cache_size=500)
-        for msg in reversed(history_messages):
-            if msg.get('role') == 'assistant':
-                raw = msg.get('content', '')
-                text = _parse_assistant_text(raw)
-                return _extract_last_sentence(text)
+        # 读取历史记录侧写，无需加载整个历史日志
+        meta = chat_service.history_manager.get_metadata(character_id)
+        return meta.get('last_assistant_sentence') or ""
     except Exception as e:
         print(f"提取最后一句失败: {e}")
     return ""
@@ -5,9 +5,11 @@
 import os
 import json
 import re
+import time
+import uuid
 import traceback
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Tuple
 from flask import Blueprint, request, render_template, jsonify, Response, send_file
 from io import BytesIO
 import sys
@@ -15,6 +17,10 @@ import sys
 project_root = Path(__file__).resolve().parent.parent
 sys.path.insert(0, str(project_root))
 
+from utils.deadline_utils import Deadline
+from utils.token_utils import count_tokens
+from utils.server_utils import server_monitor
+
 # 只有在非配置模式下才导入服务
 from services.config_service import config_service
 need_config = not config_service.initialize()
@@ -22,49 +28,44 @@ if not need_config:
     from services.chat_service import chat_service
     from services.image_service import image_service
     from services.option_service import option_service
+    from services.prefetch_service import prefetch_service
+    from services.prompt_service import prompt_service
+    from services.session_service import session_manager, SESSION_COOKIE, SESSION_HEADER
     from utils.api_utils import APIError
 
 bp = Blueprint('chat', 'chat', url_prefix='')
 
 # ------------------------------------------------------------------
-# 工具函数（与 app.py 保持一致）
+# 会话：每个浏览器（或携带会话请求头的标签页）拥有独立的对话上下文
 # ------------------------------------------------------------------
-def _parse_assistant_text(raw: str) -> str:
-    if not raw:
-        return ""
-    try:
-        obj = json.loads(raw)
-        if isinstance(obj, dict):
-            text = obj.get('content')
-            if isinstance(text, str):
-                return text
-        if isinstance(obj, str):
-            return obj
-    except Exception:
-        pass
-    return str(raw)
-
-def _extract_last_sentence(text: str) -> str:
-    import re as _re
-    if not text:
-        return ""
-    text = _re.sub(r"\s+", " ", text).strip()
-    if not text:
-        return ""
-    sentence_endings = ['。', '！', '？', '!', '?', '.', '…', '♪', '...']
-    escaped = ''.join(_re.escape(ch) for ch in sentence_endings)
-    pattern = rf"([^ {escaped}]+(?:[{escaped}]+)?)$"
-    m = _re.search(pattern, text)
-    return m.group(1).strip() if m else text
+@bp.before_app_request
+def _activate_chat_session():
+    if need_config or request.endpoint == 'static':
+        return
+    session_manager.activate(request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE))
+
+@bp.after_app_request
+def _save_chat_session(response):
+    if not need_config:
+        session_id = session_manager.created_session_id()
+        if session_id:
+            max_age = int(config_service.get_app_config().get("session_ttl", 6 * 3600))
+            response.set_cookie(SESSION_COOKIE, session_id, max_age=max_age, httponly=True, samesite='Lax')
+    return response
+
+@bp.teardown_app_request
+def _deactivate_chat_session(exc=None):
+    if not need_config:
+        session_manager.deactivate()
 
+# ------------------------------------------------------------------
+# 工具函数（与 app.py 保持一致）
+# ------------------------------------------------------------------
 def _get_last_assistant_sentence_for_character(character_id: str) -> str:
     try:
-        history_messages = chat_service.history_manager.load_history(character_id, count=200, max_cache_size=500)
-        for msg in reversed(history_messages):
-            if msg.get('role') == 'assistant':
-                raw = msg.get('content', '')
-                text = _parse_assistant_text(raw)
-                return _extract_last_sentence(text)
+        # 读取历史记录侧写，无需加载整个历史日志
+        meta = chat_service.history_manager.get_metadata(character_id)
+        return meta.get('last_assistant_sentence') or ""
     except Exception as e:
         print(f"提取最后一句失败: {e}")
     return ""
@@ -72,60 +73,36 @@ def _get_last_assistant_sentence_for_character(character_id: str) -> str:
 # ------------------------------------------------------------------
 # MCP 工具函数
 # ------------------------------------------------------------------
-def _is_in_string(text: str, position: int, in_string: bool, escape: bool) -> tuple:
-    """
-    检查指定位置是否在字符串内
-    """
-    ch = text[position]
-    if in_string:
-        if escape:
-            return in_string, False
-        elif ch == '\\':
-            return in_string, True
-        elif ch == '"':
-            return False, False
-    else:
-        if ch == '"':
-            return True, False
-    return in_string, escape
-
-def _update_brace_count(text: str, position: int, in_string: bool, brace_count: int, current_start: int) -> tuple:
-    """
-    更新大括号计数
-    """
-    if in_string:
-        return brace_count, current_start
-    
-    ch = text[position]
-    if ch == '{':
-        if brace_count == 0:
-            current_start = position
-        return brace_count + 1, current_start
-    elif ch == '}':
-        if brace_count > 0:
-            return brace_count - 1, current_start
-    return brace_count, current_start
-
 def _extract_last_complete_json(text: str) -> Optional[str]:
     """
     从给定文本中提取最后一个完整且平衡的 JSON 对象（忽略字符串内的大括号）
     """
     if not text:
         return None
-    
     in_string = False
     escape = False
     brace_count = 0
     last_complete_end = -1
     current_start = -1
-    
     for i, ch in enumerate(text):
-        in_string, escape = _is_in_string(text, i, in_string, escape)
-        if not in_string:
-            brace_count, current_start = _update_brace_count(text, i, in_string, brace_count, current_start)
-            if brace_count == 0 and current_start != -1 and text[i] == '}':
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch == '{':
+            if brace_count == 0:
+                current_start = i
+            brace_count += 1
+        elif ch == '}' and brace_count > 0:
+            brace_count -= 1
+            if brace_count == 0 and current_start != -1:
                 last_complete_end = i + 1
-
     if last_complete_end != -1 and current_start != -1:
         try:
             candidate = text[current_start:last_complete_end]
@@ -206,90 +183,6 @@ def _get_max_ai_iterations():
     except Exception:
         return 10
 
-def _generate_mcp_tool_prompt(mcp_mod):
-    """
-    生成MCP工具提示文本
-    
-    Args:
-        mcp_mod: MCP模块实例
-        
-    Returns:
-        str: 生成的工具提示文本
-    """
-    if not mcp_mod:
-        return None
-        
-    try:
-        # 获取工具描述
-        tools_desc = mcp_mod.list_tools_for_prompt()
-        lines = [
-            "[MCP 工具使用指南]",
-            "始终只输出一个合法的 JSON 对象（不要使用代码块标记）。",
-            "JSON 结构: { content:string, mood?:string, tool_request?:{ name:string, args:object, reason:string } }",
-            "需要调用工具时：在同一个 JSON 中加入 tool_request 字段；若已对用户输出过部分内容，不要重复这些内容，仅继续后文。",
-            "系统返回工具结果后：继续输出新的单个 JSON。若仍需调用工具，可再次提供 tool_request；否则仅给出 content。允许多轮连续调用工具，直到任务完成或达到限制。",
-            "严格要求：",
-            "- 不要复述之前已经对用户输出过的文本；接着写下去。",
-            "- 保留并正确使用原始标点符号，不要删除或改写标点。",
-            "- 每轮都只输出一个 JSON 对象，不要输出多段或附加说明。",
-            "[工具列表]",
-        ]
-        for name, meta in tools_desc.items():
-            args_desc = ", ".join(f"{k}:{v}" for k, v in (meta.get("args", {}) or {}).items())
-            lines.append(f"- {name}: {meta.get('desc','')} 参数: {args_desc}")
-        return "\n".join(lines)
-    except Exception:
-        return None
-
-def _generate_mcp_disabled_prompt():
-    """
-    生成MCP禁用提示文本
-    
-    Returns:
-        str: 生成的MCP禁用提示文本
-    """
-    lines = [
-        "[MCP 工具状态通知]",
-        "当前用户已关闭MCP工具功能。即使你在输出中包含tool_request字段，系统也不会执行任何工具调用。",
-        "请勿尝试使用任何MCP工具，只需正常与用户对话即可。"
-    ]
-    return "\n".join(lines)
-
-def _inject_mcp_prompt_to_messages(base_messages, mcp_mod, mcp_enabled):
-    """
-    注入MCP工具使用说明到消息列表中
-    
-    Args:
-        base_messages: 基础消息列表
-        mcp_mod: MCP模块实例
-        mcp_enabled: MCP是否启用
-        
-    Returns:
-        注入提示后的消息列表
-    """
-    try:
-        mcp_tool_prompt = None
-        # 根据MCP是否启用选择不同的提示文本
-        if mcp_enabled and mcp_mod:
-            mcp_tool_prompt = _generate_mcp_tool_prompt(mcp_mod)
-        elif not mcp_enabled:
-            mcp_tool_prompt = _generate_mcp_disabled_prompt()
-            
-        if not mcp_tool_prompt:
-            return base_messages
-            
-        inserted = False
-        for idx, msg in enumerate(base_messages):
-            if msg.get("role") == "system":
-                base_messages.insert(idx + 1, {"role": "system", "content": mcp_tool_prompt})
-                inserted = True
-                break
-        if not inserted:
-            base_messages.insert(0, {"role": "system", "content": mcp_tool_prompt})
-    except Exception:
-        pass
-    return base_messages
-
 # ------------------------------------------------------------------
 # 页面路由
 # ------------------------------------------------------------------
@@ -303,6 +196,9 @@ def _set_character_if_needed():
     """
     如果需要，设置当前角色
     """
+    # 页面请求不创建会话：没有会话时，首次发送消息会按最近选择的角色创建并加载历史
+    if session_manager.peek() is None:
+        return
     try:
         current_character = chat_service.get_character_config()
         if current_character and "id" in current_character:
@@ -429,13 +325,14 @@ def chat():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
-def _initialize_chat_stream_variables(mcp_enabled, mcp_mod):
+def _initialize_chat_stream_variables(mcp_enabled, mcp_mod, user_query=None):
     """
     初始化聊天流变量
     
     Args:
         mcp_enabled (bool): 是否启用MCP
         mcp_mod: MCP模块
+        user_query (str): 用户消息，用于检索记忆与角色详情（仅附加一次）
         
     Returns:
         dict: 初始化的变量字典
@@ -448,9 +345,15 @@ def _initialize_chat_stream_variables(mcp_enabled, mcp_mod):
         max_ai_iterations = 10
     
     # 冻结本次请求的提示词：构造一次 base_messages，不在迭代中改动
-    base_messages = chat_service.format_messages()
-    # 注入MCP提示（无论启用还是禁用）
-    base_messages = _inject_mcp_prompt_to_messages(base_messages, mcp_mod, mcp_enabled)
+    # 记忆与角色详情只在此处检索并附加一次（可复用输入时的预取结果），迭代中不再重复附加
+    full_context = chat_service.build_memory_context(user_query) if user_query else ""
+    # 固定顺序：系统提示词 → MCP说明（无论启用还是禁用）→ 历史 → 附带上下文的用户消息
+    base_messages = prompt_service.build_messages(
+        chat_service.format_messages(),
+        mcp_enabled=mcp_enabled,
+        mcp_mod=mcp_mod,
+        context=full_context
+    )
     
     return {
         'max_ai_iterations': max_ai_iterations,
@@ -481,6 +384,462 @@ def _construct_current_messages(has_tool_context, base_messages, system_only_mes
         current_messages.extend(per_request_system_msgs)
         return current_messages
 
+SSE_DONE = "data: [DONE]\n\n"
+# SSE 注释行，前端忽略，只用于保持连接并发现已断开的客户端
+SSE_HEARTBEAT = ": ping\n\n"
+
+
+def sse_event(payload: dict) -> str:
+    """把一个事件编码为 SSE data 行"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def _handle_tool_call(tool_call_data):
+    """
+    处理工具调用，执行工具并返回结果
+    
+    Args:
+        tool_call_data (dict): 包含工具调用所需的所有数据
+            - tool_name: 工具名称
+            - tool_args: 工具参数
+            - reason: 调用原因
+            - mcp_mod: MCP模块
+            - message: 用户消息
+            
+    Returns:
+        dict: 处理结果
+    """
+    tool_name = tool_call_data.get('tool_name')
+    tool_args = tool_call_data.get('tool_args')
+    reason = tool_call_data.get('reason')
+    mcp_mod = tool_call_data.get('mcp_mod')
+    message = tool_call_data.get('message')
+    
+    try:
+        # 实际调用工具
+        result = mcp_mod.call_tool(tool_name, tool_args)
+        
+        # 构造简洁的前端提示（不含详情）
+        system_msg_front = f"[MCP] 工具完成：{tool_name}（成功）"
+        
+        # 详细结果仅放入模型上下文
+        try:
+            result_str = json.dumps(result, ensure_ascii=False)
+        except Exception:
+            result_str = str(result)
+        if len(result_str) > 800:
+            result_str = result_str[:800] + '...'
+        system_msg_detail = f"[MCP] 工具完成：{tool_name}，结果：{result_str}"
+        
+        # 说明性提示仅供模型参考，不推送到前端
+        bracket_note = f"[说明] 结构：AI:[{{content: 已处理, tool: {tool_name}, status: ok}}]。方括号内是你基于内容的回应，现在等待你的下一步操作。"
+        
+        # 重申用户原始需求，确保基于工具结果继续
+        user_note = f"[用户原始需求(注意：你需要基于工具结果继续回答)] {message}" if message else ""
+        
+        return {
+            "status": "success",
+            "system_msg_front": system_msg_front,
+            "system_msg_detail": system_msg_detail,
+            "bracket_note": bracket_note,
+            "user_note": user_note,
+            "result": result_str
+        }
+    except Exception as e:
+        # 失败：前端仅显示失败，不展示错误详情
+        err_front = f"[MCP] 工具完成：{tool_name}（失败）"
+        err_msg = f"[MCP] 工具调用失败：{tool_name}，错误：{str(e)}"
+        
+        # 说明性提示仅供模型参考，不推送到前端
+        bracket_note = f"[说明] 结构：AI:[{{content: 已处理, tool: {tool_name}, status: error}}]。方括号内是你基于内容的回应，现在等待你的下一步操作。"
+        
+        # 同样在失败场景下，重申用户原始需求，便于 AI 选择改用其他工具或改写方案
+        user_note = f"[用户原始需求(注意：你需要基于工具结果继续回答)] {message}" if message else ""
+        
+        return {
+            "status": "error",
+            "err_front": err_front,
+            "err_msg": err_msg,
+            "bracket_note": bracket_note,
+            "user_note": user_note
+        }
+
+def _normalize_options(options) -> Optional[List[str]]:
+    """
+    整理主回复 JSON 中的 options 字段
+
+    Args:
+        options: 模型输出的 options 字段
+
+    Returns:
+        最多3个非空选项；格式不对或为空时返回None
+    """
+    if isinstance(options, str):
+        options = options.split('\n')
+    if not isinstance(options, list):
+        return None
+    cleaned = [str(opt).strip() for opt in options if isinstance(opt, (str, int, float)) and str(opt).strip()]
+    return cleaned[:3] or None
+
+
+class ChatTurn:
+    """
+    一次用户消息对应的流式回复（含同一轮内的 MCP 工具代理循环）
+
+    只负责解析模型输出、维护工具循环状态并产出 SSE 事件，不关心模型 token 从哪里来：
+    同步的 /api/chat/stream（WSGI 线程）与 asgi.py 中的异步流式接口共用这套逻辑。
+    prepare()、run_tool()、complete()、option_events() 可能阻塞（记忆检索、工具调用、写记忆与等待选项），
+    异步调用方应放到线程池中执行。客户端中途断开时，调用方关闭上游流后调用 cancel()。
+    """
+
+    def __init__(self, message: str, mcp_enabled: bool):
+        """
+        初始化对话轮次
+
+        Args:
+            message: 用户消息
+            mcp_enabled: 是否启用MCP
+        """
+        self.message = message
+        self.mcp_enabled = mcp_enabled
+        # 后台选项生成任务ID（complete() 中提交）
+        self.turn_id = None
+        self.options_deadline = None
+        # 本轮生成状态（start_round() 重置）；finished 表示已经 complete() 或 cancel()
+        self.full_response = ""
+        self.parsed_mood = None
+        self.parsed_content = ""
+        self.pending_tool = None
+        self.tool_call = None
+        # feed() 产生、尚未写入会话历史的状态提示（由 run_tool()/cancel() 在调用方的线程池中写入）
+        self.pending_status: List[str] = []
+        self.finished = False
+        # 懒加载导入 MCP 模块
+        try:
+            from plugins import mcps as mcp_mod
+        except Exception:
+            mcp_mod = None
+        self.mcp_mod = mcp_mod
+
+    def prepare(self) -> None:
+        """冻结本次请求的提示词并初始化工具循环状态（含记忆检索）"""
+        # 调试：记录本次请求是否启用 MCP
+        try:
+            print(f"[MCP][DEBUG] chat_stream started. mcp_enabled={self.mcp_enabled}")
+        except Exception:
+            pass
+        vars = _initialize_chat_stream_variables(self.mcp_enabled, self.mcp_mod, user_query=self.message)
+        self.max_ai_iterations = vars['max_ai_iterations']
+        self.iteration_count = vars['iteration_count']
+        self.seen_tool_sigs = vars['seen_tool_sigs']
+        self.stop_outer_loop = vars['stop_outer_loop']
+        self.base_messages = vars['base_messages']
+        self.per_request_system_msgs = vars['per_request_system_msgs']
+        self.system_only_messages = vars['system_only_messages']
+        self.tool_request_history = vars['tool_request_history']
+        self.has_tool_context = vars['has_tool_context']
+
+    def start_round(self) -> list:
+        """
+        开始新一轮生成
+
+        Returns:
+            list: 本轮发送给模型的消息
+        """
+        self.full_response = ""
+        self.parsed_mood = None
+        self.parsed_content = ""
+        self.saw_tool_request = False
+        # 主回复 JSON 中附带的选项（OPTION_CONFIG["inline_options"]）
+        self.inline_options = None
+        self.last_json = None
+        # 待执行的工具调用（延迟到句末再执行）
+        self.pending_tool = None  # dict(type: 'call'|'dup'|'limit', ...)
+        # 已到句末、等待调用方执行的工具调用
+        self.tool_call = None
+        return _construct_current_messages(
+            self.has_tool_context, self.base_messages, self.system_only_messages,
+            self.per_request_system_msgs, self.tool_request_history)
+
+    def _add_system_note(self, content: str) -> None:
+        """
+        把一条工具相关的 system 消息加入本次请求的上下文
+
+        工具结果详情与说明性提示只在本次工具循环内有效，不写入会话历史，之后的请求不再重复发送
+        """
+        self.per_request_system_msgs.append({"role": "system", "content": content})
+
+    @staticmethod
+    def _record_status(content: str) -> None:
+        """把一条简短的工具状态提示写入会话历史"""
+        try:
+            chat_service.add_message("system", content)
+        except Exception:
+            pass
+
+    def _flush_status(self) -> None:
+        """把 feed() 暂存的状态提示写入会话历史"""
+        pending, self.pending_status = self.pending_status, []
+        for content in pending:
+            self._record_status(content)
+
+    def feed(self, chunk: Optional[str]) -> Tuple[List[str], bool]:
+        """
+        处理模型输出的一个片段
+
+        Args:
+            chunk: 模型输出片段
+
+        Returns:
+            (SSE事件列表, 是否结束本轮读取)；结束后调用方应接着执行 run_tool()
+
+        只做解析，不写会话历史（异步接口在事件循环上调用）；状态提示暂存在 pending_status
+        """
+        events = []
+        if chunk is None:
+            return events, False
+        self.full_response += chunk
+        try:
+            json_str = _extract_last_complete_json(self.full_response)
+            if not json_str:
+                return events, False
+            try:
+                json_data = json.loads(json_str)
+            except json.JSONDecodeError:
+                # 流式传输中可能出现部分JSON未完整闭合的情况，忽略并等待更多数据
+                return events, False
+
+            self.last_json = json_data
+            if 'options' in json_data:
+                self.inline_options = _normalize_options(json_data.get('options'))
+
+            # mood 变化可直接推送
+            if 'mood' in json_data:
+                new_mood = json_data['mood']
+                if new_mood != self.parsed_mood:
+                    self.parsed_mood = new_mood
+                    events.append(sse_event({'mood': self.parsed_mood}))
+
+            # 仅在尚未检测到工具调用时流式推送内容；一旦检测到，将暂停继续推送
+            if 'content' in json_data and not self.saw_tool_request:
+                new_content = json_data['content']
+                if new_content != self.parsed_content:
+                    if len(new_content) < len(self.parsed_content):
+                        events.append(sse_event({'content': new_content}))
+                    else:
+                        content_diff = new_content[len(self.parsed_content):]
+                        if content_diff:
+                            events.append(sse_event({'content': content_diff}))
+                    self.parsed_content = new_content
+
+            # 如果已有待执行的工具请求，等待句末再触发
+            if self.pending_tool and _is_sentence_end(self.parsed_content):
+                kind = self.pending_tool.get('type')
+                if kind == 'limit' or kind == 'dup':
+                    msg = self.pending_tool.get('msg', '')
+                    if msg:
+                        events.append(sse_event({'system': msg}))
+                        self.pending_status.append(msg)
+                        self._add_system_note(msg)
+                    self.pending_tool = None
+                    if kind == 'limit':
+                        self.stop_outer_loop = True
+                    # 对于重复调用，仍进入下一轮让模型继续
+                    return events, True
+                elif kind == 'call':
+                    # 一旦执行工具，立刻中断当前流，进入下一轮
+                    self.tool_call, self.pending_tool = self.pending_tool, None
+                    return events, True
+
+            # 处理工具请求：暂停输出，调用工具，写入history，并开始下一轮
+            if self.mcp_enabled and self.mcp_mod and isinstance(json_data, dict) and 'tool_request' in json_data:
+                tr = json_data.get('tool_request') or {}
+                tool_request_data = {
+                    'tr': tr,
+                    'max_ai_iterations': self.max_ai_iterations,
+                    'iteration_count': self.iteration_count,
+                    'seen_tool_sigs': self.seen_tool_sigs,
+                    'message': self.message
+                }
+                _process_tool_request(tool_request_data)
+                if tr.get('name'):
+                    self.saw_tool_request = True
+                    # 一旦检测到工具请求：记录本次 assistant 的 tool_request JSON，并进入工具上下文
+                    self.tool_request_history.append({"role": "assistant", "content": json_str})
+                    self.has_tool_context = True
+                    # 轮次计数与检查
+                    self.iteration_count += 1
+                    if self.iteration_count > self.max_ai_iterations:
+                        limit_msg = f"[MCP] 已达到单次请求的最大AI轮次限制({self.max_ai_iterations})，停止工具调用。"
+                        # 等待句末后再提示并结束
+                        self.pending_tool = {"type": "limit", "msg": limit_msg}
+                        return events, False
+
+                    # 构造去重签名：name+sorted(args)
+                    try:
+                        sig = json.dumps({"name": tr.get('name'), "args": tr.get('args') or {}}, sort_keys=True, ensure_ascii=False)
+                    except Exception:
+                        sig = f"{tr.get('name')}:{str(tr.get('args') or {})}"
+                    if sig in self.seen_tool_sigs:
+                        dup_msg = f"[MCP] 检测到重复的工具请求，已跳过：{tr.get('name')} args={tr.get('args') or {}}"
+                        # 等待句末后提示，再进入下一轮
+                        self.pending_tool = {"type": "dup", "msg": dup_msg}
+                        return events, False
+                    self.seen_tool_sigs.add(sig)
+                    # 延迟到句末执行实际调用
+                    self.pending_tool = {
+                        "type": "call",
+                        "name": tr.get('name'),
+                        "args": tr.get('args') or {},
+                        "reason": tr.get('reason') or ""
+                    }
+        except Exception:
+            # 如果解析失败，尽量回退为原始片段推送（保持兼容）
+            events.append(sse_event({'content': chunk}))
+        return events, False
+
+    def run_tool(self) -> List[str]:
+        """
+        写入 feed() 暂存的状态提示，并执行 feed() 在句末触发的工具调用，把结果写入上下文
+
+        Returns:
+            list: SSE事件列表
+        """
+        self._flush_status()
+        call, self.tool_call = self.tool_call, None
+        if not call:
+            return []
+        tool_name = call.get('name')
+        tool_result = _handle_tool_call({
+            'tool_name': tool_name,
+            'tool_args': call.get('args') or {},
+            'reason': call.get('reason') or '',
+            'mcp_mod': self.mcp_mod,
+            'message': self.message
+        })
+        # 会话历史只保留简短的状态提示，结果详情只用于本次工具循环
+        if tool_result['status'] == 'success':
+            events = [sse_event({'system': tool_result['system_msg_front']})]
+            self._record_status(tool_result['system_msg_front'])
+            self._add_system_note(tool_result['system_msg_detail'])
+        else:
+            # 失败：前端仅显示失败，不展示错误详情
+            events = [sse_event({'system': tool_result['err_front']})]
+            self._record_status(tool_result['err_front'])
+            self._add_system_note(tool_result['err_msg'])
+        # 说明性提示仅供模型参考，不推送到前端
+        self._add_system_note(tool_result['bracket_note'])
+        if tool_result['user_note']:
+            self.per_request_system_msgs.append({"role": "system", "content": tool_result['user_note']})
+        try:
+            print(f"[MCP][DEBUG] Tool executed: {tool_name}")
+        except Exception:
+            pass
+        return events
+
+    def end_round(self) -> str:
+        """
+        一次流式读取结束后决定下一步
+
+        Returns:
+            str: "stop"（达到限制，直接结束）、"next"（有工具调用，进入下一轮）或 "complete"（正常完成）
+        """
+        if self.stop_outer_loop:
+            self.finished = True
+            return "stop"
+        if self.saw_tool_request:
+            # 不记录本轮的assistant文本，直接进入下一轮（已有工具结果写入history）
+            return "next"
+        return "complete"
+
+    def complete(self) -> List[str]:
+        """
+        正常完成（无工具调用）：记录回复并写入记忆；主回复附带选项时直接推送，
+        否则在后台调用选项模型（与写入记忆并行）
+
+        Returns:
+            list: SSE事件列表（后台生成的选项由随后的 option_events() 产出）
+        """
+        events = []
+        if not self.full_response:
+            return events
+        self.finished = True
+        server_monitor.record_reply(count_tokens(self.full_response))
+        option_config = config_service.get_option_config()
+        inline_options = self.inline_options if option_config.get("enable_option_generation", True) else None
+        # 回复按结构化字段保存（以最后一个完整 JSON 为准）；选项只用于前端展示，不写入历史
+        raw = json.dumps(self.last_json, ensure_ascii=False) if isinstance(self.last_json, dict) else self.full_response
+        reply = chat_service.add_message("assistant", raw)
+        if inline_options:
+            events.append(sse_event({'options': inline_options}))
+        # 选项等待的截止时间从回复完成时算起，慢的选项模型不会推迟 [DONE]
+        self.options_deadline = Deadline(float(option_config.get("stream_wait", 3.0)))
+        try:
+            turn_id = uuid.uuid4().hex
+            # 主回复未附带选项时才单独调用选项模型
+            if not inline_options and option_service.submit(
+                turn_id,
+                conversation_history=chat_service.format_messages(),
+                character_config=chat_service.get_character_config(),
+                user_query=self.message
+            ):
+                self.turn_id = turn_id
+        except Exception as e:
+            print(f"选项生成失败: {e}")
+        try:
+            character_id = chat_service.current_character_id()
+            chat_service.memory_service.add_conversation(
+                user_message=self.message,
+                assistant_message=reply.content,
+                character_name=character_id
+            )
+        except Exception as e:
+            print(f"添加对话到记忆数据库失败: {e}")
+        return events
+
+    def cancel(self) -> None:
+        """
+        客户端已断开（调用方已关闭上游流）：放弃待执行的工具调用，
+        把已推送给用户的部分回复写入会话历史并注明中断，不写入记忆、不生成选项
+        """
+        if self.finished:
+            return
+        self.finished = True
+        aborted = sum(1 for call in (self.tool_call, self.pending_tool)
+                      if call and call.get('type') == 'call')
+        self.tool_call = None
+        self.pending_tool = None
+        self._flush_status()
+        generated = count_tokens(self.full_response) if self.full_response else 0
+        saved = server_monitor.record_cancel(generated, aborted)
+        if self.parsed_content:
+            partial = {"content": self.parsed_content}
+            if self.parsed_mood is not None:
+                partial = {"mood": self.parsed_mood, "content": self.parsed_content}
+            try:
+                chat_service.add_message("assistant", json.dumps(partial, ensure_ascii=False))
+            except Exception as e:
+                print(f"记录中断的回复失败: {e}")
+        self._record_status("[系统] 客户端已断开，上一条回复未完成")
+        print(f"客户端已断开，已取消本次回复: 已生成 {generated} tokens，预计节省 {saved} tokens，放弃工具调用 {aborted} 次")
+
+    def option_events(self) -> List[str]:
+        """
+        在本轮截止时间内等待后台选项生成
+
+        Returns:
+            list: SSE事件列表；按时完成时推送 options，否则推送 options_pending（turn_id），
+                  前端在流结束后通过 /api/options/<turn_id> 获取
+        """
+        if not self.turn_id:
+            return []
+        status, options = option_service.result(self.turn_id, wait=self.options_deadline.remaining())
+        if status == "ready":
+            return [sse_event({'options': options})] if options else []
+        if status == "pending":
+            return [sse_event({'options_pending': self.turn_id})]
+        return []
+
 @bp.route('/api/chat/stream', methods=['POST'])
 def chat_stream():
     try:
@@ -488,451 +847,71 @@ def chat_stream():
         mcp_enabled = bool(request.json.get('mcp_enabled', False))
         if not message:
             return jsonify({'success': False, 'error': '消息不能为空'}), 400
-        chat_service.add_message("user", message)
+        # 流式响应在请求上下文结束后才迭代，先固定本次请求的会话
+        session = chat_service.get_session()
+        # waitress 在处理请求期间继续读取连接（channel_request_lookahead），可随时查询客户端是否已断开
+        client_disconnected = request.environ.get('waitress.client_disconnected') or (lambda: False)
+        heartbeat_interval = float(config_service.get_stream_config().get("heartbeat_interval", 10))
 
         def generate():
+            # 同一会话的回复串行执行，避免并发回复交错写入上下文
+            with session_manager.bind(session), session.turn_lock:
+                chat_service.add_message("user", message)
+                yield from generate_turn()
+
+        def generate_turn():
+            turn = ChatTurn(message, mcp_enabled)
             try:
-                # 调试：记录本次请求是否启用 MCP
-                try:
-                    print(f"[MCP][DEBUG] chat_stream started. mcp_enabled={mcp_enabled}")
-                except Exception:
-                    pass
-                # 懒加载导入 MCP 模块
-                try:
-                    from plugins import mcps as mcp_mod
-                except Exception:
-                    mcp_mod = None
-
-                # 实现同一轮内的代理循环
-                # 解析帮助函数：从给定文本中提取最后一个完整且平衡的 JSON 对象（忽略字符串内的大括号）
-                def _extract_last_complete_json(text: str) -> Optional[str]:
-                    if not text:
-                        return None
-                    in_string = False
-                    escape = False
-                    brace_count = 0
-                    last_complete_end = -1
-                    current_start = -1
-                    for i, ch in enumerate(text):
-                        if in_string:
-                            if escape:
-                                escape = False
-                            elif ch == '\\':
-                                escape = True
-                            elif ch == '"':
-                                in_string = False
-                            continue
-                        else:
-                            if ch == '"':
-                                in_string = True
-                                continue
-                            if ch == '{':
-                                if brace_count == 0:
-                                    current_start = i
-                                brace_count += 1
-                            elif ch == '}':
-                                if brace_count > 0:
-                                    brace_count -= 1
-                                    if brace_count == 0 and current_start != -1:
-                                        last_complete_end = i + 1
-                        # 其他字符不影响 brace 计数
-                    if last_complete_end != -1 and current_start != -1:
-                        try:
-                            candidate = text[current_start:last_complete_end]
-                            # 验证是合法 JSON
-                            json.loads(candidate)
-                            return candidate
-                        except Exception:
-                            return None
-                    return None
-
-                def _parse_json_response(full_response: str) -> tuple:
-                    """解析 JSON 响应，提取 mood、content 和 tool_request"""
-                    try:
-                        json_str = _extract_last_complete_json(full_response)
-                        if json_str:
-                            json_data = json.loads(json_str)
-                            
-                            mood = json_data.get('mood')
-                            content = json_data.get('content', '')
-                            
-                            tool_request = None
-                            if mcp_enabled and mcp_mod and isinstance(json_data, dict) and 'tool_request' in json_data:
-                                tool_request = json_data.get('tool_request') or {}
-                            
-                            return json_str, json_data, mood, content, tool_request
-                        return None, None, None, None, None
-                    except json.JSONDecodeError:
-                        return None, None, None, None, None
-
-                def _is_sentence_end(s: str) -> bool:
-                    """
-                    判断字符串是否以句子结束符结尾
-                    """
-                    if not s:
-                        return False
-                    t = s.rstrip()
-                    if not t:
-                        return False
-                    # 句末判断：以常见结束符收尾
-                    ends = ('。', '！', '？', '!', '?', '.', '…')
-                    return t.endswith(ends)
-
-                def _handle_tool_call(tool_call_data):
-                    """
-                    处理工具调用，执行工具并返回结果
-                    
-                    Args:
-                        tool_call_data (dict): 包含工具调用所需的所有数据
-                            - tool_name: 工具名称
-                            - tool_args: 工具参数
-                            - reason: 调用原因
-                            - mcp_mod: MCP模块
-                            - message: 用户消息
-                            
-                    Returns:
-                        dict: 处理结果
-                    """
-                    tool_name = tool_call_data.get('tool_name')
-                    tool_args = tool_call_data.get('tool_args')
-                    reason = tool_call_data.get('reason')
-                    mcp_mod = tool_call_data.get('mcp_mod')
-                    message = tool_call_data.get('message')
-                    
-                    try:
-                        # 实际调用工具
-                        result = mcp_mod.call_tool(tool_name, tool_args)
-                        
-                        # 构造简洁的前端提示（不含详情）
-                        system_msg_front = f"[MCP] 工具完成：{tool_name}（成功）"
-                        
-                        # 详细结果仅放入模型上下文
-                        try:
-                            result_str = json.dumps(result, ensure_ascii=False)
-                        except Exception:
-                            result_str = str(result)
-                        if len(result_str) > 800:
-                            result_str = result[:800] + '...'
-                        system_msg_detail = f"[MCP] 工具完成：{tool_name}，结果：{result_str}"
-                        
-                        # 说明性提示仅供模型参考，不推送到前端
-                        bracket_note = f"[说明] 结构：AI:[{{content: 已处理, tool: {tool_name}, status: ok}}]。方括号内是你基于内容的回应，现在等待你的下一步操作。"
-                        
-                        # 重申用户原始需求，确保基于工具结果继续
-                        user_note = f"[用户原始需求(注意：你需要基于工具结果继续回答)] {message}" if message else ""
-                        
-                        return {
-                            "status": "success",
-                            "system_msg_front": system_msg_front,
-                            "system_msg_detail": system_msg_detail,
-                            "bracket_note": bracket_note,
-                            "user_note": user_note,
-                            "result": result_str
-                        }
-                    except Exception as e:
-                        # 失败：前端仅显示失败，不展示错误详情
-                        err_front = f"[MCP] 工具完成：{tool_name}（失败）"
-                        err_msg = f"[MCP] 工具调用失败：{tool_name}，错误：{str(e)}"
-                        
-                        # 说明性提示仅供模型参考，不推送到前端
-                        bracket_note = f"[说明] 结构：AI:[{{content: 已处理, tool: {tool_name}, status: error}}]。方括号内是你基于内容的回应，现在等待你的下一步操作。"
-                        
-                        # 同样在失败场景下，重申用户原始需求，便于 AI 选择改用其他工具或改写方案
-                        user_note = f"[用户原始需求(注意：你需要基于工具结果继续回答)] {message}" if message else ""
-                        
-                        return {
-                            "status": "error",
-                            "err_front": err_front,
-                            "err_msg": err_msg,
-                            "bracket_note": bracket_note,
-                            "user_note": user_note
-                        }
-
-                def _construct_messages(current_messages: list, per_request_system_msgs: list, tool_request_history: list, has_tool_context: bool) -> list:
-                    """构造当前轮次的消息"""
-                    if not has_tool_context:
-                        return list(current_messages) + per_request_system_msgs
-                    else:
-                        messages = list(current_messages)
-                        if tool_request_history:
-                            messages.extend(tool_request_history)
-                        messages.extend(per_request_system_msgs)
-                        return messages
-                        
-                # 初始化变量
-                vars = _initialize_chat_stream_variables(mcp_enabled, mcp_mod)
-                max_ai_iterations = vars['max_ai_iterations']
-                iteration_count = vars['iteration_count']
-                seen_tool_sigs = vars['seen_tool_sigs']
-                stop_outer_loop = vars['stop_outer_loop']
-                base_messages = vars['base_messages']
-                per_request_system_msgs = vars['per_request_system_msgs']
-                system_only_messages = vars['system_only_messages']
-                tool_request_history = vars['tool_request_history']
-                has_tool_context = vars['has_tool_context']
-                
+                turn.prepare()
                 while True:
-                    # 本轮消息构造：
-                    current_messages = _construct_current_messages(
-                        has_tool_context, base_messages, system_only_messages,
-                        per_request_system_msgs, tool_request_history)
-                        
+                    if client_disconnected():
+                        turn.cancel()
+                        return
                     stream_gen = chat_service.chat_completion(
-                        messages=current_messages,
+                        messages=turn.start_round(),
                         stream=True,
                         user_query=None,  # 避免重复附加记忆/细节
                         mcp_enabled=False  # 我们已在 base_messages 中注入一次MCP说明
                     )
-                    full_response = ""
-                    parsed_mood = None
-                    parsed_content = ""
-                    saw_tool_request = False
-                    # 待执行的工具调用（延迟到句末再执行）
-                    pending_tool = None  # dict(type: 'call'|'dup'|'limit'|'error', data:...)
-
-                    for chunk in stream_gen:
-                        if chunk is None:
-                            continue
-                        full_response += chunk
-                        try:
-                            json_str = _extract_last_complete_json(full_response)
-                            if json_str:
-                                try:
-                                    json_data = json.loads(json_str)
-
-                                    # mood 变化可直接推送
-                                    if 'mood' in json_data:
-                                        new_mood = json_data['mood']
-                                        if new_mood != parsed_mood:
-                                            parsed_mood = new_mood
-                                            yield f"data: {json.dumps({'mood': parsed_mood})}\n\n"
-
-                                    # 仅在尚未检测到工具调用时流式推送内容；一旦检测到，将暂停继续推送
-                                    if 'content' in json_data and not saw_tool_request:
-                                        new_content = json_data['content']
-                                        if new_content != parsed_content:
-                                            if len(new_content) < len(parsed_content):
-                                                yield f"data: {json.dumps({'content': new_content})}\n\n"
-                                                parsed_content = new_content
-                                            else:
-                                                content_diff = new_content[len(parsed_content):]
-                                                if content_diff:
-                                                    yield f"data: {json.dumps({'content': content_diff})}\n\n"
-                                                parsed_content = new_content
-
-                                    # 如果已有待执行的工具请求，等待句末再触发
-                                    if pending_tool and _is_sentence_end(parsed_content):
-                                        kind = pending_tool.get('type')
-                                        if kind == 'limit' or kind == 'dup':
-                                            msg = pending_tool.get('msg', '')
-                                            if msg:
-                                                yield f"data: {json.dumps({'system': msg})}\n\n"
-                                                try:
-                                                    chat_service.add_message("system", msg)
-                                                except Exception:
-                                                    pass
-                                                per_request_system_msgs.append({"role": "system", "content": msg})
-                                            stop_outer_loop_local = (kind == 'limit')
-                                            pending_tool = None
-                                            if stop_outer_loop_local:
-                                                stop_outer_loop = True
-                                                break
-                                            # 对于重复调用，仍进入下一轮让模型继续
-                                            break
-                                        elif kind == 'call':
-                                            tool_name = pending_tool.get('name')
-                                            tool_args = pending_tool.get('args') or {}
-                                            reason = pending_tool.get('reason') or ''
-                                            pending_tool = None
-                                            
-                                            # 实际调用工具
-                                            try:
-                                                tool_call_data = {
-                                                    'tool_name': tool_name,
-                                                    'tool_args': tool_args,
-                                                    'reason': reason,
-                                                    'mcp_mod': mcp_mod,
-                                                    'message': message
-                                                }
-                                                tool_result = _handle_tool_call(tool_call_data)
-                                                
-                                                if tool_result['status'] == 'success':
-                                                    system_msg_front = tool_result['system_msg_front']
-                                                    yield f"data: {json.dumps({'system': system_msg_front})}\n\n"
-                                                    
-                                                    system_msg_detail = tool_result['system_msg_detail']
-                                                    try:
-                                                        chat_service.add_message("system", system_msg_detail)
-                                                    except Exception:
-                                                        pass
-                                                    per_request_system_msgs.append({"role": "system", "content": system_msg_detail})
-                                                    
-                                                    bracket_note = tool_result['bracket_note']
-                                                    try:
-                                                        chat_service.add_message("system", bracket_note)
-                                                    except Exception:
-                                                        pass
-                                                    per_request_system_msgs.append({"role": "system", "content": bracket_note})
-                                                    
-                                                    user_note = tool_result['user_note']
-                                                    if user_note:
-                                                        per_request_system_msgs.append({
-                                                            "role": "system",
-                                                            "content": user_note
-                                                        })
-                                                else:  # tool_result['status'] == 'error'
-                                                    err_front = tool_result['err_front']
-                                                    yield f"data: {json.dumps({'system': err_front})}\n\n"
-                                                    
-                                                    err_msg = tool_result['err_msg']
-                                                    try:
-                                                        chat_service.add_message("system", err_msg)
-                                                    except Exception:
-                                                        pass
-                                                    per_request_system_msgs.append({"role": "system", "content": err_msg})
-                                                    
-                                                    bracket_note = tool_result['bracket_note']
-                                                    try:
-                                                        chat_service.add_message("system", bracket_note)
-                                                    except Exception:
-                                                        pass
-                                                    per_request_system_msgs.append({"role": "system", "content": bracket_note})
-                                                    
-                                                    user_note = tool_result['user_note']
-                                                    if user_note:
-                                                        per_request_system_msgs.append({
-                                                            "role": "system",
-                                                            "content": user_note
-                                                        })
-                                                
-                                                try:
-                                                    print(f"[MCP][DEBUG] Tool executed: {tool_name}")
-                                                except Exception:
-                                                    pass
-                                                # 一旦执行工具，立刻中断当前流，进入下一轮
-                                                break
-                                            except Exception as e:
-                                                # 失败：前端仅显示失败，不展示错误详情
-                                                err_front = f"[MCP] 工具完成：{tool_name}（失败）"
-                                                yield f"data: {json.dumps({'system': err_front})}\n\n"
-                                                err_msg = f"[MCP] 工具调用失败：{tool_name}，错误：{str(e)}"
-                                                try:
-                                                    chat_service.add_message("system", err_msg)
-                                                except Exception:
-                                                    pass
-                                                per_request_system_msgs.append({"role": "system", "content": err_msg})
-                                                # 说明性提示仅供模型参考，不推送到前端
-                                                bracket_note = f"[说明] 结构：AI:[{{content: 已处理, tool: {tool_name}, status: error}}]。方括号内是你基于内容的回应，现在等待你的下一步操作。"
-                                                try:
-                                                    chat_service.add_message("system", bracket_note)
-                                                except Exception:
-                                                    pass
-                                                per_request_system_msgs.append({"role": "system", "content": bracket_note})
-                                                # 同样在失败场景下，重申用户原始需求，便于 AI 选择改用其他工具或改写方案
-                                                try:
-                                                    if message:
-                                                        per_request_system_msgs.append({
-                                                            "role": "system",
-                                                            "content": f"[用户原始需求(注意：你需要基于工具结果继续回答)] {message}"
-                                                        })
-                                                except Exception:
-                                                    pass
-                                                # 工具失败同样中断本轮
-                                                break
-
-                                    # 处理工具请求：暂停输出，调用工具，写入history，并开始下一轮
-                                    if mcp_enabled and mcp_mod and isinstance(json_data, dict) and 'tool_request' in json_data:
-                                        tr = json_data.get('tool_request') or {}
-                                        tool_request_data = {
-                                            'tr': tr,
-                                            'max_ai_iterations': max_ai_iterations,
-                                            'iteration_count': iteration_count,
-                                            'seen_tool_sigs': seen_tool_sigs,
-                                            'message': message
-                                        }
-                                        tool_process_result = _process_tool_request(tool_request_data)
-                                        if tr.get('name'):
-                                            saw_tool_request = True
-                                            # 一旦检测到工具请求：记录本次 assistant 的 tool_request JSON，并进入工具上下文
-                                            try:
-                                                if json_str:
-                                                    tool_request_history.append({"role": "assistant", "content": json_str})
-                                            except Exception:
-                                                pass
-                                            has_tool_context = True
-                                            # 轮次计数与检查
-                                            iteration_count += 1
-                                            if iteration_count > max_ai_iterations:
-                                                limit_msg = f"[MCP] 已达到单次请求的最大AI轮次限制({max_ai_iterations})，停止工具调用。"
-                                                pending_tool = {"type": "limit", "msg": limit_msg}
-                                                # 等待句末后再提示并结束
-                                                continue
-
-                                            # 构造去重签名：name+sorted(args)
-                                            try:
-                                                sig = json.dumps({"name": tr.get('name'), "args": tr.get('args') or {}}, sort_keys=True, ensure_ascii=False)
-                                            except Exception:
-                                                sig = f"{tr.get('name')}:{str(tr.get('args') or {})}"
-                                            if sig in seen_tool_sigs:
-                                                dup_msg = f"[MCP] 检测到重复的工具请求，已跳过：{tr.get('name')} args={tr.get('args') or {}}"
-                                                pending_tool = {"type": "dup", "msg": dup_msg}
-                                                # 等待句末后提示，再进入下一轮
-                                                continue
-                                            else:
-                                                seen_tool_sigs.add(sig)
-                                            # 延迟到句末执行实际调用
-                                            if tr.get('name'):
-                                                pending_tool = {
-                                                    "type": "call", 
-                                                    "name": tr.get('name'), 
-                                                    "args": tr.get('args') or {}, 
-                                                    "reason": tr.get('reason') or ""
-                                                }
-                                except json.JSONDecodeError:
-                                    # 流式传输中可能出现部分JSON未完整闭合的情况，忽略并等待更多数据
-                                    pass
-                        except Exception:
-                            # 如果解析失败，尽量回退为原始片段推送（保持兼容）
-                            yield f"data: {json.dumps({'content': chunk})}\n\n"
+                    last_write = time.monotonic()
+                    try:
+                        for chunk in stream_gen:
+                            if client_disconnected():
+                                break
+                            events, stop = turn.feed(chunk)
+                            if events:
+                                yield from events
+                                last_write = time.monotonic()
+                            elif time.monotonic() - last_write >= heartbeat_interval:
+                                # 模型长时间思考时发送心跳注释，写入失败即说明客户端已断开
+                                yield SSE_HEARTBEAT
+                                last_write = time.monotonic()
+                            if stop:
+                                break
+                    finally:
+                        # 立即关闭上游流并归还并发名额，不必等到工具执行完
+                        stream_gen.close()
+                    if client_disconnected():
+                        turn.cancel()
+                        return
+                    yield from turn.run_tool()
 
                     # 一次流式完成
-                    if stop_outer_loop:
-                        # 达到限制，直接结束
-                        yield "data: [DONE]\n\n"
-                        return
-                    if saw_tool_request:
-                        # 不记录本轮的assistant文本，直接进入下一轮（已有工具结果写入history）
+                    state = turn.end_round()
+                    if state == "next":
                         continue
-                    else:
-                        # 正常完成，无工具调用；记录并收尾
-                        if full_response:
-                            chat_service.add_message("assistant", full_response)
-                            try:
-                                character_id = chat_service.config_service.current_character_id or "default"
-                                chat_service.memory_service.add_conversation(
-                                    user_message=message,
-                                    assistant_message=full_response,
-                                    character_name=character_id
-                                )
-                            except Exception as e:
-                                print(f"添加对话到记忆数据库失败: {e}")
-                            try:
-                                conversation_history = chat_service.format_messages()
-                                character_config = chat_service.get_character_config()
-                                options = option_service.generate_options(
-                                    conversation_history=conversation_history,
-                                    character_config=character_config,
-                                    user_query=message
-                                )
-                                if options:
-                                    yield f"data: {json.dumps({'options': options})}\n\n"
-                            except Exception as e:
-                                print(f"选项生成失败: {e}")
-                        yield "data: [DONE]\n\n"
-                        return
+                    if state == "complete":
+                        yield from turn.complete()
+                        yield from turn.option_events()
+                    yield SSE_DONE
+                    return
+            except GeneratorExit:
+                # 写入失败（客户端断开）时服务器关闭响应迭代器，上游流已在上面的 finally 中关闭
+                turn.cancel()
+                raise
             except Exception as e:
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
-                yield "data: [DONE]\n\n"
+                yield sse_event({'error': str(e)})
+                yield SSE_DONE
 
         headers = {
             'Content-Type': 'text/event-stream',
@@ -945,6 +924,37 @@ def chat_stream():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@bp.route('/api/options/<turn_id>', methods=['GET'])
+def get_options(turn_id):
+    """
+    获取后台生成的选项（流式回复中收到 options_pending 时使用）
+
+    wait 参数为最多等待秒数，上限为 poll_wait（等待期间占用请求线程）；
+    仍在生成时返回 pending，由前端稍后重试
+    """
+    max_wait = float(config_service.get_option_config().get("poll_wait", 0.5))
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0.0), max_wait)
+    except ValueError:
+        wait = 0.0
+    status, options = option_service.result(turn_id, wait=wait)
+    if status == "unknown":
+        return jsonify({'success': False, 'error': '选项不存在或已过期'}), 404
+    return jsonify({'success': True, 'status': status, 'options': options})
+
+@bp.route('/api/recall/prefetch', methods=['POST'])
+def recall_prefetch():
+    """输入框草稿预取：在后台预先完成记忆召回与角色详情检索，发送时复用"""
+    try:
+        draft = (request.json or {}).get('draft', '')
+        # 预取按会话区分；尚无会话时在此创建（响应中下发 cookie），发送消息时沿用同一会话
+        session = session_manager.current()
+        character_id = chat_service.current_character_id()
+        status = prefetch_service.submit(session.session_id, character_id, draft)
+        return jsonify({'success': True, 'status': status}), 202
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @bp.route('/api/background', methods=['POST'])
 def generate_background():
     try:
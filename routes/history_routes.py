@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+历史记录：分页读取与全文检索
+"""
+import re
+from pathlib import Path
+from flask import Blueprint, request, jsonify
+import sys
+
+project_root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(project_root))
+
+from services.config_service import config_service
+need_config = not config_service.initialize()
+if not need_config:
+    from services.chat_service import chat_service
+
+bp = Blueprint('history', __name__, url_prefix='')
+
+
+@bp.route('/api/history', methods=['GET'])
+def get_history_page():
+    """
+    分页读取历史记录：/api/history?character=..&before=..&limit=..
+
+    before 为全局消息序号（不含），省略时从最新一条开始；
+    返回结果中的 start 可作为下一页的 before 继续向前翻
+    """
+    if need_config:
+        return jsonify({'success': False, 'error': '请先完成配置'}), 503
+    try:
+        character_id = request.args.get('character') or chat_service.current_character_id()
+        # 角色ID会拼进文件路径，只允许字母数字、下划线与连字符
+        if not re.fullmatch(r'[\w\-]+', character_id):
+            return jsonify({'success': False, 'error': f"无效的角色ID: {character_id}"}), 400
+        before = request.args.get('before', type=int)
+        max_limit = int(config_service.get_app_config().get("history_page_limit", 100))
+        limit = max(1, min(request.args.get('limit', 20, type=int), max_limit))
+        page = chat_service.history_manager.read_page(character_id, before=before, limit=limit)
+        return jsonify({'success': True, 'character': character_id, **page})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@bp.route('/api/history/search', methods=['GET'])
+def search_history():
+    """
+    全文检索历史记录：/api/history/search?character=..&q=..&limit=..&role=..
+
+    返回按相关度排序的命中消息，含片段、全局序号及其在分段日志中的位置
+    """
+    if need_config:
+        return jsonify({'success': False, 'error': '请先完成配置'}), 503
+    try:
+        character_id = request.args.get('character') or chat_service.current_character_id()
+        if not re.fullmatch(r'[\w\-]+', character_id):
+            return jsonify({'success': False, 'error': f"无效的角色ID: {character_id}"}), 400
+        query = (request.args.get('q') or '').strip()
+        if not query:
+            return jsonify({'success': False, 'error': '检索内容不能为空'}), 400
+        role = request.args.get('role') or None
+        if role not in (None, 'user', 'assistant'):
+            return jsonify({'success': False, 'error': f"无效的消息角色: {role}"}), 400
+        max_limit = int(config_service.get_app_config().get("history_page_limit", 100))
+        limit = max(1, min(request.args.get('limit', 20, type=int), max_limit))
+        result = chat_service.history_manager.search(character_id, query, limit=limit, role=role)
+        return jsonify({'success': True, 'character': character_id, 'query': query, **result})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
@@ -23,6 +23,21 @@ def serve_character_image(filename):
 
 # 已移除 /api/tts 端点
 
+@bp.route('/api/server/status', methods=['GET'])
+def server_status():
+    """服务器运行状态：进行中的请求与流、工作线程数、任务队列深度、会话数、上游调用排队情况、提示词构成"""
+    from utils.server_utils import server_monitor
+    status = server_monitor.status()
+    if not need_config:
+        from services.session_service import session_manager
+        from utils.llm_governor import llm_governor
+        from services.prompt_service import prompt_service
+        status['sessions'] = session_manager.stats()
+        status['upstream'] = llm_governor.stats()
+        status['prompt'] = prompt_service.stats()
+    return jsonify({'success': True, **status})
+
+
 @bp.route('/settings')
 def settings():
     """设置页面"""
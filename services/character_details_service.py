@@ -18,6 +18,8 @@ sys.path.append(str(Path(__file__).resolve().parent.parent))
 from utils.memory_utils import ChatHistoryVectorDB
 from services.config_service import config_service
 from config import get_RAG_config
+from utils.deadline_utils import Deadline
+from utils.llm_governor import llm_governor
 
 class CharacterDetailsService:
     """角色详细信息服务类"""
@@ -102,9 +104,10 @@ class CharacterDetailsService:
                         self.logger.warning(f"文件没有有效内容: {file_path}")
                         continue
                     
-                    # 添加到向量数据库
-                    for segment in segments:
-                        details_db.add_text(segment)
+                    # 添加到向量数据库（批量建库的嵌入请求优先级最低，不挤占对话）
+                    with llm_governor.priority("bulk"):
+                        for segment in segments:
+                            details_db.add_text(segment)
                     
                     self.logger.info(f"处理文件 {file_path}: 添加了 {len(segments)} 个段落")
                     
@@ -122,7 +125,8 @@ class CharacterDetailsService:
             traceback.print_exc()
             return False
     
-    async def search_character_details_async(self, character_id: str, query: str, top_k: int = 3, timeout: int = 10) -> str:
+    async def search_character_details_async(self, character_id: str, query: str, top_k: int = 3, timeout: int = 10,
+                                             deadline: Deadline = None) -> str:
         """
         异步搜索角色详细信息
         
@@ -131,29 +135,33 @@ class CharacterDetailsService:
             query: 查询文本
             top_k: 返回的最相似结果数量
             timeout: 超时时间（秒）
+            deadline: 可选的协作式截止时间，优先于timeout
             
         返回:
             格式化的角色详细信息提示词
         """
         loop = asyncio.get_event_loop()
+        deadline = Deadline.coerce(deadline, timeout)
         
-        # 在线程池中执行同步搜索
-        with ThreadPoolExecutor(max_workers=1) as executor:
-            future = executor.submit(self.search_character_details, character_id, query, top_k, timeout)
-            try:
-                result = await asyncio.wait_for(
-                    loop.run_in_executor(None, lambda: future.result()), 
-                    timeout=timeout
-                )
-                return result
-            except asyncio.TimeoutError:
-                self.logger.warning(f"角色详细信息检索超时 ({timeout}秒): {character_id}")
-                return ""
-            except Exception as e:
-                self.logger.error(f"异步角色详细信息检索失败: {e}")
-                return ""
+        # 在默认线程池中执行同步搜索；工作线程按截止时间自行结束，超时后不会继续占用线程
+        try:
+            result = await asyncio.wait_for(
+                loop.run_in_executor(
+                    None, lambda: self.search_character_details(character_id, query, top_k, timeout, deadline=deadline)
+                ),
+                timeout=deadline.remaining()
+            )
+            return result
+        except asyncio.TimeoutError:
+            deadline.cancel()
+            self.logger.warning(f"角色详细信息检索超时 ({timeout}秒): {character_id}")
+            return ""
+        except Exception as e:
+            self.logger.error(f"异步角色详细信息检索失败: {e}")
+            return ""
     
-    def search_character_details(self, character_id: str, query: str, top_k: int = 3, timeout: int = 10) -> str:
+    def search_character_details(self, character_id: str, query: str, top_k: int = 3, timeout: int = 10,
+                                 deadline: Deadline = None) -> str:
         """
         搜索角色详细信息并返回格式化的提示词
         
@@ -162,6 +170,7 @@ class CharacterDetailsService:
             query: 查询文本
             top_k: 返回的最相似结果数量
             timeout: 超时时间（秒）
+            deadline: 可选的协作式截止时间，优先于timeout
             
         返回:
             格式化的角色详细信息提示词
@@ -181,7 +190,7 @@ class CharacterDetailsService:
             self.logger.info(f"开始角色详细信息检索: 角色={character_id}, 查询='{query}', top_k={top_k}")
             
             # 搜索相关内容
-            results = details_db.search(query, top_k, timeout)
+            results = details_db.search(query, top_k, timeout, deadline=deadline)
             
             if not results:
                 self.logger.info(f"角色详细信息检索完成: 未找到相关内容")
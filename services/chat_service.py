@@ -7,49 +7,142 @@ import json
 import time
 import re
 import os
-from typing import List, Dict, Any, Optional, Iterator, Union, Tuple
+import threading
+from typing import List, Dict, Any, Optional, Iterator, AsyncIterator, Union, Tuple
 from pathlib import Path
 
 # 添加项目根目录到系统路径
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
 from utils.api_utils import make_api_request, APIError, handle_api_error, parse_stream_data
-from utils.history_utils import HistoryManager
+from utils.history_utils import create_history_manager
 from utils.prompt_logger import prompt_logger
+from utils.token_utils import count_tokens
 from services.config_service import config_service
-from config import get_memory_config
+from services.session_service import session_manager, ChatSession, LOCAL_SESSION_ID
+from services.prompt_service import prompt_service
+from utils.llm_governor import llm_governor
+from config import get_memory_config, get_governor_config
 # 注意：为了避免循环导入，memory_service将在ChatService类中导入
 
 class Message:
-    """消息类"""
-    def __init__(self, role: str, content: str):
+    """
+    消息类
+
+    assistant 消息按结构化字段保存（content、mood、note、tool_request），
+    持久化时写出规范化的 JSON 信封，发送给模型时只渲染 content（以及最新的 note）
+    """
+    def __init__(self, role: str, content: str, mood: Any = None, note: Optional[str] = None,
+                 tool_request: Optional[Dict[str, Any]] = None):
         """
         初始化消息
         
         Args:
             role: 消息角色（"system", "user", "assistant"）
-            content: 消息内容
+            content: 消息内容（assistant 消息为回复正文）
+            mood: 表情序号（仅assistant）
+            note: 角色记录的印象与目标（仅assistant）
+            tool_request: 工具调用请求（仅assistant）
         """
         self.role = role
         self.content = content
+        self.mood = mood
+        self.note = note
+        self.tool_request = tool_request
+        # 是否来自模型的 JSON 回复（渲染时保持 JSON 格式）
+        self.structured = role == "assistant" and (mood is not None or note is not None or tool_request is not None)
+        self._tokens = None
+        self._note_tokens = None
+    
+    @classmethod
+    def from_response(cls, raw: str) -> 'Message':
+        """
+        从模型的原始 JSON 回复创建 assistant 消息（无法解析时整段作为正文）
+
+        Args:
+            raw: 原始回复
+
+        Returns:
+            消息对象
+        """
+        try:
+            data = json.loads(raw)
+        except (TypeError, ValueError):
+            data = None
+        if not isinstance(data, dict) or not isinstance(data.get("content"), str):
+            return cls("assistant", raw)
+        note = data.get("note")
+        tool_request = data.get("tool_request")
+        message = cls(
+            "assistant",
+            data["content"],
+            mood=data.get("mood"),
+            note=note if isinstance(note, str) and note else None,
+            tool_request=tool_request if isinstance(tool_request, dict) and tool_request else None
+        )
+        message.structured = True
+        return message
+    
+    @property
+    def tokens(self) -> int:
+        """发送给模型时的 token 数（不带 note，含每条消息的格式开销，首次访问时计算并缓存）"""
+        if self._tokens is None:
+            self._tokens = 4 + count_tokens(self.role) + count_tokens(self.render() or "")
+        return self._tokens
+    
+    @property
+    def note_tokens(self) -> int:
+        """作为最近一条带 note 的回复发送时，note 额外占用的 token 数"""
+        if self._note_tokens is None:
+            self._note_tokens = 0
+            if self.structured and self.note:
+                self._note_tokens = max(0, count_tokens(self.render(include_note=True)) - count_tokens(self.render()))
+        return self._note_tokens
+    
+    def render(self, include_note: bool = False) -> str:
+        """
+        渲染发送给模型的内容：assistant 消息只保留 content（可选带上 note），
+        仍为 JSON 对象以保持模型的输出格式
+
+        Args:
+            include_note: 是否带上 note
+
+        Returns:
+            消息内容
+        """
+        if not self.structured:
+            return self.content
+        data = {"content": self.content}
+        if include_note and self.note:
+            data["note"] = self.note
+        return json.dumps(data, ensure_ascii=False)
+    
+    def to_record(self) -> str:
+        """持久化内容：assistant 消息为规范化的 JSON 信封（保留全部结构化字段），其余为原文"""
+        if not self.structured:
+            return self.content
+        data = {"mood": self.mood, "content": self.content, "note": self.note, "tool_request": self.tool_request}
+        return json.dumps({k: v for k, v in data.items() if v is not None}, ensure_ascii=False)
     
-    def to_dict(self) -> Dict[str, str]:
-        """转换为字典格式"""
+    def to_dict(self, include_note: bool = False) -> Dict[str, str]:
+        """转换为发送给模型的字典格式"""
         return {
             "role": self.role,
-            "content": self.content
+            "content": self.render(include_note)
         }
     
     @classmethod
     def from_dict(cls, data: Dict[str, str]) -> 'Message':
-        """从字典创建消息"""
+        """从字典（持久化记录）创建消息"""
+        if data["role"] == "assistant":
+            return cls.from_response(data["content"])
         return cls(data["role"], data["content"])
 
 
 
 
 import logging
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from tenacity import retry, stop_after_attempt, wait_exponential
 
 class ChatService:
@@ -57,9 +150,12 @@ class ChatService:
     
     def __init__(self):
         """初始化对话服务"""
-        self.history: List[Message] = []
         self.config_service = config_service
+        self.session_manager = session_manager
         self.logger = logging.getLogger(__name__)
+        # 系统提示词消息按 (角色ID, 提示词类型) 缓存，各会话共享同一个只读对象
+        self._system_messages: Dict[Tuple[str, str], Message] = {}
+        self._system_lock = threading.Lock()
         
         
         # 确保配置服务已初始化
@@ -69,13 +165,13 @@ class ChatService:
         # 创建历史记录管理器
         app_config = self.config_service.get_app_config()
         history_dir = app_config["history_dir"]
-        self.history_manager = HistoryManager(history_dir)
+        self.history_manager = create_history_manager(history_dir)
         
         # 导入记忆服务（避免循环导入）
         from services.memory_service import memory_service
         self.memory_service = memory_service
         
-        # 初始化时加载历史记录
+        # 初始化时加载历史记录到本地会话
         self._load_history_on_startup()
         
         # 初始化当前角色的记忆数据库
@@ -98,13 +194,23 @@ class ChatService:
                 self.logger.warning("未设置CHAT_API_BASE_URL，将使用默认API地址")
                 base_url = "https://api.openai.com/v1"
             
-            # 初始化客户端（带重试和超时配置）
+            # 初始化客户端（带重试和超时配置；429 由 llm_governor 统一退避，客户端只做少量重试）
+            max_retries = int(get_governor_config().get("client_max_retries", 1))
             self.client = OpenAI(
                 api_key=api_key,
                 base_url=base_url,
                 timeout=60.0,  # 60秒超时
-                max_retries=3  # 最多重试3次
+                max_retries=max_retries
+            )
+            # 异步客户端供 asgi.py 的异步流式接口使用
+            self.async_client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=60.0,
+                max_retries=max_retries
             )
+            # 上游准入控制的服务商标识
+            self.llm_provider = llm_governor.provider_key(base_url, api_key)
             self.chat_model = model
             
         except ImportError:
@@ -114,6 +220,120 @@ class ChatService:
             self.openai_answer = False
             self.logger.error(f"OpenAI客户端初始化失败: {e}")
     
+    @property
+    def history(self) -> List[Message]:
+        """当前会话的上下文历史（每个会话独立，见 services/session_service.py）"""
+        return self.get_session().history
+
+    @history.setter
+    def history(self, messages: List[Message]) -> None:
+        self.get_session().history = messages
+
+    def get_session(self) -> ChatSession:
+        """
+        获取当前会话，首次使用时设置角色、系统提示词并加载该角色的持久化历史
+
+        Returns:
+            会话对象
+        """
+        session = self.session_manager.current()
+        if not session.initialized:
+            with session.lock:
+                if not session.initialized:
+                    # 新会话使用最近一次选择的角色
+                    character_id = session.character_id or self.config_service.current_character_id or "default"
+                    session.character_id = character_id
+                    try:
+                        session.history = [self._get_system_message(character_id, "character")]
+                    except Exception as e:
+                        self.logger.error(f"会话系统提示词设置失败: {e}")
+                        session.history = []
+                    session.history.extend(self._load_recent_messages(character_id))
+                    session.initialized = True
+        return session
+
+    def current_character_id(self) -> str:
+        """
+        获取当前会话的角色ID
+
+        Returns:
+            角色ID
+        """
+        # 只读取角色时不创建会话（页面请求没有会话时使用最近一次选择的角色）
+        session = self.session_manager.peek()
+        character_id = session.character_id if session is not None else None
+        return character_id or self.config_service.current_character_id or "default"
+
+    def _get_system_message(self, character_id: str, prompt_type: str) -> Message:
+        """
+        获取共享的系统提示词消息（按角色和提示词类型缓存）
+
+        Args:
+            character_id: 角色ID
+            prompt_type: 提示词类型
+
+        Returns:
+            系统提示词消息，调用方不得修改
+        """
+        key = (character_id, prompt_type)
+        with self._system_lock:
+            message = self._system_messages.get(key)
+        if message is None:
+            system_prompt = prompt_service.system_prompt(character_id, prompt_type)
+            message = Message("system", system_prompt)
+            with self._system_lock:
+                message = self._system_messages.setdefault(key, message)
+        return message
+
+    def _load_recent_messages(self, character_id: str) -> List[Message]:
+        """
+        从持久化历史加载角色最近的对话消息（不含system消息）
+
+        Args:
+            character_id: 角色ID
+
+        Returns:
+            消息列表
+        """
+        max_history = self.config_service.get_app_config()["max_history_length"]
+        history_messages = self.history_manager.load_history(character_id, max_history, max_history * 2)
+        messages = [Message.from_dict(msg) for msg in history_messages if msg["role"] != "system"]
+        return self._apply_context_window(messages)
+
+    def _apply_context_window(self, messages: List[Message]) -> List[Message]:
+        """
+        按 token 预算裁剪上下文：保留开头的系统提示词，从最早的对话轮次开始整轮丢弃，
+        至少保留最后一轮（被丢弃的对话仍在长期记忆中，可通过记忆检索召回）
+
+        Args:
+            messages: 会话消息
+
+        Returns:
+            裁剪后的消息列表（未超出预算时原样返回）
+        """
+        budget = int(self.config_service.get_app_config().get("context_token_budget", 3000))
+        head = messages[:1] if messages and messages[0].role == "system" else []
+        body = messages[len(head):]
+        # format_messages 会给最近一条带 note 的回复带上 note，预算按实际发送的内容计算
+        latest_note = next((i for i in range(len(body) - 1, -1, -1) if body[i].note), None)
+        note_tokens = body[latest_note].note_tokens if latest_note is not None else 0
+        total = sum(msg.tokens for msg in body) + note_tokens
+        if total <= budget:
+            return messages
+        start = 0
+        while total > budget:
+            # 下一轮的起点（下一条用户消息）
+            next_turn = next((i for i in range(start + 1, len(body)) if body[i].role == "user"), None)
+            if next_turn is None:
+                break
+            total -= sum(msg.tokens for msg in body[start:next_turn])
+            if latest_note is not None and start <= latest_note < next_turn:
+                total -= note_tokens
+            start = next_turn
+        if start:
+            self.logger.info(f"上下文超出预算({budget} tokens)，丢弃最早的 {start} 条消息，保留 {total} tokens")
+        return head + body[start:]
+
     def add_message(self, role: str, content: str) -> Message:
         """
         添加消息到历史记录
@@ -125,27 +345,18 @@ class ChatService:
         Returns:
             添加的消息对象
         """
-        message = Message(role, content)
-        self.history.append(message)
-        
-        # 限制历史记录长度
-        max_history = self.config_service.get_app_config()["max_history_length"]
-        if len(self.history) > max_history:
-            # 保留system消息
-            system_messages = [msg for msg in self.history if msg.role == "system"]
-            other_messages = [msg for msg in self.history if msg.role != "system"]
+        message = Message.from_response(content) if role == "assistant" else Message(role, content)
+        session = self.get_session()
+        with session.lock:
+            session.history.append(message)
             
-            # 保留最新的消息
-            other_messages = other_messages[-(max_history - len(system_messages)):]
-            
-            # 重建历史记录
-            self.history = system_messages + other_messages
+            # 按 token 预算限制上下文（工具结果等长消息与普通对话按实际长度计算）
+            session.history = self._apply_context_window(session.history)
         
         # 如果不是系统消息，保存到持久化历史记录
         if role != "system":
-            # 普通模式：保存到角色目录
-            character_id = self.config_service.current_character_id or "default"
-            self.history_manager.save_message(character_id, role, content)
+            # 普通模式：保存到会话当前角色的目录
+            self.history_manager.save_message(session.character_id or "default", role, message.to_record())
         
         return message
     
@@ -164,7 +375,7 @@ class ChatService:
         if clear_persistent and not confirm:
             raise ValueError("清空持久化历史记录需要确认操作")
         
-        character_id = self.config_service.current_character_id or "default"
+        character_id = self.current_character_id()
         self.logger.info(f"正在清空历史记录 - 角色: {character_id}, 保留系统消息: {keep_system}, 清空持久化: {clear_persistent}")
         
         if keep_system:
@@ -183,8 +394,10 @@ class ChatService:
         return self.history.copy()
     
     def format_messages(self) -> List[Dict[str, str]]:
-        """格式化消息以适应API要求"""
-        return [msg.to_dict() for msg in self.history]
+        """格式化消息以适应API要求（assistant 消息只发送正文，note 只随最近一条带 note 的回复发送）"""
+        history = self.history
+        latest_note = next((i for i in range(len(history) - 1, -1, -1) if history[i].note), None)
+        return [msg.to_dict(include_note=(i == latest_note)) for i, msg in enumerate(history)]
     
     def set_system_prompt(self, prompt_type: str = "default") -> None:
         """
@@ -193,28 +406,22 @@ class ChatService:
         Args:
             prompt_type: 提示词类型，如果为"character"则使用当前角色的提示词
         """
-        # 移除现有的system消息
-        self.history = [msg for msg in self.history if msg.role != "system"]
-        
-        # 统一由config_service拼接系统提示词
-        system_prompt = self.config_service.get_system_prompt(prompt_type)
-        self.add_message("system", system_prompt)
-        self.logger.info(f"系统提示词已设置: {system_prompt[:50]}...")
+        session = self.get_session()
+        # 统一由config_service拼接系统提示词；同一角色的提示词消息在会话间共享
+        message = self._get_system_message(session.character_id or "default", prompt_type)
+        with session.lock:
+            # 移除现有的system消息
+            session.history = [message] + [msg for msg in session.history if msg.role != "system"]
+        self.logger.info(f"系统提示词已设置: {message.content[:50]}...")
     
     def _load_history_on_startup(self):
-        """在启动时加载历史记录到内存"""
-        # 普通模式：从角色目录加载
+        """在启动时加载历史记录到内存（本地会话）"""
+        # 普通模式：从角色目录加载；系统消息会通过set_system_prompt单独设置
         character_id = self.config_service.current_character_id or "default"
-
-        app_config = self.config_service.get_app_config()
-        max_history = app_config["max_history_length"]
-
-        history_messages = self.history_manager.load_history(character_id, max_history, max_history * 2)
-
-        # 转换为Message对象并添加到内存中
-        for msg in history_messages:
-            if msg["role"] != "system":  # 系统消息会通过set_system_prompt单独设置
-                self.history.append(Message.from_dict(msg))
+        session = self.session_manager.get(LOCAL_SESSION_ID)
+        session.character_id = character_id
+        session.history = self._load_recent_messages(character_id)
+        session.initialized = True
     
     def _initialize_character_memory(self):
         """初始化当前角色的记忆数据库"""
@@ -232,26 +439,25 @@ class ChatService:
         Returns:
             是否设置成功
         """
-        # 设置角色
+        # 设置角色（全局当前角色记录最近一次选择，用于新会话与后台服务）
         if self.config_service.set_character(character_id):
-            # 清空当前会话历史
-            self.history = []
+            session = self.get_session()
             
-            # 设置系统提示词
-            self.set_system_prompt("character")
+            # 重新选择角色时刷新该角色的共享系统提示词
+            with self._system_lock:
+                for key in [k for k in self._system_messages if k[0] == character_id]:
+                    del self._system_messages[key]
+            prompt_service.invalidate(character_id)
             
             # 初始化该角色的记忆数据库
             self.memory_service.set_current_character(character_id)
             
-            # 加载该角色的历史记录
-            app_config = self.config_service.get_app_config()
-            max_history = app_config["max_history_length"]
-            history_messages = self.history_manager.load_history(character_id, max_history, max_history * 2)
-            
-            # 转换为Message对象并添加到内存中
-            for msg in history_messages:
-                if msg["role"] != "system":  # 系统消息已通过set_system_prompt设置
-                    self.history.append(Message.from_dict(msg))
+            # 清空当前会话历史，设置系统提示词并加载该角色的历史记录
+            history = [self._get_system_message(character_id, "character")]
+            history.extend(self._load_recent_messages(character_id))
+            with session.lock:
+                session.character_id = character_id
+                session.history = history
                     
             return True
         
@@ -265,7 +471,7 @@ class ChatService:
         Returns:
             角色配置字典
         """
-        return self.config_service.get_character_config()
+        return self.config_service.get_character_config(self.current_character_id())
         
     def load_persistent_history(self, count: Optional[int] = None) -> List[Message]:
         """
@@ -276,12 +482,67 @@ class ChatService:
         Returns:
             历史记录列表（Message对象）
         """
-        character_id = self.config_service.current_character_id or "default"
+        character_id = self.current_character_id()
         if count is None:
             count = self.config_service.get_app_config()["max_history_length"]
         raw_msgs = self.history_manager.load_history(character_id, count)
         return [Message.from_dict(msg) for msg in raw_msgs]
     
+    def _get_mcp_module(self):
+        """懒加载 MCP 工具模块，不可用时返回None"""
+        try:
+            from plugins import mcps
+            return mcps
+        except Exception as e:
+            self.logger.error(f"加载MCP工具模块失败: {e}")
+            return None
+
+    def build_memory_context(self, user_query: str) -> str:
+        """
+        检索与用户消息相关的记忆和角色详细信息，拼接为注入提示的上下文
+
+        若输入框预取的草稿与该消息相同或足够相似，直接复用预取结果
+
+        Args:
+            user_query: 用户消息
+
+        Returns:
+            上下文文本，无相关内容时为空字符串
+        """
+        memory_context = ""
+        details_context = ""
+        try:
+            from config import get_memory_config as _get_mem_cfg
+            from utils.deadline_utils import Deadline
+            from services.prefetch_service import prefetch_service
+            character_id = self.current_character_id()
+
+            warmed = prefetch_service.take(self.get_session().session_id, character_id, user_query)
+            if warmed is not None:
+                memory_context, details_context = warmed
+            else:
+                mem_cfg = _get_mem_cfg()
+                token_budget = int(mem_cfg.get("token_budget", 512))
+                # 记忆与角色详情共享一个截止时间，保证检索总耗时有上限
+                deadline = Deadline(int(mem_cfg.get("timeout", 10)))
+                memory_context = self.memory_service.recall(
+                    query=user_query,
+                    character_name=character_id,
+                    token_budget=token_budget,
+                    deadline=deadline,
+                )
+                from services.character_details_service import character_details_service
+                details_context = character_details_service.search_character_details(
+                    character_id=character_id,
+                    query=user_query,
+                    top_k=3,
+                    deadline=deadline
+                )
+        except Exception as e:
+            self.logger.error(f"记忆和详细信息检索失败: {e}")
+
+        return "\n\n".join(part for part in (memory_context, details_context) if part)
+
     def chat_completion(
         self, 
         messages: Optional[List[Dict[str, str]]] = None, 
@@ -300,7 +561,7 @@ class ChatService:
             on_token: 可选，流式生成时每个token的回调
             mcp_enabled: 是否启用MCP工具
         Returns:
-            迭代器，每次yield一个字符串token
+            迭代器，每次yield一个字符串token；模型思考期间yield None（供调用方检查客户端是否断开）
         Raises:
             APIError: 当API调用失败时
         """
@@ -322,128 +583,19 @@ class ChatService:
             # 确保系统提示词中包含角色设定（统一由config_service处理）
             has_system_message = any(msg.get("role") == "system" for msg in messages)
             if not has_system_message:
-                system_prompt = self.config_service.get_system_prompt("default")
+                system_prompt = self._get_system_message(self.current_character_id(), "default").content
                 messages.insert(0, {"role": "system", "content": system_prompt})
 
-        # 如果开启 MCP，在系统提示后面追加一条工具使用说明
-        if mcp_enabled:
-            try:
-                from plugins import mcps
-                tools_desc = mcps.list_tools_for_prompt()
-                # 构建更严格、清晰的工具与输出规范提示
-                lines = [
-                    "[MCP 工具使用说明]",
-                    "你拥有一组可调用的 MCP 工具。在需要时，你可以在你的 JSON 输出中加入 `tool_request` 字段来请求调用工具。",
-                    "",
-                    "[JSON 输出规范] 必须始终且仅返回一个 JSON 对象（不得使用任何代码块标记），字段：",
-                    "- mood: int，必填。当前表情，且必须是其中之一，值为序号，**只写序号**：<[MOODS]>",
-                    "- content: string，必填。请遵守系统提示中对中文标点与禁用换行/markdown/中文括号的要求。",
-                    "- tool_request: object，可选，仅当需要调用工具时包含，结构：",
-                    "    { name: string, args: object, reason: string }",
-                    "示例：",
-                    '{"mood": 2, "content": "我将先读取目标文件以确认内容。", "tool_request": {"name": "read_file", "args": {"file_path": "path/to/file.py", "start_line": 1, "end_line": 60}, "reason": "需要查看文件开头定义"}}',
-                    "",
-                    "[调用流程]",
-                    "- 你可以多次调用工具。每次需要调用时先输出带有 `tool_request` 的单一 JSON 对象；",
-                    "- 等待系统消息返回工具结果（将以 system 消息形式注入会话）；",
-                    "- 根据系统消息中的结果继续思考并再次输出新的单一 JSON（可再次包含新的 `tool_request`），直到完成。",
-                    "- 若无需工具，仍需输出完整的 JSON（至少包含 mood 与 content）。",
-                    "",
-                    "[重要提醒]",
-                    "- 当工具执行成功后，系统会明确告知你\"工具已成功执行\"",
-                    "- 此时你应该分析返回的结果数据，继续对话或完成任务",
-                    "- 不要重复请求已经成功执行的相同工具，除非确实需要新的操作",
-                    "- 只有在需要新的工具操作时才再次使用 `tool_request` 字段",
-                    "",
-                    "[工具列表]"
-                ]
-                for name, meta in tools_desc.items():
-                    args_desc = ", ".join(f"{k}:{v}" for k, v in meta.get("args", {}).items())
-                    lines.append(f"- {name}: {meta.get('desc','')} 参数: {args_desc}")
-                    ex = meta.get("example")
-                    if isinstance(ex, dict):
-                        try:
-                            import json as _json
-                            lines.append("  示例调用：" + _json.dumps(ex, ensure_ascii=False))
-                        except Exception:
-                            pass
-                lines.append("请仅在必要时调用工具，并在 reason 中简要说明原因。工具返回结果会作为 system 消息插入到会话中，请根据结果继续完成任务。")
-                lines.append("")
-                lines.append("[重要提醒] 当工具执行成功后，系统会返回结果作为 system 消息。此时你应该：")
-                lines.append("- 分析工具返回的结果数据")
-                lines.append("- 基于结果继续对话或完成任务")
-                lines.append("- 不要重复请求已经执行成功的相同工具")
-                lines.append("- 只有在需要新的工具操作时才再次使用 tool_request")
-                mcp_tool_prompt = "\n".join(lines)
-                # 在第一条 system 之后追加一条新的 system 说明，避免破坏原角色提示词
-                # 如果没有 system，则插入开头
-                inserted = False
-                for idx, msg in enumerate(messages):
-                    if msg.get("role") == "system":
-                        messages.insert(idx + 1, {"role": "system", "content": mcp_tool_prompt})
-                        inserted = True
-                        break
-                if not inserted:
-                    messages.insert(0, {"role": "system", "content": mcp_tool_prompt})
-            except Exception as e:
-                self.logger.error(f"注入MCP工具说明失败: {e}")
-        
         # 如果有用户查询，进行记忆和角色详细信息检索（使用新 recall 接口）
-        memory_context = ""
-        details_context = ""
-        if user_query:
-            try:
-                from config import get_memory_config as _get_mem_cfg
-                token_budget = int(_get_mem_cfg().get("token_budget", 512))
-
-                # 普通模式：使用新 recall + 角色详情
-                character_id = self.config_service.current_character_id or "default"
-                memory_context = self.memory_service.recall(
-                    query=user_query,
-                    character_name=character_id,
-                    token_budget=token_budget,
-                )
-                from services.character_details_service import character_details_service
-                details_context = character_details_service.search_character_details(
-                    character_id=character_id,
-                    query=user_query,
-                    top_k=3
-                )
-
-                # 构建完整的上下文
-                full_context = ""
-                if memory_context:
-                    full_context += memory_context
-                if details_context:
-                    if full_context:
-                        full_context += "\n\n" + details_context
-                    else:
-                        full_context = details_context
-
-                # 如果有相关上下文，添加到最后一条用户消息中
-                if full_context and messages:
-                    # 找到最后一条用户消息
-                    for i in range(len(messages) - 1, -1, -1):
-                        if messages[i]["role"] == "user":
-                            original_content = messages[i]["content"]
-                            messages[i]["content"] = full_context + "\n以下是用户说的话：\n" + original_content
-                            break
-
-            except Exception as e:
-                self.logger.error(f"记忆和详细信息检索失败: {e}")
-                memory_context = ""
-                details_context = ""
-        
-        # 记录完整提示词到日志
-        try:
-            character_id = self.config_service.current_character_id or "default"
-            prompt_logger.log_prompt(
-                messages=messages,
-                character_name=character_id,
-                user_query=user_query
-            )
-        except Exception as e:
-            self.logger.error(f"记录提示词日志失败: {e}")
+        full_context = self.build_memory_context(user_query) if user_query else ""
+        # 开启 MCP 时在系统提示后追加工具使用说明；记忆上下文附加到最后一条用户消息（复制该条消息，避免改动调用方的列表）
+        messages = prompt_service.build_messages(
+            messages,
+            mcp_enabled=True if mcp_enabled else None,
+            mcp_mod=self._get_mcp_module() if mcp_enabled else None,
+            context=full_context
+        )
+        self.log_request(messages, user_query)
         
         try:
             # 发送API请求
@@ -466,31 +618,48 @@ class ChatService:
                         del chat_config[key]
                 
                 def stream_generator():
-                    stream_ans = self.client.chat.completions.create(
-                        model=self.chat_model,
-                        messages=messages,
-                        stream=True,
-                        response_format={"type": "json_object"},
-                        **chat_config
-                    )
-                    ifreasoning = False
-                    for chunk in stream_ans:
-                        data = chunk.choices[0].delta
-                        x = data.content
-                        if data.content is None:
-                            if ifreasoning is False:
-                                print('思考中...')
-                                ifreasoning = True
-                                # yield '思考中...\n'
-                            x = data.reasoning_content
+                    # 流式请求在整个流读完（或提前关闭）前一直占用一个并发名额
+                    permit = llm_governor.acquire(self.llm_provider, "chat")
+                    try:
+                        stream_ans = self.client.chat.completions.create(
+                            model=self.chat_model,
+                            messages=messages,
+                            stream=True,
+                            response_format={"type": "json_object"},
+                            **chat_config
+                        )
+                    except Exception as e:
+                        llm_governor.check_rate_limited(self.llm_provider, e)
+                        permit.release()
+                        raise
+                    try:
+                        ifreasoning = False
+                        for chunk in stream_ans:
+                            data = chunk.choices[0].delta
+                            x = data.content
+                            if data.content is None:
+                                if ifreasoning is False:
+                                    print('思考中...')
+                                    ifreasoning = True
+                                    # yield '思考中...\n'
+                                x = data.reasoning_content
+                                print(x, end="", flush=True)
+                                # 思考过程不输出内容，产出 None 让调用方有机会检查客户端是否已断开
+                                yield None
+                                continue
+                            else:
+                                if ifreasoning is True:
+                                    print('\n回答中...')
+                                    ifreasoning = False
                             print(x, end="", flush=True)
-                            continue
-                        else:
-                            if ifreasoning is True:
-                                print('\n回答中...')
-                                ifreasoning = False
-                        print(x, end="", flush=True)
-                        yield x
+                            yield x
+                    except Exception as e:
+                        llm_governor.check_rate_limited(self.llm_provider, e)
+                        raise
+                    finally:
+                        # 提前结束（工具调用、客户端断开）时关闭上游连接并归还名额
+                        stream_ans.close()
+                        permit.release()
                 # def stream_generator__():
                 #     response.encoding = "utf-8"
                     
@@ -532,22 +701,80 @@ class ChatService:
             error_info = handle_api_error(e)
             raise APIError(error_info["error"], e.status_code, error_info)
 
-    async def chat_completion_async(self, messages: Optional[List[Dict[str, str]]] = None, 
-                                user_query: str = None) -> Iterator[str]:
+    def log_request(self, messages: List[Dict[str, str]], user_query: str = None) -> None:
         """
-        异步对话API调用（预留接口）
-        
+        统计提示词构成并把完整提示词写入日志（涉及文件写入与分词，异步接口须在线程池中调用）
+
         Args:
-            messages: 消息列表
+            messages: 发送给模型的消息列表
             user_query: 用户查询
+        """
+        prompt_service.report(messages)
+
+        # 记录完整提示词到日志
+        try:
+            prompt_logger.log_prompt(
+                messages=messages,
+                character_name=self.current_character_id(),
+                user_query=user_query
+            )
+        except Exception as e:
+            self.logger.error(f"记录提示词日志失败: {e}")
+
+    async def chat_completion_async(self, messages: Optional[List[Dict[str, str]]] = None) -> AsyncIterator[str]:
+        """
+        异步流式对话API调用（AsyncOpenAI），供 asgi.py 的异步流式接口使用；
+        等待模型输出期间只占用协程，不占用线程。记忆检索与提示词日志（log_request）
+        由调用方在线程池中完成
+        
+        Args:
+            messages: 消息列表，如果为None则使用历史记录
             
         Returns:
-            Iterator[str]: 流式响应
-            
-        Note:
-            此为预留接口，将在未来实现异步支持
+            AsyncIterator[Optional[str]]: 每次yield一个字符串token；思考期间yield None
         """
-        raise NotImplementedError("异步支持将在未来版本实现")
+        if not self.openai_answer:
+            raise APIError("OpenAI客户端未初始化")
+        if messages is None:
+            messages = self.format_messages()
+
+        chat_config = self.config_service.get_chat_config()
+        for key in ('model', 'stream', 'top_k'):
+            chat_config.pop(key, None)
+
+        # 协程内排队等待准入，不占用线程；排队中被取消时限流器自行移除等待项
+        permit = await llm_governor.acquire_async(self.llm_provider, "chat")
+        try:
+            stream_ans = await self.async_client.chat.completions.create(
+                model=self.chat_model,
+                messages=messages,
+                stream=True,
+                response_format={"type": "json_object"},
+                **chat_config
+            )
+        except BaseException as e:
+            # 包括建立连接期间客户端断开导致的 CancelledError
+            if isinstance(e, Exception):
+                llm_governor.check_rate_limited(self.llm_provider, e)
+            permit.release()
+            raise
+        try:
+            async for chunk in stream_ans:
+                if not chunk.choices:
+                    continue
+                # 思考过程（reasoning_content）不推送给前端
+                content = chunk.choices[0].delta.content
+                # 思考期间产出 None，调用方借此检查客户端是否已断开
+                yield content
+        except Exception as e:
+            llm_governor.check_rate_limited(self.llm_provider, e)
+            raise
+        finally:
+            # 提前结束（工具调用、客户端断开）时关闭上游连接并归还名额；关闭被取消也要归还
+            try:
+                await stream_ans.close()
+            finally:
+                permit.release()
 
 # 创建全局对话服务实例
 chat_service = ChatService()
@@ -569,7 +796,8 @@ if __name__ == "__main__":
         # 调用API（流式）
         logging.info("发送API请求...")
         for token in chat_service.chat_completion(stream=True):
-            print(token, end="", flush=True)
+            if token is not None:
+                print(token, end="", flush=True)
         
         # 打印对话历史
         logging.info("\n对话历史:")
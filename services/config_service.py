@@ -104,12 +104,13 @@ class ConfigService:
             raise RuntimeError("配置未加载")
         return config.get_image_config()
     
-    def get_system_prompt(self, prompt_type="default"):
+    def get_system_prompt(self, prompt_type="default", character_id: Optional[str] = None):
         """
         获取系统提示词
         
         Args:
             prompt_type: 提示词类型，如果为"character"则使用当前角色的提示词和通用提示词
+            character_id: 角色ID，为None时使用当前角色；指定时不会改变当前角色
             
         Returns:
             系统提示词
@@ -118,7 +119,10 @@ class ConfigService:
             raise RuntimeError("配置未加载")
         
         if prompt_type == "character":
-            character_config = self.get_character_config()
+            if character_id is None:
+                character_config = self.get_character_config()
+            else:
+                character_config = characters.get_character_config(character_id)
             general_prompt = config.get_system_prompt("default")
             
             # 获取角色的心情列表并动态拼接
@@ -133,8 +137,9 @@ class ConfigService:
         
         # 对于非角色类型的提示词，也需要处理心情拼接
         prompt = config.get_system_prompt(prompt_type)
-        if self.current_character_id:
-            moods = self._get_character_moods(self.current_character_id)
+        character_id = character_id or self.current_character_id
+        if character_id:
+            moods = self._get_character_moods(character_id)
             if moods:
                 mood_str = " ".join([f"{i+1}.{mood}" for i, mood in enumerate(moods)])
                 prompt = prompt.replace("<[MOODS]>", mood_str)
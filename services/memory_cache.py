@@ -0,0 +1,126 @@
+"""
+召回结果缓存模块
+按角色缓存 MemoryService.recall 的结果，写入时通过角色代数（generation）失效
+"""
+import re
+import time
+import threading
+import unicodedata
+from collections import OrderedDict, defaultdict
+from typing import Dict, Optional, Tuple
+
+# 近似键中忽略的语气词，"你喜欢猫吗" 与 "你喜欢猫呢" 视为同一问题
+_FILLER_CHARS = set("吗呢吧啊呀嘛哦哈了的么")
+
+
+def normalize_query(query: str) -> str:
+    """规范化查询：全半角统一、小写、去除标点符号与空白"""
+    text = unicodedata.normalize("NFKC", query or "").lower()
+    text = "".join(ch for ch in text if not unicodedata.category(ch).startswith(("P", "S")))
+    return re.sub(r"\s+", "", text)
+
+
+def near_duplicate_key(normalized: str) -> str:
+    """廉价的近似重复键：按原顺序去掉语气词（只忽略语气词差异，"我喜欢你" 与 "你喜欢我" 不同键）"""
+    return "".join(ch for ch in normalized if ch not in _FILLER_CHARS)
+
+
+class RecallCache:
+    """
+    角色维度的召回缓存
+
+    - 精确键：规范化后的查询；近似键：去掉语气词的查询，用于命中只差语气词的重发问题
+    - TTL 到期或角色代数变化（有新记忆写入）即失效
+    - LRU 淘汰，线程安全
+    """
+
+    def __init__(self, ttl: float = 30.0, max_entries: int = 256):
+        """
+        初始化缓存
+
+        Args:
+            ttl: 条目存活时间（秒）
+            max_entries: 最大条目数
+        """
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self._lock = threading.Lock()
+        self._generations: Dict[str, int] = defaultdict(int)
+        # (character, budget, exact_key) -> (generation, expires_at, value)
+        self._entries: "OrderedDict[Tuple[str, int, str], Tuple[int, float, str]]" = OrderedDict()
+        # (character, budget, near_key) -> exact_key
+        self._near: Dict[Tuple[str, int, str], str] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, character: str) -> int:
+        """获取角色当前代数；计算结果前先取代数，写回时据此丢弃过期结果"""
+        with self._lock:
+            return self._generations[character]
+
+    def bump(self, character: str) -> None:
+        """角色记忆有写入：代数加一，该角色所有缓存条目随之失效"""
+        with self._lock:
+            self._generations[character] += 1
+            stale = [k for k in self._entries if k[0] == character]
+            for k in stale:
+                del self._entries[k]
+            for k in [k for k in self._near if k[0] == character]:
+                del self._near[k]
+
+    def get(self, character: str, query: str, budget: int = 0) -> Optional[str]:
+        """
+        查询缓存
+
+        Returns:
+            命中时返回缓存的召回文本，否则None
+        """
+        exact = normalize_query(query)
+        if not exact:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            key = (character, budget, exact)
+            entry = self._entries.get(key)
+            if entry is None:
+                near = self._near.get((character, budget, near_duplicate_key(exact)))
+                if near is not None:
+                    key = (character, budget, near)
+                    entry = self._entries.get(key)
+            if entry is not None:
+                generation, expires_at, value = entry
+                if generation == self._generations[character] and expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def put(self, character: str, query: str, value: str, generation: int, budget: int = 0) -> None:
+        """
+        写入缓存；若计算期间角色代数已变化（有新写入），结果作废不缓存
+
+        Args:
+            generation: 开始计算前通过 generation() 取得的代数
+        """
+        exact = normalize_query(query)
+        if not exact:
+            return
+        with self._lock:
+            if generation != self._generations[character]:
+                return
+            key = (character, budget, exact)
+            self._entries[key] = (generation, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            self._near[(character, budget, near_duplicate_key(exact))] = exact
+            while len(self._entries) > self.max_entries:
+                old_key, _ = self._entries.popitem(last=False)
+                near_key = (old_key[0], old_key[1], near_duplicate_key(old_key[2]))
+                if self._near.get(near_key) == old_key[2]:
+                    del self._near[near_key]
+
+    def stats(self) -> Dict[str, int]:
+        """命中统计"""
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
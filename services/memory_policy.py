@@ -3,7 +3,9 @@ Memory policies: importance scoring, simple event extraction, and summarization.
 Lightweight and rule-based for MVP.
 """
 from __future__ import annotations
+import math
 import re
+from datetime import datetime
 from typing import Dict, Optional
 
 IMPORTANT_PATTERNS = [
@@ -26,6 +28,39 @@ class MemoryPolicy:
     def should_persist(self, text: str) -> bool:
         return self.importance(text) >= self.threshold
 
+    def retention_score(self, meta: Dict, text: str = "", now: Optional[datetime] = None) -> float:
+        """Value of keeping a vector memory when the per-character cap is hit.
+
+        Combines importance, recency (exponential decay of the latest
+        ts/last_seen/last_hit), retrieval hits and repeat count. Pinned
+        entries are never evicted.
+        """
+        if meta.get("pinned"):
+            return math.inf
+        importance = meta.get("importance")
+        if importance is None:
+            importance = self.importance(text) if text else 0.0
+
+        now = now or datetime.now()
+        latest = None
+        for key in ("last_hit", "last_seen", "ts"):
+            try:
+                ts = datetime.fromisoformat(meta[key])
+            except (KeyError, TypeError, ValueError):
+                continue
+            latest = ts if latest is None or ts > latest else latest
+        half_life = float(self.cfg.get("recency_half_life_days", 30)) * 86400
+        if latest is None or half_life <= 0:
+            recency = 0.0
+        else:
+            age = max((now - latest).total_seconds(), 0.0)
+            recency = 0.5 ** (age / half_life)
+
+        # log-scaled so a handful of hits matters but popular entries do not dominate
+        hits = min(math.log1p(int(meta.get("hits", 0))) / math.log1p(20), 1.0)
+        repeats = min(math.log1p(int(meta.get("ref_count", 1)) - 1) / math.log1p(10), 1.0)
+        return 0.4 * float(importance) + 0.3 * recency + 0.2 * hits + 0.1 * repeats
+
     def summarize(self, user: str, assistant: str) -> str:
         # ultra-light summary: keep salient sentences up to ~2
         def pick_sentences(s: str, n: int = 2):
@@ -1,11 +1,15 @@
 """
 MemoryRouter: multi-source recall and prompt assembly.
 MVP: combine short-term buffer, summaries, profile, and vector search results.
+Sources are packed into the token budget by priority and score, whole items only.
 """
 from __future__ import annotations
+import logging
 from typing import Dict, Optional, Tuple, List
 
 from config import get_memory_config
+from utils.deadline_utils import Deadline
+from utils.token_utils import count_tokens, pack_by_budget
 from utils.memory import (
     ShortTermBufferStore,
     SummaryStore,
@@ -13,62 +17,105 @@ from utils.memory import (
     VectorStoreAdapter,
 )
 
+logger = logging.getLogger("MemoryRouter")
+
+HEADER = "[相关记忆] 以下信息用于帮助你更一致地回复，请结合使用，不要重复："
+
+# section -> (heading, packing priority); lower priority is packed first.
+# Rendering keeps the original section order regardless of priority.
+SECTIONS = {
+    "profile": (None, 0),
+    "summary": ("[对话摘要]", 2),
+    "buffer": ("[最近对话片段]", 3),
+    "vector": ("[历史语义记忆]", 1),
+}
+SECTION_ORDER = ["profile", "summary", "buffer", "vector"]
+
 
 class MemoryRouter:
-    def __init__(self, scope_id: str, root_dir: str = "data/memory"):
+    def __init__(self, scope_id: str, root_dir: str = "data/memory", vector_db=None):
         self.scope_id = scope_id
         self.root_dir = root_dir
         self.cfg = get_memory_config()
         self.buffer = ShortTermBufferStore(root_dir, scope_id)
         self.summaries = SummaryStore(root_dir, scope_id)
         self.profile = ProfileStore(root_dir, scope_id)
-        self.vector = VectorStoreAdapter(scope_id)
+        self.vector = VectorStoreAdapter(scope_id, db=vector_db)
+        # token accounting of the latest recall, for cost monitoring
+        self.last_report: Dict[str, int] = {}
 
-    def _assemble(self, parts: List[str], token_budget: int) -> str:
-        if not parts:
+    def _assemble(self, items: List[Dict], token_budget: int) -> str:
+        """Pack candidate items into the budget and render them by section."""
+        if not items:
             return ""
-        # approx char budget for zh: ~2 chars per token
-        char_budget = int(token_budget * 2)
-        text = "\n\n".join([p for p in parts if p])
-        if len(text) <= char_budget:
-            return text
-        # truncate safely
-        return text[:char_budget]
-
-    def recall(self, query: str, token_budget: Optional[int] = None) -> str:
-        cfg = self.cfg
-        if token_budget is None:
-            token_budget = int(cfg.get("token_budget", 512))
-        top_k = int(cfg.get("top_k", 5))
-        timeout = int(cfg.get("timeout", 10))
+        # section headings are paid once, only for sections that make it in
+        heading_cost = {sec: count_tokens(h) + 1 for sec, (h, _) in SECTIONS.items() if h}
+        chosen = pack_by_budget(items, token_budget - count_tokens(HEADER), group_costs=heading_cost)
+
+        blocks = []
+        for sec in SECTION_ORDER:
+            lines = [it["text"] for it in chosen if it["group"] == sec]
+            if not lines:
+                continue
+            heading = SECTIONS[sec][0]
+            blocks.append("\n".join(([heading] if heading else []) + lines))
+        text = "\n\n".join([HEADER] + blocks) if blocks else ""
+
+        candidate_tokens = count_tokens(HEADER) + sum(it["tokens"] for it in items) + sum(
+            heading_cost.get(sec, 0) for sec in {it["group"] for it in items})
+        packed_tokens = count_tokens(text)
+        self.last_report = {
+            "budget": token_budget,
+            "candidate_items": len(items),
+            "packed_items": len(chosen),
+            "candidate_tokens": candidate_tokens,
+            "packed_tokens": packed_tokens,
+            "saved_tokens": max(candidate_tokens - packed_tokens, 0),
+        }
+        logger.info(
+            f"记忆注入[{self.scope_id}]: {len(chosen)}/{len(items)} 条, "
+            f"{packed_tokens}/{token_budget} tokens, 节省 {self.last_report['saved_tokens']} tokens"
+        )
+        return text
 
-        parts: List[str] = []
+    def _collect(self, query: str, top_k: int, timeout: int, deadline: Deadline) -> List[Dict]:
+        """Gather candidate items from every source."""
+        items: List[Dict] = []
+
+        def add(section: str, text: str, score: float):
+            if text:
+                items.append({"group": section, "text": text, "priority": SECTIONS[section][1], "score": score})
 
         # profile
-        prof = self.profile.to_prompt()
-        if prof:
-            parts.append(prof)
+        add("profile", self.profile.to_prompt(), 1.0)
 
-        # summaries (latest few)
-        summs = self.summaries.top(k=min(3, top_k))
-        if summs:
-            parts.append("[对话摘要]\n" + "\n".join(f"- {s}" for s in summs))
+        # summaries relevant to the query, pinned first, best scores highest
+        summs = self.summaries.top(query, k=min(3, top_k))
+        for rank, s in enumerate(summs):
+            add("summary", f"- {s}", 1.0 / (rank + 1))
 
-        # short-term buffer (recent turns)
+        # short-term buffer (recent turns, kept in chronological order)
         recent = self.buffer.get_recent(n=min(4, top_k))
-        if recent:
-            buf_lines = []
-            for t in recent:
-                buf_lines.append(f"用户：{t.user}")
-                buf_lines.append(f"助手：{t.assistant}")
-            parts.append("[最近对话片段]\n" + "\n".join(buf_lines))
-
-        # vector recall
-        vec = self.vector.search(query=query, top_k=top_k, timeout=timeout)
-        if vec:
-            parts.append("[历史语义记忆]\n" + vec)
-
-        if not parts:
+        for i, t in enumerate(recent):
+            add("buffer", f"用户：{t.user}\n助手：{t.assistant}", 1.0 / (len(recent) - i))
+
+        # vector recall, already ordered by rerank score
+        hits = self.vector.search_items(query=query, top_k=top_k, timeout=timeout, deadline=deadline)
+        for rank, text in enumerate(hits):
+            add("vector", text, 1.0 / (rank + 1))
+        return items
+
+    def recall(self, query: str, token_budget: Optional[int] = None, deadline: Optional[Deadline] = None) -> str:
+        cfg = self.cfg
+        if token_budget is None:
+            token_budget = int(cfg.get("token_budget", 512))
+        top_k = int(cfg.get("top_k", 5))
+        timeout = int(cfg.get("timeout", 10))
+        # one deadline for the whole recall; the vector step only gets what is left
+        deadline = Deadline.coerce(deadline, timeout)
+
+        items = self._collect(query, top_k, timeout, deadline)
+        if not items:
+            self.last_report = {}
             return ""
-        header = "[相关记忆] 以下信息用于帮助你更一致地回复，请结合使用，不要重复："
-        return self._assemble([header] + parts, token_budget=token_budget)
+        return self._assemble(items, token_budget=token_budget)
@@ -6,9 +6,11 @@ import os
 import sys
 import logging
 import asyncio
-from typing import Dict, Optional, Tuple
+from typing import Callable, Dict, Iterable, Optional, Tuple, Union
 from pathlib import Path
+import threading
 import traceback
+from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
 # 添加项目根目录到系统路径
 sys.path.append(str(Path(__file__).resolve().parent.parent))
@@ -16,9 +18,12 @@ sys.path.append(str(Path(__file__).resolve().parent.parent))
 from utils.memory_utils import ChatHistoryVectorDB
 from services.memory_router import MemoryRouter
 from services.memory_policy import MemoryPolicy
+from services.memory_cache import RecallCache
 from services.config_service import config_service
 from services.character_details_service import character_details_service
 from config import get_memory_config,  get_RAG_config
+from utils.deadline_utils import Deadline
+from utils.llm_governor import llm_governor
 
 class MemoryService:
     """记忆服务类"""
@@ -28,7 +33,18 @@ class MemoryService:
         self.memory_databases: Dict[str, ChatHistoryVectorDB] = {}
         # 仅角色维度：多路召回路由器与策略
         self.routers: Dict[str, MemoryRouter] = {}
-        self.policy = MemoryPolicy(get_memory_config())
+        memory_config = get_memory_config()
+        self.policy = MemoryPolicy(memory_config)
+        # 召回缓存：按角色代数失效，写入记忆时调用 recall_cache.bump
+        self.recall_cache = RecallCache(
+            ttl=memory_config.get("recall_cache_ttl", 30),
+            max_entries=memory_config.get("recall_cache_size", 256)
+        )
+
+        # 后台压缩：删除比例超过阈值时重写索引，单线程且每个角色同时只排队一次
+        self._compact_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-compact")
+        self._compact_pending = set()
+        self._compact_lock = threading.Lock()
 
         self.current_character = None
         self.logger = logging.getLogger("MemoryService")
@@ -60,7 +76,11 @@ class MemoryService:
                 self.logger.info(f"初始化角色记忆数据库: {character_name}")
             # 初始化路由器（角色维度）
             if character_name not in self.routers:
-                self.routers[character_name] = MemoryRouter(scope_id=character_name)
+                # 与记忆数据库共用同一实例，写入与删除对召回立即可见
+                self.routers[character_name] = MemoryRouter(
+                    scope_id=character_name,
+                    vector_db=self.memory_databases[character_name]
+                )
             
             self.current_character = character_name
             return True
@@ -81,7 +101,8 @@ class MemoryService:
             return self.memory_databases[self.current_character]
         return None
     
-    def search_memory(self, query: str, character_name: str = None, top_k: int = None, timeout: int = None) -> str:
+    def search_memory(self, query: str, character_name: str = None, top_k: int = None, timeout: int = None,
+                      deadline: Deadline = None) -> str:
         """
         搜索记忆并返回格式化的提示词
         
@@ -90,6 +111,7 @@ class MemoryService:
             character_name: 角色名称，如果为None则使用当前角色
             top_k: 返回的最相似结果数量，如果为None则使用配置中的值
             timeout: 超时时间（秒），如果为None则使用配置中的值
+            deadline: 可选的协作式截止时间，优先于timeout
             
         返回:
             格式化的记忆提示词
@@ -116,7 +138,7 @@ class MemoryService:
             return ""
         
         memory_db = self.memory_databases[character_name]
-        result = memory_db.get_relevant_memory(query, top_k, timeout)
+        result = memory_db.get_relevant_memory(query, top_k, timeout, deadline=deadline)
         
         if result:
             self.logger.info(f"记忆搜索完成: 生成了 {len(result)} 字符的记忆上下文")
@@ -157,19 +179,21 @@ class MemoryService:
         
         self.logger.info(f"开始异步记忆和详细信息检索: 角色={character_name}, 查询='{query}'")
         
+        # 两路检索共享同一个截止时间，工作线程内按剩余时间逐步检查
+        deadline = Deadline(timeout)
+        
         # 创建异步任务
         loop = asyncio.get_event_loop()
         
         # 记忆检索任务
         memory_task = loop.run_in_executor(
             None, 
-            self.search_memory, 
-            query, character_name, memory_top_k, timeout
+            lambda: self.search_memory(query, character_name, memory_top_k, timeout, deadline=deadline)
         )
         
         # 角色详细信息检索任务
         details_task = character_details_service.search_character_details_async(
-            character_name, query, details_top_k, timeout
+            character_name, query, details_top_k, timeout, deadline=deadline
         )
         
         try:
@@ -252,20 +276,29 @@ class MemoryService:
         if not self.initialize_character_memory(character_name):
             return
         
-        memory_db = self.memory_databases[character_name]
-        memory_db.add_chat_turn(user_message, assistant_message)
-        # 写入短期缓冲与摘要（MVP）
-        try:
-            router = self.routers.get(character_name)
-            if router:
-                router.buffer.add_turn(user_message, assistant_message)
-                # 重要则生成摘要
-                if self.policy.should_persist(user_message + "\n" + assistant_message):
-                    summary = self.policy.summarize(user_message, assistant_message)
-                    if summary:
-                        router.summaries.add_summary(summary, meta={"source": "auto", "type": "chat"})
-        except Exception:
-            pass
+        # 写入记忆时的嵌入请求按 ingest 优先级排队，让位于对话中的召回
+        with llm_governor.priority("ingest"):
+            memory_db = self.memory_databases[character_name]
+            memory_db.add_chat_turn(
+                user_message,
+                assistant_message,
+                importance=self.policy.importance(user_message + "\n" + assistant_message)
+            )
+            self._enforce_capacity(character_name)
+            # 写入短期缓冲与摘要（MVP）
+            try:
+                router = self.routers.get(character_name)
+                if router:
+                    router.buffer.add_turn(user_message, assistant_message)
+                    # 重要则生成摘要
+                    if self.policy.should_persist(user_message + "\n" + assistant_message):
+                        summary = self.policy.summarize(user_message, assistant_message)
+                        if summary:
+                            router.summaries.add_summary(summary, meta={"source": "auto", "type": "chat"})
+            except Exception:
+                pass
+        # 写入完成后再失效缓存，避免并发召回把旧结果写回
+        self.recall_cache.bump(character_name)
         
         # 保存到文件
         try:
@@ -337,11 +370,12 @@ class MemoryService:
                     summary = self.policy.summarize(user_message, assistant_message)
                     if summary:
                         router.summaries.add_summary(summary, meta={"source": "record_event", "type": "chat"})
+                self.recall_cache.bump(character_name)
         except Exception:
             pass
 
-    def recall(self, query: str, character_name: str = None, token_budget: int = None) -> str:
-        """多路召回统一入口（仅角色维度）。"""
+    def recall(self, query: str, character_name: str = None, token_budget: int = None, deadline: Deadline = None) -> str:
+        """多路召回统一入口（仅角色维度）。deadline 为整个召回的协作式截止时间。"""
         try:
             if character_name is None:
                 character_name = self.current_character
@@ -352,7 +386,17 @@ class MemoryService:
             router = self.routers.get(character_name)
             if not router:
                 return ""
-            return router.recall(query, token_budget=token_budget)
+            budget = int(token_budget or 0)
+            cached = self.recall_cache.get(character_name, query, budget)
+            if cached is not None:
+                self.logger.info(f"召回缓存命中: 角色={character_name}, 查询='{query}'")
+                return cached
+            generation = self.recall_cache.generation(character_name)
+            result = router.recall(query, token_budget=token_budget, deadline=deadline)
+            if not (deadline is not None and deadline.expired()):
+                # 超时得到的可能是不完整结果，不缓存
+                self.recall_cache.put(character_name, query, result, generation, budget)
+            return result
         except Exception:
             return ""
 
@@ -371,22 +415,190 @@ class MemoryService:
                 summary = self.policy.summarize(last.user, last.assistant)
                 if summary:
                     router.summaries.add_summary(summary, meta={"source": "buffer_threshold"})
+                    self.recall_cache.bump(character_name)
         except Exception:
             pass
 
-    def pin_memory(self, text: str, character_name: str = None):
-        """将条目加入摘要库作为置顶（角色维度）。"""
+    def pin_memory(self, text: str, character_name: str = None, ids: Iterable[int] = None) -> int:
+        """
+        将条目加入摘要库作为置顶（角色维度），并把对应的向量记忆标记为置顶（容量淘汰时保留）
+
+        参数:
+            text: 置顶内容；未给出 ids 时，包含该文本的向量记忆都会被标记
+            character_name: 角色名称，如果为None则使用当前角色
+            ids: 要置顶的向量文档id
+
+        返回:
+            标记为置顶的向量记忆数量
+        """
+        pinned = 0
         try:
             if character_name is None:
                 character_name = self.current_character
             if character_name and character_name in self.routers:
                 self.routers[character_name].summaries.add_summary(text, meta={"pinned": True})
-        except Exception:
-            pass
+                memory_db = self.memory_databases.get(character_name)
+                if memory_db is not None:
+                    if ids is not None:
+                        targets = [int(i) for i in ids]
+                    else:
+                        targets = memory_db.find_documents(predicate=lambda _id, doc, _meta: bool(text) and text in doc)
+                    pinned = memory_db.pin_documents(targets)
+                    if pinned:
+                        memory_db.save_to_file()
+                self.recall_cache.bump(character_name)
+        except Exception as e:
+            self.logger.error(f"置顶记忆失败 {character_name}: {e}")
+        return pinned
 
-    def forget_memory(self, character_name: str = None):
-        """占位：未来实现更细粒度的删除。目前不执行操作（角色维度）。"""
-        return
+    def forget_memory(self, character_name: str = None, ids: Iterable[int] = None,
+                      since: Union[str, datetime] = None, until: Union[str, datetime] = None,
+                      predicate: Callable[[int, str, dict], bool] = None) -> int:
+        """
+        删除角色的向量记忆（按文档id、写入时间范围或自定义条件，条件之间取交集）
+
+        删除立即对召回生效；删除比例超过 compact_dead_ratio 时在后台压缩索引
+
+        参数:
+            character_name: 角色名称，如果为None则使用当前角色
+            ids: 文档id列表
+            since: 写入时间下限（datetime 或 ISO 字符串）
+            until: 写入时间上限（datetime 或 ISO 字符串）
+            predicate: 自定义条件，参数为 (文档id, 文本, 元数据)，返回True表示删除
+
+        返回:
+            删除的记忆数量；未给出任何条件时不删除
+        """
+        if character_name is None:
+            character_name = self.current_character
+        if not character_name or (ids is None and since is None and until is None and predicate is None):
+            return 0
+        if not self.initialize_character_memory(character_name):
+            return 0
+        try:
+            memory_db = self.memory_databases[character_name]
+            if isinstance(since, str):
+                since = datetime.fromisoformat(since)
+            if isinstance(until, str):
+                until = datetime.fromisoformat(until)
+            targets = memory_db.find_documents(since=since, until=until, predicate=predicate)
+            if ids is not None:
+                wanted = {int(i) for i in ids}
+                targets = [doc_id for doc_id in targets if doc_id in wanted]
+            deleted = memory_db.delete_documents(targets)
+            if deleted:
+                self.recall_cache.bump(character_name)
+                memory_db.save_to_file()
+                self._schedule_compaction(character_name)
+            return deleted
+        except Exception as e:
+            self.logger.error(f"删除记忆失败 {character_name}: {e}")
+            traceback.print_exc()
+            return 0
+
+    def _enforce_capacity(self, character_name: str) -> int:
+        """
+        容量上限检查：超过 max_documents / max_bytes 时淘汰价值最低的向量记忆
+
+        带滞回：一旦超限，淘汰到上限的 evict_low_watermark 比例以下，避免每轮都触发。
+        evict_to_summary 开启时，被淘汰的对话压缩成摘要写入摘要库而非直接丢弃。
+
+        参数:
+            character_name: 角色名称
+
+        返回:
+            淘汰的记忆数量
+        """
+        cfg = get_memory_config()
+        max_documents = int(cfg.get("max_documents", 0) or 0)
+        max_bytes = int(cfg.get("max_bytes", 0) or 0)
+        if max_documents <= 0 and max_bytes <= 0:
+            return 0
+        memory_db = self.memory_databases.get(character_name)
+        if memory_db is None:
+            return 0
+        count, size = memory_db.footprint()
+        if (max_documents <= 0 or count <= max_documents) and (max_bytes <= 0 or size <= max_bytes):
+            return 0
+
+        try:
+            watermark = float(cfg.get("evict_low_watermark", 0.9))
+            target_count = int(max_documents * watermark) if max_documents > 0 else count
+            target_bytes = int(max_bytes * watermark) if max_bytes > 0 else size
+
+            id_to_doc = memory_db.rag.retriever.id_to_doc
+            now = datetime.now()
+            scored = []
+            for doc_id in memory_db.find_documents():
+                meta = memory_db.doc_meta.get(doc_id, {})
+                text = id_to_doc.get(doc_id, "")
+                scored.append((self.policy.retention_score(meta, text, now), doc_id, text))
+            scored.sort(key=lambda x: (x[0], x[1]))  # 价值相同时先淘汰更旧的
+
+            victims = []
+            for score, doc_id, text in scored:
+                if count <= target_count and size <= target_bytes:
+                    break
+                if score == float("inf"):  # 置顶记忆不淘汰
+                    break
+                victims.append((doc_id, text))
+                count -= 1
+                size -= memory_db.document_bytes(text)
+            if not victims:
+                return 0
+
+            if cfg.get("evict_to_summary", True):
+                self._fold_into_summaries(character_name, victims)
+            evicted = memory_db.delete_documents([doc_id for doc_id, _ in victims])
+            self.logger.info(f"角色 {character_name} 记忆超出容量，淘汰 {evicted} 条")
+            self._schedule_compaction(character_name, force=True)
+            return evicted
+        except Exception as e:
+            self.logger.error(f"记忆容量淘汰失败 {character_name}: {e}")
+            traceback.print_exc()
+            return 0
+
+    def _fold_into_summaries(self, character_name: str, victims):
+        """把被淘汰的对话压缩成摘要写入摘要库"""
+        router = self.routers.get(character_name)
+        if router is None:
+            return
+        for doc_id, text in victims:
+            user, _, assistant = text.partition("\n助手: ")
+            summary = self.policy.summarize(user.replace("用户: ", "", 1), assistant)
+            if summary:
+                router.summaries.add_summary(summary, meta={"source": "evicted"})
+
+    def _schedule_compaction(self, character_name: str, force: bool = False):
+        """删除比例超过阈值（或 force）时提交后台压缩任务（同一角色不重复排队）"""
+        memory_db = self.memory_databases.get(character_name)
+        if memory_db is None:
+            return
+        cfg = get_memory_config()
+        if not force and memory_db.dead_ratio() < float(cfg.get("compact_dead_ratio", 0.2)):
+            return
+        with self._compact_lock:
+            if character_name in self._compact_pending:
+                return
+            self._compact_pending.add(character_name)
+        self._compact_executor.submit(self._compact, character_name)
+
+    def _compact(self, character_name: str):
+        """后台压缩：新索引构建完成后整体替换，期间查询照常使用旧索引"""
+        try:
+            memory_db = self.memory_databases.get(character_name)
+            if memory_db is None:
+                return
+            reclaimed = memory_db.compact()
+            if reclaimed:
+                memory_db.save_to_file()
+                self.logger.info(f"压缩角色记忆 {character_name}: 回收 {reclaimed} 条")
+        except Exception as e:
+            self.logger.error(f"压缩角色记忆失败 {character_name}: {e}")
+            traceback.print_exc()
+        finally:
+            with self._compact_lock:
+                self._compact_pending.discard(character_name)
 
 # 创建全局记忆服务实例
 memory_service = MemoryService()
@@ -5,13 +5,19 @@
 import sys
 import json
 import os
-from typing import List, Dict, Any, Optional
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from typing import List, Dict, Any, Optional, Tuple
 from pathlib import Path
 
 # 添加项目根目录到系统路径
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
 from services.config_service import config_service
+from utils.llm_governor import llm_governor
+from config import get_governor_config
 
 class OptionService:
     """选项生成服务类"""
@@ -24,12 +30,25 @@ class OptionService:
         if not self.config_service.initialized:
             self.config_service.initialize()
         
+        # 后台选项生成任务（按 turn_id 保存，供 SSE 推送或 /api/options/<turn_id> 获取）
+        option_config = self.config_service.get_option_config()
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(option_config.get("background_workers", 2)),
+            thread_name_prefix="option-gen"
+        )
+        self._tasks: "OrderedDict[str, Tuple[float, Future]]" = OrderedDict()
+        self._tasks_lock = threading.Lock()
+        
         # 初始化 OpenAI 客户端
         try:
             from openai import OpenAI
             self.client = OpenAI(
                 api_key=os.getenv("OPTION_API_KEY"),
-                base_url=os.getenv("OPTION_API_BASE_URL")
+                base_url=os.getenv("OPTION_API_BASE_URL"),
+                max_retries=int(get_governor_config().get("client_max_retries", 1))
+            )
+            self.llm_provider = llm_governor.provider_key(
+                os.getenv("OPTION_API_BASE_URL"), os.getenv("OPTION_API_KEY")
             )
         except ImportError:
             print("未找到openai模块，请安装openai模块")
@@ -96,8 +115,9 @@ class OptionService:
             # if "o1" in model_name or "reasoning" in model_name:
             #     request_params["reasoning"] = False
             
-            # 使用 OpenAI 库调用选项生成API
-            response = self.client.chat.completions.create(**request_params)
+            # 使用 OpenAI 库调用选项生成API（选项优先级低于对话，排不上时直接放弃）
+            with llm_governor.slot(self.llm_provider, "options"):
+                response = self.client.chat.completions.create(**request_params)
             
             # 处理响应
             if response.choices and len(response.choices) > 0:
@@ -115,6 +135,66 @@ class OptionService:
             print(f"选项生成失败: {str(e)}")
             return []
     
+    def submit(
+        self,
+        turn_id: str,
+        conversation_history: List[Dict[str, str]],
+        character_config: Dict[str, Any],
+        user_query: str
+    ) -> bool:
+        """
+        在后台生成选项（与写入记忆等收尾工作并行）
+
+        Args:
+            turn_id: 本轮对话ID
+            conversation_history: 对话历史记录（调用方传入快照）
+            character_config: 角色配置
+            user_query: 用户最后的查询
+
+        Returns:
+            是否已提交（未启用选项生成时返回False）
+        """
+        option_config = self.config_service.get_option_config()
+        if not option_config.get("enable_option_generation", True) or not self.client:
+            return False
+        future = self._executor.submit(self.generate_options, conversation_history, character_config, user_query)
+        ttl = float(option_config.get("result_ttl", 300))
+        now = time.monotonic()
+        with self._tasks_lock:
+            # 淘汰过期的任务结果
+            while self._tasks:
+                created_at, _ = next(iter(self._tasks.values()))
+                if now - created_at <= ttl and len(self._tasks) < 256:
+                    break
+                self._tasks.popitem(last=False)
+            self._tasks[turn_id] = (now, future)
+        return True
+
+    def result(self, turn_id: str, wait: Optional[float] = 0) -> Tuple[str, List[str]]:
+        """
+        获取后台选项生成的结果
+
+        Args:
+            turn_id: 本轮对话ID
+            wait: 尚未完成时最多等待的秒数
+
+        Returns:
+            (状态, 选项列表)；状态为 ready（已完成）、pending（生成中）或 unknown（不存在或已过期）
+        """
+        with self._tasks_lock:
+            task = self._tasks.get(turn_id)
+        if task is None:
+            return "unknown", []
+        future = task[1]
+        try:
+            options = future.result(timeout=max(0.0, wait or 0))
+        except FutureTimeoutError:
+            return "pending", []
+        except Exception as e:
+            print(f"选项生成失败: {str(e)}")
+            options = []
+        return "ready", options or []
+
     def _build_user_prompt(
         self, 
         conversation_history: List[Dict[str, str]], 
@@ -0,0 +1,212 @@
+"""
+召回预取服务模块
+用户输入时按草稿在后台预先完成记忆召回与角色详情检索，发送时复用结果
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+from pathlib import Path
+import sys
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from config import get_memory_config
+from services.memory_cache import normalize_query
+from utils.deadline_utils import Deadline
+
+
+def _bigrams(text: str) -> set:
+    """字符二元组集合（单字文本退化为单字集合）"""
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def draft_similarity(a: str, b: str) -> float:
+    """
+    计算两段文本的相似度（规范化后字符二元组的 Jaccard 系数）
+
+    Args:
+        a: 文本A
+        b: 文本B
+
+    Returns:
+        0~1 之间的相似度
+    """
+    na, nb = normalize_query(a), normalize_query(b)
+    if not na or not nb:
+        return 0.0
+    if na == nb:
+        return 1.0
+    ga, gb = _bigrams(na), _bigrams(nb)
+    return len(ga & gb) / len(ga | gb)
+
+
+@dataclass
+class _Prefetch:
+    """单个角色当前草稿的预取任务"""
+    draft: str
+    normalized: str
+    deadline: Deadline
+    created_at: float = field(default_factory=time.monotonic)
+    future: object = None
+
+
+class PrefetchService:
+    """
+    召回预取服务
+
+    - 每个会话的每个角色只保留最新草稿的预取任务（不同会话与同一角色对话时互不影响），新草稿到达时取消旧任务（通过 Deadline 协作取消）
+    - 发送消息时 take() 取出任务：最终消息与草稿相同或足够相似则复用结果，否则丢弃
+    """
+
+    def __init__(self, max_workers: int = 2):
+        """
+        初始化预取服务
+
+        Args:
+            max_workers: 后台线程数
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="recall-prefetch")
+        self._lock = threading.Lock()
+        # (会话ID, 角色ID) -> 预取任务
+        self._slots: Dict[Tuple[Optional[str], str], _Prefetch] = {}
+        self.stats = {"scheduled": 0, "superseded": 0, "reused": 0, "discarded": 0}
+        self.logger = logging.getLogger("PrefetchService")
+
+        # 设置日志格式
+        if not self.logger.handlers:
+            handler = logging.StreamHandler()
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            handler.setFormatter(formatter)
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+
+    def submit(self, session_id: Optional[str], character_id: str, draft: str) -> str:
+        """
+        提交草稿进行预取
+
+        Args:
+            session_id: 会话ID
+            character_id: 角色ID
+            draft: 输入框中的草稿文本
+
+        Returns:
+            状态：scheduled（已调度）、unchanged（与进行中的草稿相同）、skipped（未启用或草稿过短）
+        """
+        cfg = get_memory_config()
+        normalized = normalize_query(draft)
+        if not cfg.get("prefetch_enabled", True) or len(normalized) < int(cfg.get("prefetch_min_chars", 4)):
+            return "skipped"
+
+        with self._lock:
+            current = self._slots.get((session_id, character_id))
+            if current is not None and current.normalized == normalized and not current.deadline.cancelled:
+                return "unchanged"
+            if current is not None:
+                self._cancel(current)
+                self.stats["superseded"] += 1
+            slot = _Prefetch(draft=draft, normalized=normalized, deadline=Deadline(int(cfg.get("timeout", 10))))
+            slot.future = self._executor.submit(self._warm, character_id, slot)
+            self._slots[(session_id, character_id)] = slot
+            self.stats["scheduled"] += 1
+        return "scheduled"
+
+    def take(self, session_id: Optional[str], character_id: str, query: str,
+             wait: Optional[float] = None) -> Optional[Tuple[str, str]]:
+        """
+        取出与最终消息匹配的预取结果
+
+        Args:
+            session_id: 会话ID
+            character_id: 角色ID
+            query: 最终发送的用户消息
+            wait: 预取正在执行时最多等待的秒数，None 时使用 prefetch_max_wait；
+                  仍在排队未开始的任务不等待，直接由调用方自行召回
+
+        Returns:
+            (记忆上下文, 角色详情上下文)；没有可复用的结果时返回None
+        """
+        with self._lock:
+            slot = self._slots.pop((session_id, character_id), None)
+        if slot is None:
+            return None
+
+        cfg = get_memory_config()
+        ttl = float(cfg.get("prefetch_ttl", 60))
+        threshold = float(cfg.get("prefetch_similarity", 0.8))
+        if time.monotonic() - slot.created_at > ttl or draft_similarity(slot.draft, query) < threshold:
+            self._cancel(slot)
+            self._count("discarded")
+            return None
+
+        future = slot.future
+        if not future.done() and not future.running():
+            self._cancel(slot)
+            self._count("discarded")
+            return None
+        if wait is None:
+            wait = float(cfg.get("prefetch_max_wait", 0.5))
+        remaining = slot.deadline.remaining()
+        if remaining is not None:
+            wait = min(wait, remaining)
+        try:
+            result = future.result(timeout=max(0.0, wait))
+        except FutureTimeoutError:
+            result = None
+        except Exception as e:
+            self.logger.warning(f"预取任务失败: {e}")
+            result = None
+        if result is None:
+            self._cancel(slot)
+            self._count("discarded")
+            return None
+        self._count("reused")
+        self.logger.info(f"复用预取结果: 角色={character_id}, 草稿='{slot.draft}'")
+        return result
+
+    def _warm(self, character_id: str, slot: _Prefetch) -> Optional[Tuple[str, str]]:
+        """后台执行召回与角色详情检索；被取消或超时返回None"""
+        from services.memory_service import memory_service
+        from services.character_details_service import character_details_service
+
+        deadline = slot.deadline
+        if deadline.expired():
+            return None
+        token_budget = int(get_memory_config().get("token_budget", 512))
+        memory_context = memory_service.recall(
+            query=slot.draft,
+            character_name=character_id,
+            token_budget=token_budget,
+            deadline=deadline,
+        )
+        details_context = character_details_service.search_character_details(
+            character_id=character_id,
+            query=slot.draft,
+            top_k=3,
+            deadline=deadline
+        )
+        # 截止时间已到时结果可能不完整，不予复用
+        if deadline.expired():
+            return None
+        return memory_context, details_context
+
+    def _count(self, name: str) -> None:
+        """统计计数（take 在锁外执行，计数单独加锁）"""
+        with self._lock:
+            self.stats[name] += 1
+
+    @staticmethod
+    def _cancel(slot: _Prefetch) -> None:
+        """取消预取任务：未开始的直接撤销，进行中的在下一个检查点退出"""
+        slot.deadline.cancel()
+        if slot.future is not None:
+            slot.future.cancel()
+
+
+# 创建全局预取服务实例
+prefetch_service = PrefetchService()
@@ -0,0 +1,271 @@
+"""
+提示词组装服务
+系统提示词与 MCP 工具说明预先生成并缓存，每次请求按固定顺序拼接：
+静态前缀（系统提示词 + 工具说明）→ 对话历史 → 本次请求的动态内容（记忆上下文与用户消息）。
+前缀在各轮之间逐字节不变，服务商侧的提示词缓存（prompt/KV cache）才能命中。
+"""
+import sys
+import json
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from pathlib import Path
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from services.config_service import config_service
+from utils.token_utils import count_tokens
+
+# 用户关闭 MCP 时注入的说明
+MCP_DISABLED_PROMPT = "\n".join([
+    "[MCP 工具状态通知]",
+    "当前用户已关闭MCP工具功能。即使你在输出中包含tool_request字段，系统也不会执行任何工具调用。",
+    "请勿尝试使用任何MCP工具，只需正常与用户对话即可。"
+])
+
+# 记忆上下文与用户消息之间的分隔
+CONTEXT_SEPARATOR = "\n以下是用户说的话：\n"
+
+
+def _message_tokens(message: Dict[str, str]) -> int:
+    """单条消息的 token 数（与 count_messages_tokens 相同的每条约4个 token 格式开销）"""
+    return 4 + count_tokens(message.get("role", "")) + count_tokens(message.get("content") or "")
+
+
+class PromptService:
+    """
+    提示词组装服务
+
+    - 系统提示词按 (角色ID, 提示词类型) 缓存，MOODS 等占位符只替换一次
+    - MCP 工具说明按 (是否启用, 工具集签名) 缓存；同步与异步接口共用同一份说明
+    - 每次请求统计静态前缀、历史与动态部分的 token 数，便于调整提示词结构
+    """
+
+    def __init__(self):
+        """初始化提示词服务"""
+        self._lock = threading.Lock()
+        self._system_prompts: Dict[Tuple[str, str], str] = {}
+        self._tool_prompts: Dict[Tuple[bool, str], Optional[str]] = {}
+        self._static_contents = set()
+        self._prefix_ids = set()
+        self.stats_data = {
+            "requests": 0,
+            "static_tokens": 0,
+            "history_tokens": 0,
+            "dynamic_tokens": 0,
+        }
+        self.last_report: Optional[Dict[str, Any]] = None
+        self.logger = logging.getLogger("PromptService")
+
+        # 设置日志格式
+        if not self.logger.handlers:
+            handler = logging.StreamHandler()
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            handler.setFormatter(formatter)
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+
+    def system_prompt(self, character_id: str, prompt_type: str = "character") -> str:
+        """
+        获取系统提示词（缓存）
+
+        Args:
+            character_id: 角色ID
+            prompt_type: 提示词类型
+
+        Returns:
+            系统提示词
+        """
+        key = (character_id, prompt_type)
+        with self._lock:
+            prompt = self._system_prompts.get(key)
+        if prompt is None:
+            prompt = config_service.get_system_prompt(prompt_type, character_id=character_id)
+            with self._lock:
+                prompt = self._system_prompts.setdefault(key, prompt)
+                self._static_contents.add(prompt)
+        return prompt
+
+    def invalidate(self, character_id: Optional[str] = None) -> None:
+        """
+        使缓存的提示词失效（角色设定或工具集变化后调用）
+
+        Args:
+            character_id: 角色ID，为None时清空全部缓存
+        """
+        with self._lock:
+            if character_id is None:
+                self._system_prompts.clear()
+                self._tool_prompts.clear()
+            else:
+                for key in [k for k in self._system_prompts if k[0] == character_id]:
+                    del self._system_prompts[key]
+            self._static_contents = set(self._system_prompts.values()) | {
+                p for p in self._tool_prompts.values() if p
+            }
+
+    def tool_prompt(self, mcp_enabled: bool, mcp_mod=None) -> Optional[str]:
+        """
+        获取 MCP 工具说明（缓存）
+
+        Args:
+            mcp_enabled: 用户是否启用了MCP
+            mcp_mod: MCP模块（plugins.mcps）
+
+        Returns:
+            启用时为工具使用指南，关闭时为禁用通知；启用但工具模块不可用时返回None
+        """
+        if not mcp_enabled:
+            self._remember_static(MCP_DISABLED_PROMPT)
+            return MCP_DISABLED_PROMPT
+        if not mcp_mod:
+            return None
+        try:
+            tools_desc = mcp_mod.list_tools_for_prompt()
+            signature = hashlib.sha1(
+                json.dumps(tools_desc, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+            ).hexdigest()
+        except Exception as e:
+            self.logger.error(f"获取MCP工具列表失败: {e}")
+            return None
+        key = (True, signature)
+        with self._lock:
+            if key in self._tool_prompts:
+                return self._tool_prompts[key]
+        prompt = self._build_tool_prompt(tools_desc)
+        with self._lock:
+            prompt = self._tool_prompts.setdefault(key, prompt)
+            if prompt:
+                self._static_contents.add(prompt)
+        return prompt
+
+    @staticmethod
+    def _build_tool_prompt(tools_desc: Dict[str, Any]) -> Optional[str]:
+        """生成 MCP 工具使用指南（输出字段规范见系统提示词，此处不再重复）"""
+        try:
+            lines = [
+                "[MCP 工具使用指南]",
+                "始终只输出一个合法的 JSON 对象（不要使用代码块标记），字段规范见上文。",
+                "需要调用工具时：在同一个 JSON 中加入 tool_request 字段 { name:string, args:object, reason:string }；若已对用户输出过部分内容，不要重复这些内容，仅继续后文。",
+                "系统返回工具结果后（以 system 消息注入会话）：继续输出新的单个 JSON。若仍需调用工具，可再次提供 tool_request；否则仅给出 content。允许多轮连续调用工具，直到任务完成或达到限制。",
+                "严格要求：",
+                "- 不要复述之前已经对用户输出过的文本；接着写下去。",
+                "- 保留并正确使用原始标点符号，不要删除或改写标点。",
+                "- 每轮都只输出一个 JSON 对象，不要输出多段或附加说明。",
+                "- 不要重复请求已经成功执行的相同工具，除非确实需要新的操作；仅在必要时调用工具，并在 reason 中简要说明原因。",
+                "[工具列表]",
+            ]
+            for name, meta in tools_desc.items():
+                args_desc = ", ".join(f"{k}:{v}" for k, v in (meta.get("args", {}) or {}).items())
+                lines.append(f"- {name}: {meta.get('desc', '')} 参数: {args_desc}")
+                example = meta.get("example")
+                if isinstance(example, dict):
+                    lines.append("  示例调用：" + json.dumps(example, ensure_ascii=False, sort_keys=True))
+            return "\n".join(lines)
+        except Exception:
+            return None
+
+    def _remember_static(self, content: str) -> None:
+        with self._lock:
+            self._static_contents.add(content)
+
+    def build_messages(self, history: List[Dict[str, str]], mcp_enabled: Optional[bool] = None,
+                       mcp_mod=None, context: str = "") -> List[Dict[str, str]]:
+        """
+        按固定顺序组装请求消息：系统提示词 → 工具说明 → 历史 → 附带记忆上下文的最后一条用户消息
+
+        Args:
+            history: 已格式化的会话消息（首条为系统提示词）
+            mcp_enabled: 是否启用MCP；None 表示不注入任何工具说明
+            mcp_mod: MCP模块
+            context: 本次检索到的记忆与角色详情上下文
+
+        Returns:
+            消息列表（新列表，不修改传入的消息）
+        """
+        messages = list(history)
+        if mcp_enabled is not None:
+            tool_prompt = self.tool_prompt(mcp_enabled, mcp_mod)
+            if tool_prompt:
+                head = 1 if messages and messages[0].get("role") == "system" else 0
+                messages.insert(head, {"role": "system", "content": tool_prompt})
+        # 易变内容只放在末尾：记忆上下文附加到最后一条用户消息，不改动之前的任何消息
+        if context:
+            for i in range(len(messages) - 1, -1, -1):
+                if messages[i].get("role") == "user":
+                    messages[i] = dict(messages[i])
+                    messages[i]["content"] = context + CONTEXT_SEPARATOR + messages[i]["content"]
+                    break
+        return messages
+
+    def report(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        """
+        统计一次请求的 token 构成并记录日志
+
+        静态前缀为开头连续的缓存提示词（系统提示词、工具说明）；动态部分从最后一条用户消息开始；
+        二者之间为对话历史。同一角色的 prefix_id 变化说明前缀不再相同，服务商侧缓存无法命中。
+
+        Args:
+            messages: 发送给模型的消息列表
+
+        Returns:
+            统计字典
+        """
+        with self._lock:
+            static_contents = self._static_contents
+        static_end = 0
+        while (static_end < len(messages) and messages[static_end].get("role") == "system"
+               and messages[static_end].get("content") in static_contents):
+            static_end += 1
+        dynamic_start = len(messages)
+        for i in range(len(messages) - 1, static_end - 1, -1):
+            if messages[i].get("role") == "user":
+                dynamic_start = i
+                break
+        static_tokens = sum(_message_tokens(m) for m in messages[:static_end])
+        history_tokens = sum(_message_tokens(m) for m in messages[static_end:dynamic_start])
+        dynamic_tokens = sum(_message_tokens(m) for m in messages[dynamic_start:]) + 2
+        prefix_id = hashlib.sha1(
+            "\x00".join(m.get("content") or "" for m in messages[:static_end]).encode("utf-8")
+        ).hexdigest()[:8]
+        total = static_tokens + history_tokens + dynamic_tokens
+        budget = int(config_service.get_app_config().get("context_token_budget", 3000))
+        report = {
+            "messages": len(messages),
+            "static_messages": static_end,
+            "static_tokens": static_tokens,
+            "history_tokens": history_tokens,
+            "dynamic_tokens": dynamic_tokens,
+            "total_tokens": total,
+            "history_budget": budget,
+            "prefix_id": prefix_id,
+        }
+        with self._lock:
+            self.stats_data["requests"] += 1
+            self._prefix_ids.add(prefix_id)
+            self.stats_data["static_tokens"] += static_tokens
+            self.stats_data["history_tokens"] += history_tokens
+            self.stats_data["dynamic_tokens"] += dynamic_tokens
+            self.last_report = report
+        self.logger.info(
+            f"提示词构成: 静态前缀 {static_tokens} tokens（{static_end} 条, {prefix_id}），"
+            f"历史 {history_tokens}/{budget} tokens，本次 {dynamic_tokens} tokens，实际上下文共 {total} tokens"
+        )
+        return report
+
+    def stats(self) -> Dict[str, Any]:
+        """累计统计与最近一次请求的构成"""
+        with self._lock:
+            data = dict(self.stats_data)
+            data["last"] = dict(self.last_report) if self.last_report else None
+            # 不同静态前缀的数量：应接近 角色数 × MCP开关，持续增长说明前缀不稳定
+            data["distinct_prefixes"] = len(self._prefix_ids)
+            data["cached_system_prompts"] = len(self._system_prompts)
+            data["cached_tool_prompts"] = len(self._tool_prompts)
+        return data
+
+
+# 创建全局提示词服务实例
+prompt_service = PromptService()
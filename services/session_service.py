@@ -0,0 +1,239 @@
+"""
+会话服务模块
+按会话（浏览器 cookie）隔离对话状态：每个会话有独立的上下文历史、当前角色与锁，
+会话表按最近使用（LRU）淘汰；角色设定与系统提示词等只读数据由各会话共享
+"""
+import re
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+from pathlib import Path
+import sys
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from config import get_app_config
+
+# 浏览器保存会话ID的 cookie 名；客户端也可用请求头指定会话（如每个标签页一个会话）
+SESSION_COOKIE = "cabm_session"
+SESSION_HEADER = "X-Chat-Session"
+# 非请求线程（启动、命令行、后台任务）使用的本地会话
+LOCAL_SESSION_ID = "local"
+
+_SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_\-]{8,64}$")
+
+
+class ChatSession:
+    """单个会话的对话状态"""
+
+    def __init__(self, session_id: str, character_id: Optional[str]):
+        """
+        初始化会话
+
+        Args:
+            session_id: 会话ID
+            character_id: 会话当前角色ID
+        """
+        self.session_id = session_id
+        self.character_id = character_id
+        # 上下文历史（Message 列表）；system 消息为各会话共享的同一对象
+        self.history: List[Any] = []
+        # 保护 history 等字段的短时修改
+        self.lock = threading.RLock()
+        # 串行化同一会话的对话轮次（如流式回复进行中再次发送）；
+        # 非重入，异步接口先在事件循环上等待该会话的 asyncio.Lock，再以非阻塞方式获取
+        self.turn_lock = threading.Lock()
+        self.initialized = False
+        self.created_at = time.time()
+        self.last_access = self.created_at
+
+
+class SessionManager:
+    """
+    会话表
+
+    - 请求开始时 activate() 记录本次请求的会话ID，首次用到会话时才创建（静态资源请求不会产生会话）
+    - 会话数超过 max_sessions 或空闲超过 ttl 时淘汰最久未用的会话；正在进行对话轮次（turn_lock 被持有）
+      的会话不淘汰；被淘汰的会话再次访问时从持久化历史重新加载，不会丢失对话
+    - 只读取会话信息的请求（如页面渲染）用 peek()，不会为没有 cookie 的请求创建会话
+    """
+
+    def __init__(self, max_sessions: int = 64, ttl: float = 6 * 3600):
+        """
+        初始化会话表
+
+        Args:
+            max_sessions: 最多保留的会话数
+            ttl: 会话空闲超时（秒）
+        """
+        self.max_sessions = max(1, int(max_sessions))
+        self.ttl = float(ttl)
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        # waitress 按线程处理请求，ContextVar 在每个线程内独立
+        self._active: ContextVar[bool] = ContextVar("chat_session_active", default=False)
+        self._requested: ContextVar[Optional[str]] = ContextVar("chat_session_requested", default=None)
+        self._bound: ContextVar[Optional[ChatSession]] = ContextVar("chat_session_bound", default=None)
+        self._created: ContextVar[Optional[str]] = ContextVar("chat_session_created", default=None)
+        self.evicted = 0
+        self.logger = logging.getLogger("SessionManager")
+
+        # 设置日志格式
+        if not self.logger.handlers:
+            handler = logging.StreamHandler()
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            handler.setFormatter(formatter)
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+
+    @staticmethod
+    def valid_id(session_id: Optional[str]) -> bool:
+        """会话ID是否合法（拒绝客户端伪造的异常值）"""
+        return bool(session_id) and bool(_SESSION_ID_PATTERN.match(session_id))
+
+    def activate(self, session_id: Optional[str]) -> None:
+        """
+        记录当前请求携带的会话ID（在请求开始时调用）
+
+        Args:
+            session_id: cookie 或请求头中的会话ID，没有时为None
+        """
+        self._active.set(True)
+        self._requested.set(session_id if self.valid_id(session_id) else None)
+        self._bound.set(None)
+        self._created.set(None)
+
+    def deactivate(self) -> None:
+        """请求结束时调用，之后该线程上的调用回到本地会话"""
+        self._active.set(False)
+        self._requested.set(None)
+        self._created.set(None)
+
+    def created_session_id(self) -> Optional[str]:
+        """本次请求新建的会话ID（需要写回 cookie），没有新建时为None"""
+        return self._created.get()
+
+    @contextmanager
+    def bind(self, session: ChatSession):
+        """在代码块（如流式响应的生成器）内固定使用指定会话"""
+        token = self._bound.set(session)
+        try:
+            yield session
+        finally:
+            self._bound.reset(token)
+
+    def current(self) -> ChatSession:
+        """
+        获取当前会话：显式绑定的会话 > 本次请求的会话（不存在则创建）> 本地会话
+
+        Returns:
+            会话对象
+        """
+        session = self._bound.get()
+        if session is not None:
+            self._touch(session)
+            return session
+        if not self._active.get():
+            return self.get(LOCAL_SESSION_ID)
+        session_id = self._requested.get() or self._created.get()
+        if session_id is None:
+            session_id = uuid.uuid4().hex
+            self._created.set(session_id)
+        return self.get(session_id)
+
+    def peek(self) -> Optional[ChatSession]:
+        """
+        获取当前会话但不创建（页面渲染等只读取会话信息的请求使用）
+
+        Returns:
+            会话对象；本次请求没有会话或会话已被淘汰时返回None
+        """
+        session = self._bound.get()
+        if session is not None:
+            self._touch(session)
+            return session
+        if not self._active.get():
+            return self.get(LOCAL_SESSION_ID)
+        session_id = self._requested.get() or self._created.get()
+        if session_id is None:
+            return None
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                session.last_access = time.time()
+            return session
+
+    def _touch(self, session: ChatSession) -> None:
+        """刷新绑定会话的最近使用顺序；绑定期间已被淘汰的会话放回会话表，避免同一会话出现两个对象"""
+        with self._lock:
+            current = self._sessions.get(session.session_id)
+            if current is session:
+                self._sessions.move_to_end(session.session_id)
+            elif current is None:
+                self._sessions[session.session_id] = session
+            session.last_access = time.time()
+
+    def get(self, session_id: str) -> ChatSession:
+        """
+        获取（必要时创建）会话，并更新其最近使用时间
+
+        Args:
+            session_id: 会话ID
+
+        Returns:
+            会话对象
+        """
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = ChatSession(session_id, None)
+                self._sessions[session_id] = session
+                self._evict(now)
+            else:
+                self._sessions.move_to_end(session_id)
+            session.last_access = now
+            return session
+
+    def _evict(self, now: float) -> None:
+        """淘汰超出容量或空闲超时的会话（本地会话与正在进行对话轮次的会话不淘汰）"""
+        # OrderedDict 按最近使用排序，从最旧的开始检查
+        for session_id, session in list(self._sessions.items()):
+            if session_id == LOCAL_SESSION_ID or session.turn_lock.locked():
+                continue
+            over = len(self._sessions) > self.max_sessions
+            if not over and now - session.last_access <= self.ttl:
+                break
+            del self._sessions[session_id]
+            self.evicted += 1
+            self.logger.info(f"淘汰会话: {session_id[:8]}...")
+
+    def remove(self, session_id: str) -> None:
+        """移除会话"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def sessions(self) -> List[ChatSession]:
+        """当前全部会话（按最近使用排序）"""
+        with self._lock:
+            return list(self._sessions.values())
+
+    def stats(self) -> Dict[str, int]:
+        """会话统计"""
+        with self._lock:
+            return {"sessions": len(self._sessions), "max_sessions": self.max_sessions, "evicted": self.evicted}
+
+
+_app_config = get_app_config()
+# 创建全局会话表实例
+session_manager = SessionManager(
+    max_sessions=int(_app_config.get("max_sessions", 64)),
+    ttl=float(_app_config.get("session_ttl", 6 * 3600))
+)
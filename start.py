@@ -164,11 +164,24 @@ def open_browser(host, port, delay=1.5):
     browser_thread.daemon = True
     browser_thread.start()
 
-def start_server(host, port, debug=False, open_browser_flag=True):
+def flush_writers():
+    """写出尚在防抖延迟中的记忆存储修改与历史记录缓冲"""
+    try:
+        from utils.persist_utils import get_persister
+        get_persister().flush()
+        from services.chat_service import chat_service
+        chat_service.history_manager.flush_all()
+    except Exception as e:
+        logger.error(f"写出缓冲失败: {e}")
+
+def start_server(host, port, debug=False, open_browser_flag=True, use_asgi=False):
     """启动服务器"""
     try:
-        # 导入Flask应用
-        from app import app
+        # 导入Flask应用（ASGI 模式下由 asgi.py 包装）
+        if use_asgi:
+            import asgi
+        else:
+            from app import app
         
         # 如果需要，启动浏览器（只在非重载模式下打开）
         # WERKZEUG_RUN_MAIN 环境变量在Flask重载时会被设置
@@ -201,12 +214,32 @@ def start_server(host, port, debug=False, open_browser_flag=True):
         
         logger.info("按Ctrl+C停止服务器")
         
-        app.run(
-            host=host,
-            port=port,
-            debug=debug,
-            use_reloader=debug  # 只在debug模式下启用重载器
-        )
+        if use_asgi:
+            # 流式对话走异步路径；关闭时由 ASGI lifespan 写出缓冲
+            logger.info("使用 ASGI（uvicorn）模式运行")
+            asgi.serve(host, port)
+            return True
+        
+        from config import get_server_config
+        from utils.server_utils import server_monitor
+        server_config = get_server_config()
+        if not debug and server_config.get("mode", "production") == "production":
+            # 生产模式：waitress 多线程服务器，退出时等待进行中的流结束并写出缓冲
+            server_monitor.serve(app, host, port, server_config, on_shutdown=flush_writers)
+            return True
+        
+        logger.info("使用Flask开发服务器运行")
+        app.wsgi_app = server_monitor.wrap(app.wsgi_app)
+        try:
+            app.run(
+                host=host,
+                port=port,
+                debug=debug,
+                use_reloader=debug,  # 只在debug模式下启用重载器
+                threaded=True
+            )
+        finally:
+            flush_writers()
         
         return True
     except Exception as e:
@@ -242,6 +275,7 @@ def main():
     parser.add_argument('--debug', action='store_true', help='启用调试模式')
     parser.add_argument('--no-browser', action='store_true', help='不自动打开浏览器')
     parser.add_argument('--gui', action='store_true', help='使用PySide6 GUI启动')
+    parser.add_argument('--asgi', action='store_true', help='使用ASGI（uvicorn）运行，流式对话走异步路径')
     args = parser.parse_args()
     
     logger.info("正在启动CABM应用...")
@@ -279,7 +313,7 @@ def main():
         open_browser_flag = not args.no_browser
 
     # 启动服务器
-    if not start_server(host, port, debug, open_browser_flag):
+    if not start_server(host, port, debug, open_browser_flag, use_asgi=args.asgi):
         logger.error("服务器启动失败")
         sys.exit(1)
 
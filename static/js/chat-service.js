@@ -26,6 +26,43 @@ window.mcpToolResults = window.mcpToolResults || {};
 // 流式处理器实例
 let streamProcessor = null;
 
+// 显示选项
+function showPendingOptions(options) {
+    if (window.showOptionsAsUserBubble) {
+        window.showOptionsAsUserBubble(options);
+    } else if (window.showOptionButtons) {
+        // 兼容旧逻辑
+        window.showOptionButtons(options);
+    }
+}
+
+// 选项轮询：服务端每次只短暂等待，仍在生成时间隔一段时间重试
+const OPTIONS_POLL_INTERVAL = 1000;
+const OPTIONS_POLL_ATTEMPTS = 15;
+
+// 获取后台生成的选项（流式回复中收到 options_pending 时）
+async function fetchPendingOptions(turnId) {
+    try {
+        for (let attempt = 0; attempt < OPTIONS_POLL_ATTEMPTS; attempt++) {
+            // 期间用户已发送新消息则不再获取
+            if (getIsProcessing()) return;
+            const response = await fetch(`/api/options/${encodeURIComponent(turnId)}?wait=0.5`);
+            if (!response.ok) return;
+            const data = await response.json();
+            if (!data.success) return;
+            if (data.status !== 'pending') {
+                if (Array.isArray(data.options) && data.options.length > 0 && !getIsProcessing()) {
+                    showPendingOptions(data.options);
+                }
+                return;
+            }
+            await new Promise(resolve => setTimeout(resolve, OPTIONS_POLL_INTERVAL));
+        }
+    } catch (e) {
+        console.error('获取选项失败:', e);
+    }
+}
+
 // 发送消息
 export async function sendMessage() {
     const message = messageInput.value.trim();
@@ -42,6 +79,7 @@ export async function sendMessage() {
 
     // 创建新的流式处理器
     streamProcessor = new StreamProcessor();
+    window.pendingOptionsTurn = null;
 
     // 跟踪已添加到历史记录的内容长度（与 StreamProcessor 的段落边界对齐）
     let addedToHistoryLength = 0;
@@ -90,14 +128,13 @@ export async function sendMessage() {
             enableUserInput();
             setIsPaused(false);
             if (window.pendingOptions && window.pendingOptions.length > 0) {
-                if (window.showOptionsAsUserBubble) {
-                    window.showOptionsAsUserBubble(window.pendingOptions);
-                } else if (window.showOptionButtons) {
-                    // 兼容旧逻辑
-                    window.showOptionButtons(window.pendingOptions);
-                }
+                showPendingOptions(window.pendingOptions);
                 window.pendingOptions = null;
+            } else if (window.pendingOptionsTurn) {
+                // 选项未能在流结束前生成完，改为按 turn_id 获取
+                fetchPendingOptions(window.pendingOptionsTurn);
             }
+            window.pendingOptionsTurn = null;
         }
     );
 
@@ -214,6 +251,7 @@ export async function sendMessage() {
                             if (data.mood !== undefined) handleMoodChange(data.mood);
                             if (data.content) streamProcessor.addData(data.content);
                             if (data.options) window.pendingOptions = data.options;
+                            if (data.options_pending) window.pendingOptionsTurn = data.options_pending;
                         } catch (e) {
                             console.error('解析JSON失败(EOF):', e, jsonStr);
                         }
@@ -315,6 +353,9 @@ export async function sendMessage() {
                         if (data.options) {
                             window.pendingOptions = data.options;
                         }
+                        if (data.options_pending) {
+                            window.pendingOptionsTurn = data.options_pending;
+                        }
                     } catch (e) {
                         console.error('解析JSON失败:', e, jsonStr);
                     }
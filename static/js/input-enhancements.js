@@ -8,6 +8,10 @@ class InputEnhancements {
         this.sendButton = null;
         this.charCount = null;
         this.maxLength = 2000;
+        // 草稿预取：停止输入一段时间后把草稿发给后端预先检索记忆
+        this.prefetchDelay = 400;
+        this.prefetchTimer = null;
+        this.lastPrefetchDraft = '';
         this.init();
     }
 
@@ -39,6 +43,7 @@ class InputEnhancements {
         this.messageInput.addEventListener('input', () => {
             this.updateCharCount();
             this.updateSendButtonState();
+            this.schedulePrefetch();
         });
 
         // 键盘快捷键
@@ -140,6 +145,31 @@ class InputEnhancements {
         }
     }
 
+    schedulePrefetch() {
+        // 防抖：连续输入时只在停顿后发送最新草稿
+        if (this.prefetchTimer) {
+            clearTimeout(this.prefetchTimer);
+        }
+        this.prefetchTimer = setTimeout(() => {
+            this.prefetchTimer = null;
+            this.sendPrefetch();
+        }, this.prefetchDelay);
+    }
+
+    sendPrefetch() {
+        const draft = this.messageInput.value.trim();
+        if (!draft || draft === this.lastPrefetchDraft || draft.length > this.maxLength) {
+            return;
+        }
+        this.lastPrefetchDraft = draft;
+        // 预取失败不影响正常发送，静默忽略
+        fetch('/api/recall/prefetch', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ draft })
+        }).catch(() => {});
+    }
+
     autoResize() {
         // 自动调整textarea高度
         this.messageInput.style.height = 'auto';
@@ -161,6 +191,13 @@ class InputEnhancements {
             return;
         }
 
+        // 发送时取消尚未触发的预取
+        if (this.prefetchTimer) {
+            clearTimeout(this.prefetchTimer);
+            this.prefetchTimer = null;
+        }
+        this.lastPrefetchDraft = '';
+
         // 直接调用全局的sendMessage函数
         if (window.sendMessage) {
             window.sendMessage();
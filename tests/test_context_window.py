@@ -0,0 +1,84 @@
+"""
+上下文裁剪（ChatService._apply_context_window）的单元测试
+"""
+import json
+import logging
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from services.chat_service import ChatService, Message
+
+
+def _service(budget: int) -> ChatService:
+    """只带裁剪所需属性的对话服务（不初始化客户端与会话）"""
+    service = ChatService.__new__(ChatService)
+    service.config_service = SimpleNamespace(get_app_config=lambda: {"context_token_budget": budget})
+    service.logger = logging.getLogger("test_context_window")
+    return service
+
+
+def _turn(i: int, note: str = None):
+    """一轮对话：用户消息与结构化的助手回复"""
+    reply = {"mood": 1, "content": f"第{i}轮回复，内容稍微长一些，用来占用预算"}
+    if note:
+        reply["note"] = note
+    return [Message("user", f"第{i}轮提问"), Message.from_response(json.dumps(reply, ensure_ascii=False))]
+
+
+def _history(turns: int):
+    messages = [Message("system", "你是一个测试角色")]
+    for i in range(turns):
+        messages.extend(_turn(i))
+    return messages
+
+
+def test_within_budget_returns_messages_unchanged():
+    messages = _history(3)
+    budget = sum(msg.tokens for msg in messages[1:])
+    assert _service(budget)._apply_context_window(messages) is messages
+
+
+def test_keeps_leading_system_prompt_and_drops_whole_oldest_turns():
+    messages = _history(4)
+    # 预算只够最后两轮
+    budget = sum(msg.tokens for msg in messages[5:])
+    trimmed = _service(budget)._apply_context_window(messages)
+    assert trimmed[0] is messages[0]
+    assert trimmed[1:] == messages[5:]
+    assert trimmed[1].role == "user"
+
+
+def test_always_keeps_last_turn_even_over_budget():
+    messages = _history(3)
+    messages.append(Message("user", "最后一条很长的提问" * 50))
+    trimmed = _service(1)._apply_context_window(messages)
+    assert trimmed == [messages[0], messages[-1]]
+
+
+def test_last_turn_with_tool_status_is_kept_whole():
+    messages = _history(2)
+    # 工具调用的状态提示以 system 消息写入会话历史（ChatTurn._record_status），属于同一轮
+    last_turn = [
+        Message("user", "查一下天气"),
+        Message("system", "[MCP] 已调用工具：weather"),
+        Message.from_response(json.dumps({"mood": 1, "content": "今天是晴天"}, ensure_ascii=False)),
+    ]
+    messages.extend(last_turn)
+    budget = sum(msg.tokens for msg in last_turn)
+    trimmed = _service(budget)._apply_context_window(messages)
+    assert trimmed == [messages[0]] + last_turn
+
+
+def test_budget_counts_note_sent_with_latest_reply():
+    messages = [Message("system", "你是一个测试角色")]
+    messages.extend(_turn(0))
+    messages.extend(_turn(1, note="用户喜欢猫，" * 20))
+    body = messages[1:]
+    without_note = sum(msg.tokens for msg in body)
+    assert messages[-1].note_tokens > 0
+    # 不计 note 时恰好放得下，实际发送会带上 note，因此必须丢弃最早一轮
+    trimmed = _service(without_note)._apply_context_window(messages)
+    assert trimmed == [messages[0]] + messages[3:]
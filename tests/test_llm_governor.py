@@ -0,0 +1,170 @@
+"""
+上游调用准入控制（ProviderLimiter）的单元测试：准入、排队、挤出与异步等待
+"""
+import asyncio
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.llm_governor import GovernorRejected, ProviderLimiter
+
+
+def _limiter(**overrides) -> ProviderLimiter:
+    config = {"max_concurrency": 1, "rate": 0, "burst": 10, "max_queue": 2, "max_wait": {"chat": 2, "bulk": 2}}
+    config.update(overrides)
+    return ProviderLimiter("test", config)
+
+
+def _acquire_in_thread(limiter: ProviderLimiter, priority: str, results: list) -> threading.Thread:
+    def run():
+        try:
+            results.append(limiter.acquire(priority))
+        except GovernorRejected as e:
+            results.append(e)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def _wait_for(predicate, timeout: float = 2.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "等待超时"
+        time.sleep(0.01)
+
+
+def test_admits_up_to_max_concurrency_then_queues():
+    limiter = _limiter(max_concurrency=2)
+    first, second = limiter.acquire("chat"), limiter.acquire("chat")
+    assert limiter.in_flight == 2
+
+    results = []
+    thread = _acquire_in_thread(limiter, "chat", results)
+    _wait_for(lambda: limiter._waiting() == 1)
+    assert results == []
+
+    first.release()
+    thread.join(2)
+    assert len(results) == 1 and not isinstance(results[0], GovernorRejected)
+    assert limiter.in_flight == 2
+    second.release()
+    results[0].release()
+    assert limiter.in_flight == 0
+
+
+def test_release_is_idempotent():
+    limiter = _limiter()
+    permit = limiter.acquire("chat")
+    permit.release()
+    permit.release()
+    assert limiter.in_flight == 0
+
+
+def test_rejects_when_wait_times_out():
+    limiter = _limiter()
+    held = limiter.acquire("chat")
+    with pytest.raises(GovernorRejected):
+        limiter.acquire("chat", timeout=0.05)
+    assert limiter._waiting() == 0
+    assert limiter.rejected["chat"] == 1
+    held.release()
+
+
+def test_higher_priority_sheds_lowest_waiter_when_queue_full():
+    limiter = _limiter()
+    held = limiter.acquire("chat")
+    bulk = []
+    threads = [_acquire_in_thread(limiter, "bulk", bulk) for _ in range(2)]
+    _wait_for(lambda: limiter._waiting() == 2)
+
+    chat = []
+    chat_thread = _acquire_in_thread(limiter, "chat", chat)
+    _wait_for(lambda: len(bulk) == 1)
+    assert isinstance(bulk[0], GovernorRejected)
+    assert limiter.shed["bulk"] == 1
+
+    # 归还名额后先放行排队的对话请求
+    held.release()
+    chat_thread.join(2)
+    assert len(chat) == 1 and not isinstance(chat[0], GovernorRejected)
+    chat[0].release()
+    for thread in threads:
+        thread.join(2)
+    bulk[1].release()
+    assert limiter.in_flight == 0 and limiter._waiting() == 0
+
+
+def test_rejects_when_queue_full_and_nothing_to_shed():
+    limiter = _limiter()
+    held = limiter.acquire("chat")
+    waiting = []
+    threads = [_acquire_in_thread(limiter, "chat", waiting) for _ in range(2)]
+    _wait_for(lambda: limiter._waiting() == 2)
+    with pytest.raises(GovernorRejected):
+        limiter.acquire("chat")
+    # 排队的请求依次获准
+    held.release()
+    _wait_for(lambda: len(waiting) == 1)
+    waiting[0].release()
+    _wait_for(lambda: len(waiting) == 2)
+    waiting[1].release()
+    for thread in threads:
+        thread.join(2)
+    assert not any(isinstance(p, GovernorRejected) for p in waiting)
+    assert limiter.in_flight == 0
+
+
+def test_async_waiter_is_woken_by_release_from_another_thread():
+    async def scenario():
+        limiter = _limiter()
+        held = limiter.acquire("chat")
+        task = asyncio.ensure_future(limiter.acquire_async("chat"))
+        await asyncio.sleep(0.05)
+        assert not task.done()
+        threading.Timer(0.05, held.release).start()
+        permit = await asyncio.wait_for(task, 2)
+        assert limiter.in_flight == 1
+        permit.release()
+        assert limiter.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_async_waiter_leaves_queue_and_returns_permit():
+    async def scenario():
+        limiter = _limiter()
+        held = limiter.acquire("chat")
+        task = asyncio.ensure_future(limiter.acquire_async("chat"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert limiter._waiting() == 0
+
+        # 名额已发放但协程恢复前被取消：名额归还
+        task = asyncio.ensure_future(limiter.acquire_async("chat"))
+        await asyncio.sleep(0.05)
+        held.release()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert limiter.in_flight == 0 and limiter._waiting() == 0
+
+    asyncio.run(scenario())
+
+
+def test_rate_limit_spaces_out_async_admissions():
+    async def scenario():
+        limiter = _limiter(max_concurrency=5, rate=20, burst=1)
+        started = time.monotonic()
+        permits = [await limiter.acquire_async("chat") for _ in range(3)]
+        assert time.monotonic() - started >= 0.09
+        for permit in permits:
+            permit.release()
+
+    asyncio.run(scenario())
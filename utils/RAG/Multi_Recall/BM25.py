@@ -1,8 +1,10 @@
 from .Retriever import *
 from typing import List, Literal, Dict
+import copy
 try:
     from rank_bm25 import BM25Okapi
     import jieba
+    import numpy as np
 except ImportError:
     raise ImportError("rank_bm25 or jieba 未安装. 无法使用BM25")
 
@@ -38,11 +40,36 @@ class BM25(Retriever):
     def retrieval(self, 
                   query: str, 
                   id_to_doc: Dict[int, str], 
-                  top_k: int = 10):  # 原文档corpus可为外部传入, 减少重复储存带来的内存消耗
+                  top_k: int = 10,
+                  deadline = None,
+                  tombstones = None):  # 原文档corpus可为外部传入, 减少重复储存带来的内存消耗
+        if deadline is not None:
+            deadline.check('BM25召回')
+        bm25 = self.bm25  # 压缩时会整体替换, 本次查询固定使用同一份
+        if bm25 is None:
+            return []
         query = self.method(query)
-        res = self.bm25.get_top_n(query, list(id_to_doc.values()), n=top_k)
+        if not tombstones:
+            return bm25.get_top_n(query, list(id_to_doc.values()), n=top_k)
+        # 跳过已删除的文档
+        scores = bm25.get_scores(query)
+        doc_ids = list(id_to_doc.keys())[:len(scores)]
+        res = []
+        for i in np.argsort(scores)[::-1]:
+            if doc_ids[i] in tombstones:
+                continue
+            res.append(id_to_doc[doc_ids[i]])
+            if len(res) >= top_k:
+                break
         return res
 
+    def compacted(self, keep_ids: List[int], id_to_doc: Dict[int, str]):
+        new = copy.copy(self)
+        new.bm25 = None
+        if id_to_doc:
+            new.add([], id_to_doc)  # 用保留的文档重建倒排统计
+        return new
+
     def save_to_file(self, file_path: str):
         logger.info('保存BM25索引')
         return ''
@@ -1,7 +1,11 @@
 from .Retriever import *
 from typing import List, Literal, Dict, Union
 import traceback
+import copy
 import os
+from utils.deadline_utils import DeadlineExceeded
+from utils.llm_governor import llm_governor
+from config import get_governor_config
 try:
     import torch
     from transformers import AutoTokenizer, AutoModel
@@ -28,7 +32,7 @@ try:
             self.model = AutoModel.from_pretrained(emb_model_name_or_path, trust_remote_code=True).half().to(device)
             self.tokenizer = AutoTokenizer.from_pretrained(emb_model_name_or_path, trust_remote_code=True)
 
-        def embed(self, texts: Union[List[str], str]) -> List[List[float]]:
+        def embed(self, texts: Union[List[str], str], deadline=None) -> List[List[float]]:
             if isinstance(texts, str):
                 texts = [texts]
                 
@@ -37,6 +41,8 @@ try:
             sentence_embeddings = []
 
             for start in tqdm(range(0, num_texts, self.batch_size), desc='Model批量嵌入文本'):
+                if deadline is not None:
+                    deadline.check('模型嵌入')
                 end = min(start + self.batch_size, num_texts)
                 batch_texts = texts[start:end]
                 batch_texts = [self.DEFAULT_QUERY_BGE_INSTRUCTION_ZH+x for x in batch_texts]
@@ -71,12 +77,15 @@ try:
             self.model = model
             self.client = OpenAI(
                 api_key=self.api_key,
-                base_url=self.base_url
+                base_url=self.base_url,
+                max_retries=int(get_governor_config().get("client_max_retries", 1))
             )
+            self.llm_provider = llm_governor.provider_key(self.base_url, self.api_key)
         
-        def embed(self, texts: Union[List[str], str]) -> List[List[float]]:
+        def embed(self, texts: Union[List[str], str], deadline=None) -> List[List[float]]:
             """
             调用API获取文本的嵌入向量（带缓存检查）
+            deadline: 可选的截止时间，每次请求只使用剩余时间且不重试
             """
             if isinstance(texts, str):
                 texts = [texts]
@@ -88,15 +97,24 @@ try:
             try:
                 ans = []
                 for text in tqdm(texts, desc='API嵌入文本'):
-                    # 使用 OpenAI 库调用嵌入API
-                    response = self.client.embeddings.create(
-                        model=self.model,
-                        input=text
-                    )
+                    client = self.client
+                    wait = None
+                    if deadline is not None:
+                        # 剩余时间不足以重试, 由调用方决定降级
+                        client = self.client.with_options(timeout=deadline.timeout(), max_retries=0)
+                        wait = deadline.timeout()
+                    # 使用 OpenAI 库调用嵌入API（优先级取调用场景：对话召回或记忆写入/建库）
+                    with llm_governor.slot(self.llm_provider, timeout=wait):
+                        response = client.embeddings.create(
+                            model=self.model,
+                            input=text
+                        )
                     res = response.data[0].embedding
                     ans.append(res)
                 return ans
             except Exception as e:
+                if deadline is not None and deadline.expired():
+                    raise DeadlineExceeded(f"API嵌入超时: {e}") from e
                 print(f"获取嵌入时发生异常: {e}")
                 traceback.print_exc()
         
@@ -165,19 +183,26 @@ class Cosine_Similarity(Retriever):
     def retrieval(self, 
                   query: str, 
                   id_to_doc: Dict[int, str], 
-                  top_k: int = 10
+                  top_k: int = 10,
+                  deadline = None,
+                  tombstones = None
                   ):
+        vectors = self.vectors  # 压缩时会整体替换, 本次查询固定使用同一份
+        if not vectors:
+            return []
         # 1. 计算query向量，归一化
-        query_embed = self.embed(query)[0]
-        query_embed = np.array(query_embed)
+        query_embed = self.embed(query, deadline=deadline)
+        if not query_embed:
+            return []
+        query_embed = np.array(query_embed[0])
         query_embed = query_embed / np.linalg.norm(query_embed)
 
         # 2. 计算余弦相似度（向量点积，因为归一化了，所以点积=余弦相似度）
-        sims = []
-        for vec in self.vectors:
-            sims.append(np.dot(query_embed, vec))
+        sims = np.asarray(vectors) @ query_embed
+        if tombstones:  # 已删除的文档不参与排序
+            dead = [i for i in tombstones.ids() if i < len(sims)]
+            sims[dead] = -np.inf
 
-        sims = np.array(sims)
         # 3. 找到相似度最高的top_k个索引
         topk_idx = sims.argsort()[::-1][:top_k//3+1]
 
@@ -187,11 +212,15 @@ class Cosine_Similarity(Retriever):
             dist = sims[idx]
             if dist < self.threshold:
                 break
-            res.append(id_to_doc[max(idx-1, 0)])  #TODO 保留上下文信息
-            res.append(id_to_doc[idx])
-            res.append(id_to_doc[min(len(id_to_doc)-1, idx+1)])
+            for doc_id in context_ids(idx, id_to_doc, tombstones):  #TODO 保留上下文信息
+                res.append(id_to_doc[doc_id])
         res = list(set(res))
         return res
+
+    def compacted(self, keep_ids: List[int], id_to_doc: Dict[int, str]):
+        new = copy.copy(self)  # 共享嵌入客户端
+        new.vectors = [self.vectors[i] for i in keep_ids]
+        return new
     
 
 if __name__ == "__main__":
@@ -1,7 +1,11 @@
 from .Retriever import *
 from typing import List, Literal, Dict, Union
 import traceback
+import copy
 import os
+from utils.deadline_utils import DeadlineExceeded
+from utils.llm_governor import llm_governor
+from config import get_governor_config
 try:
     import torch
     from transformers import AutoTokenizer, AutoModel
@@ -27,7 +31,7 @@ try:
             self.model = AutoModel.from_pretrained(emb_model_name_or_path, trust_remote_code=True).half().to(device)
             self.tokenizer = AutoTokenizer.from_pretrained(emb_model_name_or_path, trust_remote_code=True)
 
-        def embed(self, texts: Union[List[str], str]) -> List[List[float]]:
+        def embed(self, texts: Union[List[str], str], deadline=None) -> List[List[float]]:
             if isinstance(texts, str):
                 texts = [texts]
                 
@@ -36,6 +40,8 @@ try:
             sentence_embeddings = []
 
             for start in tqdm(range(0, num_texts, self.batch_size), desc='Model批量嵌入文本'):
+                if deadline is not None:
+                    deadline.check('模型嵌入')
                 end = min(start + self.batch_size, num_texts)
                 batch_texts = texts[start:end]
                 batch_texts = [self.DEFAULT_QUERY_BGE_INSTRUCTION_ZH+x for x in batch_texts]
@@ -69,12 +75,15 @@ try:
             self.model = model
             self.client = OpenAI(
                 api_key=self.api_key,
-                base_url=self.base_url
+                base_url=self.base_url,
+                max_retries=int(get_governor_config().get("client_max_retries", 1))
             )
+            self.llm_provider = llm_governor.provider_key(self.base_url, self.api_key)
         
-        def embed(self, texts: Union[List[str], str]) -> List[List[float]]:
+        def embed(self, texts: Union[List[str], str], deadline=None) -> List[List[float]]:
             """
             调用API获取文本的嵌入向量（带缓存检查）
+            deadline: 可选的截止时间，每次请求只使用剩余时间且不重试
             """
             if isinstance(texts, str):
                 texts = [texts]
@@ -86,15 +95,24 @@ try:
             try:
                 ans = []
                 for text in tqdm(texts, desc='API嵌入文本'):
-                    # 使用 OpenAI 库调用嵌入API
-                    response = self.client.embeddings.create(
-                        model=self.model,
-                        input=text
-                    )
+                    client = self.client
+                    wait = None
+                    if deadline is not None:
+                        # 剩余时间不足以重试, 由调用方决定降级
+                        client = self.client.with_options(timeout=deadline.timeout(), max_retries=0)
+                        wait = deadline.timeout()
+                    # 使用 OpenAI 库调用嵌入API（优先级取调用场景：对话召回或记忆写入/建库）
+                    with llm_governor.slot(self.llm_provider, timeout=wait):
+                        response = client.embeddings.create(
+                            model=self.model,
+                            input=text
+                        )
                     res = response.data[0].embedding
                     ans.append(res)
                 return ans
             except Exception as e:
+                if deadline is not None and deadline.expired():
+                    raise DeadlineExceeded(f"API嵌入超时: {e}") from e
                 print(f"获取嵌入时发生异常: {e}")
                 traceback.print_exc()
         
@@ -157,20 +175,41 @@ class Cosine_Similarity(Retriever):
     def retrieval(self, 
                   query: str, 
                   id_to_doc: Dict[int, str], 
-                  top_k: int = 10
+                  top_k: int = 10,
+                  deadline = None,
+                  tombstones = None
                   ):
-        query_embed = self.embed(query)[0]
-        nearest_ids, distances = self.annoy_index.get_nns_by_vector(query_embed, top_k//3+1, include_distances=True)
+        annoy_index = self.annoy_index  # 压缩时会整体替换, 本次查询固定使用同一份
+        query_embed = self.embed(query, deadline=deadline)
+        if not query_embed:
+            return []
+        query_embed = query_embed[0]
+        n = top_k//3+1
+        # 多取已删除数量的候选, 跳过已删除的文档后仍能凑够n个
+        extra = len(tombstones) if tombstones else 0
+        nearest_ids, distances = annoy_index.get_nns_by_vector(query_embed, n + extra, include_distances=True)
         res = []
+        hits = 0
         for idx, dist in zip(nearest_ids, distances):  # 遍历最接近的向量
-            if dist < self.threshold:
+            if tombstones and idx in tombstones:
+                continue
+            if dist < self.threshold or hits >= n:
                 break
-            res.append(id_to_doc[max(idx-1, 0)])  #TODO 保留上下文信息
-            res.append(id_to_doc[idx])
-            res.append(id_to_doc[min(len(id_to_doc)-1, idx+1)])
+            hits += 1
+            for doc_id in context_ids(idx, id_to_doc, tombstones):  #TODO 保留上下文信息
+                res.append(id_to_doc[doc_id])
             
         res = list(set(res))  # 去重
         return res
+
+    def compacted(self, keep_ids: List[int], id_to_doc: Dict[int, str]):
+        # Annoy 索引构建后不可修改, 用保留的向量重建一个新索引
+        new = copy.copy(self)  # 共享嵌入客户端
+        new.annoy_index = AnnoyIndex(self.vector_dim, 'angular')
+        for new_id, old_id in enumerate(keep_ids):
+            new.annoy_index.add_item(new_id, self.annoy_index.get_item_vector(old_id))
+        new.build()
+        return new
     
     def build(self, n_trees: int = 10):
         self.annoy_index.build(n_trees)
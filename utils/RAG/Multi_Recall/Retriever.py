@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 from typing import List, Dict
 import logging
-__all__ = ['Retriever', 'tqdm', 'logger']
+__all__ = ['Retriever', 'tqdm', 'logger', 'context_ids']
 
 try:
     from tqdm import tqdm
@@ -25,9 +25,20 @@ class Retriever(ABC):
     def retrieval(self, 
                   query: str,  # 查询字符串
                   id_to_doc: Dict[int, str],  # 文档id_to_doc  
-                  top_k: int = 10  # 召回文档数目
+                  top_k: int = 10,  # 召回文档数目
+                  deadline = None,  # utils.deadline_utils.Deadline, 调用外部服务时使用剩余时间
+                  tombstones = None  # 已删除的文档id集合(支持 in), 召回时跳过
                   ):
         pass
+
+    def compacted(self,
+                  keep_ids: List[int],  # 保留的旧文档id, 按新id顺序排列
+                  id_to_doc: Dict[int, str]  # 压缩后的文档id_to_doc
+                  ) -> 'Retriever':
+        '''
+        返回去掉已删除文档后的新召回对象(不修改自身, 以便查询继续使用旧状态)
+        '''
+        raise NotImplementedError(f'{type(self).__name__} 不支持压缩')
     
     @abstractmethod
     def save_to_file(self, file_path: str):
@@ -37,6 +48,16 @@ class Retriever(ABC):
     def load_from_file(self, data_dict: dict):
         pass
 
+def context_ids(idx: int, id_to_doc: Dict[int, str], tombstones = None) -> List[int]:
+    '''
+    命中文档及其前后相邻文档的id(保留上下文信息), 跳过已删除或不存在的文档
+    '''
+    ids = []
+    for doc_id in (max(idx - 1, 0), idx, min(len(id_to_doc) - 1, idx + 1)):
+        if doc_id in id_to_doc and not (tombstones is not None and doc_id in tombstones):
+            ids.append(doc_id)
+    return ids
+
 logger = logging.getLogger(f"Recall Loading")
 if not logger.handlers:
     handler = logging.StreamHandler()
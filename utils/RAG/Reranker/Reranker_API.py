@@ -1,18 +1,22 @@
 import requests
+from utils.deadline_utils import DeadlineExceeded
+from utils.llm_governor import llm_governor, GovernorRejected
 class Reranker_API:
-    def __init__(self, base_url, api_key, model):
+    def __init__(self, base_url, api_key, model, timeout: float = 30):
         self.api_key = api_key
         self.model = model
         self.api_base = base_url.rstrip("/")
+        self.timeout = timeout  # 单次请求超时上限（秒）
+        self.llm_provider = llm_governor.provider_key(self.api_base, api_key)
 
-    def rerank(self, docs, query, k=5):
+    def rerank(self, docs, query, k=5, deadline=None):
         docs_ = []
         for item in docs:
             if isinstance(item, str):
                 docs_.append(item)
             else:
                 docs_.append(item.page_content)
-        docs = list(set(docs_))
+        docs = list(dict.fromkeys(docs_))  # 按召回顺序去重（精排被跳过时直接按此顺序返回）
         url = f"{self.api_base}/rerank"
         headers = {
             "Authorization": f"Bearer {self.api_key}",
@@ -25,8 +29,16 @@ class Reranker_API:
             "top_n": k,
             "return_documents": False
         }
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
+        timeout = deadline.timeout(self.timeout) if deadline is not None else self.timeout
+        try:
+            with llm_governor.slot(self.llm_provider, timeout=timeout):
+                response = requests.post(url, headers=headers, json=data, timeout=timeout)
+                response.raise_for_status()
+        except GovernorRejected:
+            # 上游繁忙时跳过精排，按召回顺序返回
+            return docs[:k]
+        except requests.Timeout as e:
+            raise DeadlineExceeded(f"精排请求超时({timeout:.2f}秒)") from e
         results = response.json()["results"]
         # 按得分排序并返回文档索引
         idx_score = [(r["index"], r["relevance_score"]) for r in results]
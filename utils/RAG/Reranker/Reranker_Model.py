@@ -27,7 +27,7 @@ try:
             self.device = device
             print('successful load rerank model')
 
-        def rerank(self, docs: List, query: str, k: int = 5) -> List:
+        def rerank(self, docs: List, query: str, k: int = 5, deadline=None) -> List:
             """
             对文档进行重新排序
             
@@ -35,6 +35,7 @@ try:
                 docs: 文档列表
                 query: 查询语句
                 k: 返回的文档数量
+                deadline: 可选的截止时间，推理前检查
                 
             Returns:
                 重新排序后的文档列表
@@ -46,6 +47,8 @@ try:
                 else:
                     docs_.append(item.page_content)
             docs = list(set(docs_))
+            if deadline is not None:
+                deadline.check('模型精排')
             pairs = []
             for d in docs:
                 pairs.append([query, d])
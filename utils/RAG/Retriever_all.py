@@ -1,10 +1,58 @@
-from typing import List, Union
+from typing import Dict, Iterable, List, NamedTuple, Union
 import logging
+import threading
 from importlib import import_module
 from traceback import print_exc
 import traceback
+from utils.deadline_utils import Deadline
 # from langchain.vectorstores import FAISS
 
+
+class Tombstones:
+    """删除标记位图: 按文档id记录已删除(待压缩)的文档, 查询时跳过"""
+    def __init__(self, ids: Iterable[int] = None):
+        self._bits = bytearray()
+        self._count = 0
+        for doc_id in ids or []:
+            self.add(doc_id)
+
+    def add(self, doc_id: int) -> bool:
+        # 返回是否为新增的删除标记
+        doc_id = int(doc_id)
+        byte, bit = divmod(doc_id, 8)
+        if byte >= len(self._bits):
+            self._bits.extend(b'\x00' * (byte + 1 - len(self._bits)))
+        if self._bits[byte] & (1 << bit):
+            return False
+        self._bits[byte] |= 1 << bit
+        self._count += 1
+        return True
+
+    def __contains__(self, doc_id) -> bool:
+        byte, bit = divmod(int(doc_id), 8)
+        return byte < len(self._bits) and bool(self._bits[byte] & (1 << bit))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def ids(self) -> List[int]:
+        return [byte * 8 + bit for byte, value in enumerate(self._bits) if value
+                for bit in range(8) if value & (1 << bit)]
+
+    def copy(self) -> 'Tombstones':
+        new = Tombstones()
+        new._bits = bytearray(self._bits)
+        new._count = self._count
+        return new
+
+
+class _View(NamedTuple):
+    # 一次查询看到的完整索引状态; 压缩完成后整体替换, 读者不加锁也不会看到新旧混杂的状态
+    recall_dict: Dict[str, object]
+    id_to_doc: Dict[int, str]
+    tombstones: Tombstones
+
+
 class Retriever:
     def __init__(self, config: dict):
         self.logger = logging.getLogger(f"Retriever")
@@ -16,27 +64,43 @@ class Retriever:
             self.logger.setLevel(logging.INFO)
             
         self.config = config
+        self._lock = threading.RLock()  # 写操作(添加/删除/压缩)互斥, 查询不加锁
 
         self.initialize()
+
+    @property
+    def recall_dict(self) -> Dict[str, object]:
+        return self._view.recall_dict
+
+    @property
+    def id_to_doc(self) -> Dict[int, str]:
+        return self._view.id_to_doc
+
+    @property
+    def tombstones(self) -> Tombstones:
+        return self._view.tombstones
         
     def save_to_file(self, file_path: str):
+        view = self._view
         dic = {}
-        for recall_func in self.recall_dict:
-            dic[recall_func] = self.recall_dict[recall_func].save_to_file(file_path)
-        dic['id_to_doc'] = self.id_to_doc
+        for recall_func in view.recall_dict:
+            dic[recall_func] = view.recall_dict[recall_func].save_to_file(file_path)
+        dic['id_to_doc'] = view.id_to_doc
+        dic['tombstones'] = view.tombstones.ids()
         return dic
     
     def load_from_file(self, data_dict: dict):
-        self.id_to_doc = data_dict['id_to_doc'].copy()
-        self.id_to_doc = {int(k): v for k, v in self.id_to_doc.items()}  # 确保id是int类型
-        for recall_func in self.recall_dict:
-            self.recall_dict[recall_func].load_from_file(data_dict)
+        with self._lock:
+            id_to_doc = {int(k): v for k, v in data_dict['id_to_doc'].items()}  # 确保id是int类型
+            self._view = _View(self.recall_dict, id_to_doc, Tombstones(data_dict.get('tombstones', [])))
+            for recall_func in self.recall_dict:
+                self.recall_dict[recall_func].load_from_file(data_dict)
         return self
             
     def initialize(self):
         self.recall_config = self.config['Multi_Recall']
-        self.id_to_doc = {}  # 用于存储文档的映射
-        self.recall_dict = {}
+        recall_dict = {}
+        self._view = _View(recall_dict, {}, Tombstones())  # id_to_doc 用于存储文档的映射
         for recall_func in self.recall_config:
             self.logger.info(f"Loading {recall_func}...")
             func_kwds = self.recall_config[recall_func]
@@ -47,7 +111,7 @@ class Retriever:
                 print_exc()
                 continue
             try:
-                self.recall_dict[recall_func] = getattr(module, recall_func)(**func_kwds)  # 创建召回对象
+                recall_dict[recall_func] = getattr(module, recall_func)(**func_kwds)  # 创建召回对象
             except Exception as e:
                 self.logger.error(f"Error creating {recall_func}: {e}")
                 print_exc()
@@ -63,27 +127,63 @@ class Retriever:
         corpus = self.process_corpus(corpus)  # 前处理
         self.logger.info(f"Process {len(corpus)} documents")
         
-        for recall_func, recall_module in self.recall_dict.items():  # 循环添加
-            self.logger.info(f"Adding {recall_func}...")
-            recall_module.add(corpus, self.id_to_doc)
-        
-        starId = len(self.id_to_doc)  # 更新id_to_doc
-        for doc in corpus:
-            self.id_to_doc[starId] = doc
-            starId += 1
+        with self._lock:
+            for recall_func, recall_module in self.recall_dict.items():  # 循环添加
+                self.logger.info(f"Adding {recall_func}...")
+                recall_module.add(corpus, self.id_to_doc)
+            
+            starId = len(self.id_to_doc)  # 更新id_to_doc
+            for doc in corpus:
+                self.id_to_doc[starId] = doc
+                starId += 1
         return self
+
+    def delete(self, ids: Iterable[int]) -> int:
+        # 标记删除(墓碑), 文档在压缩前仍占位但不会再被召回; 返回新删除的数量
+        with self._lock:
+            id_to_doc = self.id_to_doc
+            return sum(1 for doc_id in ids if int(doc_id) in id_to_doc and self.tombstones.add(doc_id))
+
+    def dead_ratio(self) -> float:
+        view = self._view
+        return len(view.tombstones) / len(view.id_to_doc) if view.id_to_doc else 0.0
+
+    def compact(self) -> Dict[int, int]:
+        '''
+        重写向量、倒排与文档映射, 去掉已删除的文档; 新状态构建完成后整体替换
+        返回旧id到新id的映射
+        '''
+        with self._lock:
+            view = self._view
+            keep_ids = [doc_id for doc_id in sorted(view.id_to_doc) if doc_id not in view.tombstones]
+            remap = {old: new for new, old in enumerate(keep_ids)}
+            if len(keep_ids) == len(view.id_to_doc):
+                return remap
+            id_to_doc = {new: view.id_to_doc[old] for old, new in remap.items()}
+            recall_dict = {}
+            for recall_func, recall_module in view.recall_dict.items():
+                self.logger.info(f"Compacting {recall_func}...")
+                recall_dict[recall_func] = recall_module.compacted(keep_ids, id_to_doc)
+            self._view = _View(recall_dict, id_to_doc, Tombstones())
+            self.logger.info(f"Compacted {len(view.id_to_doc)} -> {len(id_to_doc)} documents")
+            return remap
     def retrieval(self, query, 
                   methods = None,
-                  top_k = 10
+                  top_k = 10,
+                  deadline: Deadline = None
                   ) -> List[str]:
         search_res = list()
+        deadline = Deadline.coerce(deadline)
+        view = self._view  # 本次查询固定使用同一份索引状态
         if methods is None:
-            methods = list(self.recall_dict.keys())
+            methods = list(view.recall_dict.keys())
         for method in methods:
-            if method in self.recall_dict:
-                res = self.recall_dict[method].retrieval(query, self.id_to_doc, top_k)
+            if method in view.recall_dict:
+                deadline.check(f'召回 {method}')
+                res = view.recall_dict[method].retrieval(query, view.id_to_doc, top_k, deadline=deadline,
+                                                         tombstones=view.tombstones)
                 search_res.extend(res)
-        search_res = list(set(search_res))  # 结果去重
+        search_res = list(dict.fromkeys(search_res))  # 结果去重，保留各路召回的先后顺序
         return search_res
 
 if __name__ == "__main__":
@@ -1,7 +1,8 @@
 import os
-from typing import List, Union
+from typing import Dict, Iterable, List, Union
 from .Retriever_all import Retriever
 from importlib import import_module
+from utils.deadline_utils import Deadline
 class RAG:
     def __init__(self, config: dict):
         # 初始化函数
@@ -26,13 +27,23 @@ class RAG:
         # 私有添加函数
         self.retriever.add(corpus)
         return self
+
+    def delete(self, ids: Iterable[int]) -> int:
+        # 按文档id标记删除, 返回新删除的数量
+        return self.retriever.delete(ids)
+
+    def compact(self) -> Dict[int, int]:
+        # 压缩索引, 返回旧id到新id的映射
+        return self.retriever.compact()
         
-    def req(self, query, top_k=5) -> List[str]:
-        # 查询函数
-        retrieval_res = self.retriever.retrieval(query)  # 获得初步查询
+    def req(self, query, top_k=5, deadline: Deadline = None) -> List[str]:
+        # 查询函数; deadline 贯穿召回与精排, 每一步只使用剩余时间
+        deadline = Deadline.coerce(deadline)
+        retrieval_res = self.retriever.retrieval(query, deadline=deadline)  # 获得初步查询
         if retrieval_res is None or len(retrieval_res) == 0:
             return []
-        rerank_res = self.reranker.rerank(retrieval_res, query, k=top_k)  # 后处理, 精排
+        deadline.check('精排')
+        rerank_res = self.reranker.rerank(retrieval_res, query, k=top_k, deadline=deadline)  # 后处理, 精排
         return rerank_res
 
 if __name__ == '__main__':
@@ -0,0 +1,97 @@
+"""
+截止时间工具模块
+提供线程安全、可在任意线程及asyncio中使用的协作式截止时间（替代signal.alarm）
+"""
+import time
+import threading
+from typing import Optional
+
+
+class DeadlineExceeded(TimeoutError):
+    """截止时间已到（或已被取消）"""
+    pass
+
+
+class Deadline:
+    """
+    协作式截止时间
+
+    基于 time.monotonic，不依赖信号，可在 Flask/waitress 工作线程、线程池和 asyncio 中使用。
+    调用方在每个步骤前检查剩余时间，并用 timeout() 为 HTTP 请求计算剩余超时。
+    """
+
+    def __init__(self, seconds: Optional[float] = None):
+        """
+        初始化截止时间
+
+        Args:
+            seconds: 从现在起的可用秒数，None 表示不限时
+        """
+        self.seconds = seconds
+        self.expires_at = None if seconds is None else time.monotonic() + float(seconds)
+        self._cancelled = threading.Event()
+
+    @classmethod
+    def coerce(cls, deadline: Optional["Deadline"] = None, seconds: Optional[float] = None) -> "Deadline":
+        """已有截止时间则直接返回，否则按秒数新建一个"""
+        if isinstance(deadline, Deadline):
+            return deadline
+        return cls(seconds)
+
+    def remaining(self) -> Optional[float]:
+        """剩余秒数（不小于0），不限时返回None"""
+        if self._cancelled.is_set():
+            return 0.0
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        """是否已超时或已取消"""
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def cancel(self) -> None:
+        """主动取消，之后所有检查点都视为超时"""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        """是否被主动取消"""
+        return self._cancelled.is_set()
+
+    def check(self, step: str = "") -> None:
+        """
+        检查点：已超时则抛出 DeadlineExceeded
+
+        Args:
+            step: 当前步骤名称，用于错误信息
+        """
+        if self.expired():
+            reason = "已取消" if self.cancelled else "已超时"
+            raise DeadlineExceeded(f"{step or '操作'}{reason}")
+
+    def timeout(self, cap: Optional[float] = None, floor: float = 0.05) -> Optional[float]:
+        """
+        计算下一步可用的超时时间（秒）
+
+        Args:
+            cap: 单步超时上限，None表示不设上限
+            floor: 最小超时，避免向HTTP库传入0
+
+        Returns:
+            超时秒数；不限时且无上限时返回None
+
+        Raises:
+            DeadlineExceeded: 已无剩余时间时
+        """
+        self.check()
+        remaining = self.remaining()
+        if remaining is None:
+            return cap
+        if cap is not None:
+            remaining = min(remaining, cap)
+        return max(remaining, floor)
+
+    def __repr__(self) -> str:
+        return f"Deadline(remaining={self.remaining()}, cancelled={self.cancelled})"
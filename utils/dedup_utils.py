@@ -0,0 +1,145 @@
+"""
+近似重复检测工具模块
+基于 SimHash 指纹与分段（band）索引，在写入记忆时识别近似重复的文本
+"""
+import re
+import hashlib
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Set
+
+try:
+    import jieba
+except ImportError:
+    jieba = None
+
+FINGERPRINT_BITS = 64
+_MASK = (1 << FINGERPRINT_BITS) - 1
+
+
+def normalize_text(text: str) -> str:
+    """全半角统一、小写，标点与空白统一为空格"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = "".join(" " if unicodedata.category(ch).startswith(("P", "S", "Z")) else ch for ch in text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def shingles(text: str) -> List[str]:
+    """
+    生成文本特征片段：分词结果及相邻词二元组；未安装 jieba 时退化为字二元组
+
+    Args:
+        text: 原始文本
+
+    Returns:
+        特征片段列表（可重复，重复次数即权重）
+    """
+    text = normalize_text(text)
+    if not text:
+        return []
+    if jieba is not None:
+        tokens = [t for t in jieba.lcut(text) if t.strip()]
+        return tokens + [a + "\u0001" + b for a, b in zip(tokens, tokens[1:])]
+    compact = text.replace(" ", "")
+    if len(compact) < 2:
+        return [compact]
+    return [compact[i:i + 2] for i in range(len(compact) - 1)]
+
+
+def _feature_hash(feature: str) -> int:
+    """稳定的64位特征哈希（不受 PYTHONHASHSEED 影响，便于持久化指纹）"""
+    return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def simhash(text: str) -> int:
+    """
+    计算文本的64位 SimHash 指纹
+
+    Args:
+        text: 原始文本
+
+    Returns:
+        指纹整数；空文本返回0
+    """
+    weights = [0] * FINGERPRINT_BITS
+    for feature, count in Counter(shingles(text)).items():
+        h = _feature_hash(feature)
+        for bit in range(FINGERPRINT_BITS):
+            weights[bit] += count if (h >> bit) & 1 else -count
+    fingerprint = 0
+    for bit, weight in enumerate(weights):
+        if weight > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """两个指纹的汉明距离"""
+    return bin((a ^ b) & _MASK).count("1")
+
+
+class SimHashIndex:
+    """
+    SimHash 近似重复索引
+
+    把64位指纹切成 max_distance+1 段，汉明距离不超过 max_distance 的两个指纹
+    至少有一段完全相同（抽屉原理），因此只需比较同段桶中的候选，查询代价与总量基本无关。
+    """
+
+    def __init__(self, max_distance: int = 3):
+        """
+        初始化索引
+
+        Args:
+            max_distance: 视为近似重复的最大汉明距离
+        """
+        self.max_distance = max(0, int(max_distance))
+        bands = self.max_distance + 1
+        width = FINGERPRINT_BITS // bands
+        # (起始位, 位宽)，最后一段吸收余数
+        self._bands = [(i * width, width if i < bands - 1 else FINGERPRINT_BITS - i * width) for i in range(bands)]
+        self._buckets: List[Dict[int, Set[int]]] = [defaultdict(set) for _ in self._bands]
+        self.fingerprints: Dict[int, int] = {}
+
+    def _keys(self, fingerprint: int) -> Iterable[int]:
+        for start, width in self._bands:
+            yield (fingerprint >> start) & ((1 << width) - 1)
+
+    def add(self, doc_id: int, fingerprint: int) -> None:
+        """登记文档指纹"""
+        self.remove(doc_id)
+        self.fingerprints[doc_id] = fingerprint
+        for buckets, key in zip(self._buckets, self._keys(fingerprint)):
+            buckets[key].add(doc_id)
+
+    def remove(self, doc_id: int) -> None:
+        """移除文档指纹（不存在时忽略）"""
+        fingerprint = self.fingerprints.pop(doc_id, None)
+        if fingerprint is None:
+            return
+        for buckets, key in zip(self._buckets, self._keys(fingerprint)):
+            bucket = buckets.get(key)
+            if bucket is not None:
+                bucket.discard(doc_id)
+                if not bucket:
+                    del buckets[key]
+
+    def find(self, fingerprint: int) -> Optional[int]:
+        """
+        查找与给定指纹最接近的近似重复文档
+
+        Returns:
+            文档id；没有距离在阈值内的文档时返回None
+        """
+        candidates = set()
+        for buckets, key in zip(self._buckets, self._keys(fingerprint)):
+            candidates |= buckets.get(key, set())
+        best_id, best_distance = None, self.max_distance + 1
+        for doc_id in candidates:
+            distance = hamming_distance(fingerprint, self.fingerprints[doc_id])
+            if distance < best_distance or (distance == best_distance and best_id is not None and doc_id > best_id):
+                best_id, best_distance = doc_id, distance
+        return best_id
+
+    def __len__(self) -> int:
+        return len(self.fingerprints)
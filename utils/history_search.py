@@ -0,0 +1,601 @@
+"""
+历史记录全文检索模块
+按角色维护磁盘上的倒排索引：基础索引（词典 + 二进制倒排表，按需读取）加增量日志，
+save_message 时只追加增量，不重新扫描历史日志；查询用 BM25 排序
+"""
+import os
+import re
+import json
+import math
+import mmap
+import struct
+import logging
+import threading
+from array import array
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import jieba
+except ImportError:
+    jieba = None
+
+from utils.dedup_utils import normalize_text
+from utils.persist_utils import atomic_write_json
+
+logger = logging.getLogger(__name__)
+
+# 文档表的定长记录：字节偏移、字节长度、词数、角色
+_DOC_STRUCT = struct.Struct("<QIHB")
+_ROLE_CODES = {"user": 1, "assistant": 2}
+_ROLE_NAMES = {code: role for role, code in _ROLE_CODES.items()}
+
+_CJK_RUN = re.compile(r"[㐀-䶿一-鿿぀-ヿ가-힯]+")
+
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    切分检索词：使用 jieba 搜索引擎模式；未安装 jieba 时中日韩文本取字二元组、其余按单词
+
+    Args:
+        text: 原始文本
+
+    Returns:
+        词列表（可重复）
+    """
+    text = normalize_text(text)
+    if not text:
+        return []
+    if jieba is not None:
+        return [t for t in jieba.lcut_for_search(text) if t.strip()]
+    tokens = []
+    for chunk in text.split(" "):
+        pos = 0
+        for match in _CJK_RUN.finditer(chunk):
+            if match.start() > pos:
+                tokens.append(chunk[pos:match.start()])
+            run = match.group()
+            if len(run) > 1:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            else:
+                tokens.append(run)
+            pos = match.end()
+        if pos < len(chunk):
+            tokens.append(chunk[pos:])
+    return tokens
+
+
+def make_snippet(content: str, terms: Iterable[str], before: int = 20, after: int = 60) -> str:
+    """
+    截取包含最早出现的检索词的片段
+
+    Args:
+        content: 消息内容
+        terms: 检索词
+        before: 命中位置之前保留的字数
+        after: 命中位置之后保留的字数
+
+    Returns:
+        片段文本，截断处用省略号标记
+    """
+    lowered = content.lower()
+    hits = [pos for pos in (lowered.find(t) for t in terms) if pos >= 0]
+    first = min(hits) if hits else 0
+    start = max(0, first - before)
+    end = min(len(content), first + after)
+    return ("…" if start > 0 else "") + content[start:end] + ("…" if end < len(content) else "")
+
+
+def _make_entry(doc: int, text: str, role: str, offset: int, length: int) -> Dict[str, Any]:
+    """构造一条增量记录（分词在调用方线程中完成，不持有索引锁）"""
+    return {"d": doc, "o": offset, "n": length, "r": _ROLE_CODES.get(role, 0),
+            "t": dict(Counter(tokenize(text)))}
+
+
+def _generation_name(name: str, generation: int) -> str:
+    """基础索引文件名：第0代沿用不带代号的旧文件名"""
+    if not generation:
+        return name
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{generation}{ext}"
+
+
+class _CharacterIndex:
+    """
+    单个角色的倒排索引
+
+    文件（<index_dir>/<角色ID>/）：
+    - lexicon.json：{"generation", "next_doc", "total_len", "terms": {词: [倒排表起点, 长度]}}
+    - postings.<代>.bin / tf.<代>.bin：按词连续存放的文档号（uint32）与词频（uint16），通过 mmap 按需读取
+    - docs.<代>.bin：文档表，每条消息一条定长记录
+    - delta.log：基础索引之后新增消息的JSONL增量，加载时回放，合并后只保留未合并的部分
+    文档号即消息的全局序号。合并时写出新一代基础文件，最后写入的词典决定使用哪一代，
+    因此合并可以在后台进行，查询只在切换时短暂等待锁。
+    """
+
+    def __init__(self, directory: str):
+        self.dir = directory
+        self.lock = threading.RLock()
+        # 同一时间只有一个合并；补齐索引按角色串行
+        self.merge_lock = threading.Lock()
+        self.backfill_lock = threading.Lock()
+        self.terms: Dict[str, Tuple[int, int]] = {}
+        self.generation = 0
+        self.base_docs = 0
+        self.next_doc = 0
+        self.total_len = 0
+        self.doc_offsets = array("Q")
+        self.doc_lengths = array("I")
+        self.doc_lens = array("H")
+        self.doc_roles = bytearray()
+        self.delta: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self.delta_docs = 0
+        # 尚未写出的增量行：(文档号, 对应记录在历史日志中的结束偏移, 行)
+        self._pending: List[Tuple[int, int, bytes]] = []
+        # clear() 时递增，进行中的合并据此放弃结果
+        self._epoch = 0
+        self._postings = None
+        self._tfs = None
+        self._delta_file = None
+        self.loaded = False
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.dir, name)
+
+    def load(self) -> None:
+        """加载基础索引并回放增量日志"""
+        with self.lock:
+            if self.loaded:
+                return
+            lexicon_file = self._path("lexicon.json")
+            if os.path.exists(lexicon_file):
+                try:
+                    with open(lexicon_file, "r", encoding="utf-8") as f:
+                        lexicon = json.load(f)
+                    self.generation = int(lexicon.get("generation", 0))
+                    self.terms = {t: tuple(v) for t, v in lexicon["terms"].items()}
+                    self.base_docs = self.next_doc = lexicon["next_doc"]
+                    self.total_len = lexicon["total_len"]
+                    with open(self._path(_generation_name("docs.bin", self.generation)), "rb") as f:
+                        for offset, length, doc_len, role in _DOC_STRUCT.iter_unpack(f.read()):
+                            self.doc_offsets.append(offset)
+                            self.doc_lengths.append(length)
+                            self.doc_lens.append(doc_len)
+                            self.doc_roles.append(role)
+                    self._postings = self._map(_generation_name("postings.bin", self.generation))
+                    self._tfs = self._map(_generation_name("tf.bin", self.generation))
+                except Exception as e:
+                    logger.error(f"加载历史检索索引失败，将重建 {self.dir}: {e}")
+                    self._reset_state()
+            delta_file = self._path("delta.log")
+            if os.path.exists(delta_file):
+                valid_end = 0
+                with open(delta_file, "rb") as f:
+                    for raw in f:
+                        if not raw.endswith(b"\n"):
+                            break
+                        try:
+                            entry = json.loads(raw.decode("utf-8"))
+                        except (UnicodeDecodeError, json.JSONDecodeError):
+                            break
+                        # 已合并进基础索引的增量（合并后、清理增量日志前中断）直接跳过
+                        if entry.get("d", -1) < self.next_doc:
+                            valid_end += len(raw)
+                            continue
+                        if entry.get("d") != self.next_doc:
+                            break
+                        self._apply(entry)
+                        valid_end += len(raw)
+                # 截掉中断写入或与基础索引对不上的尾部，之后的增量接在有效部分后面
+                if valid_end < os.path.getsize(delta_file):
+                    with open(delta_file, "r+b") as f:
+                        f.truncate(valid_end)
+            self._remove_stale_generations()
+            self.loaded = True
+
+    def _map(self, name: str):
+        path = self._path(name)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return None
+        with open(path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _remove_stale_generations(self) -> None:
+        """删除不再使用的旧一代基础文件（仍被映射而删除失败时留到下次）"""
+        if not os.path.isdir(self.dir):
+            return
+        current = {_generation_name(name, self.generation) for name in ("postings.bin", "tf.bin", "docs.bin")}
+        for name in os.listdir(self.dir):
+            if name.endswith(".bin") and name.split(".")[0] in ("postings", "tf", "docs") and name not in current:
+                try:
+                    os.unlink(self._path(name))
+                except OSError:
+                    pass
+
+    def _reset_state(self) -> None:
+        self.close()
+        self.terms = {}
+        self.generation = 0
+        self.base_docs = self.next_doc = self.total_len = 0
+        self.doc_offsets, self.doc_lengths, self.doc_lens = array("Q"), array("I"), array("H")
+        self.doc_roles = bytearray()
+        self.delta = defaultdict(list)
+        self.delta_docs = 0
+        self._pending = []
+        self._epoch += 1
+
+    def _apply(self, entry: Dict[str, Any]) -> None:
+        """把一条增量计入内存"""
+        doc = entry["d"]
+        for term, tf in entry["t"].items():
+            self.delta[term].append((doc, tf))
+        doc_len = min(sum(entry["t"].values()), 0xFFFF)
+        self.doc_offsets.append(entry["o"])
+        self.doc_lengths.append(entry["n"])
+        self.doc_lens.append(doc_len)
+        self.doc_roles.append(entry["r"])
+        self.total_len += doc_len
+        self.next_doc = doc + 1
+        self.delta_docs += 1
+
+    def add(self, doc: int, text: str, role: str, offset: int, length: int) -> None:
+        """
+        追加一条消息：更新内存，增量行先缓冲，随历史日志的成组写盘一起写出（见 flush_delta）
+
+        Args:
+            doc: 消息全局序号，必须等于 next_doc
+            text: 消息内容
+            role: 消息角色
+            offset: 消息在日志中的字节偏移
+            length: 消息记录的字节长度
+        """
+        self.load()
+        if doc != self.next_doc:
+            return
+        entry = _make_entry(doc, text, role, offset, length)
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+        with self.lock:
+            if doc != self.next_doc:
+                return
+            self._pending.append((doc, offset + length, line))
+            self._apply(entry)
+
+    def add_batch(self, items: List[Tuple[int, str, str, int, int]]) -> bool:
+        """
+        补齐索引时批量追加消息：只更新内存、不写增量日志，调用方随后 merge() 直接写入基础索引
+
+        Args:
+            items: (文档号, 内容, 角色, 字节偏移, 字节长度) 列表，文档号须从 next_doc 起连续
+
+        Returns:
+            是否全部追加（索引被并发清空或序号对不上时返回False）
+        """
+        self.load()
+        entries = [_make_entry(*item) for item in items]
+        with self.lock:
+            for entry in entries:
+                if entry["d"] != self.next_doc:
+                    return False
+                self._apply(entry)
+        return True
+
+    def flush_delta(self, size: Optional[int] = None, fsync: bool = False) -> None:
+        """
+        写出缓冲中的增量行
+
+        Args:
+            size: 历史日志已写盘的大小，只写出记录已落盘的增量；None 表示全部写出
+            fsync: 是否 fsync
+        """
+        with self.lock:
+            if self._pending:
+                count = len(self._pending)
+                if size is not None:
+                    count = 0
+                    while count < len(self._pending) and self._pending[count][1] <= size:
+                        count += 1
+                if count:
+                    if self._delta_file is None:
+                        os.makedirs(self.dir, exist_ok=True)
+                        self._delta_file = open(self._path("delta.log"), "ab")
+                    self._delta_file.write(b"".join(line for _, _, line in self._pending[:count]))
+                    self._delta_file.flush()
+                    del self._pending[:count]
+            if fsync and self._delta_file is not None:
+                os.fsync(self._delta_file.fileno())
+
+    def _base_postings(self, term: str, terms=None, postings=None, tf_map=None) -> Tuple[array, array]:
+        start, count = (self.terms if terms is None else terms).get(term, (0, 0))
+        postings = self._postings if postings is None else postings
+        tf_map = self._tfs if tf_map is None else tf_map
+        docs, tfs = array("I"), array("H")
+        if count and postings is not None:
+            docs.frombytes(postings[start * 4:(start + count) * 4])
+            tfs.frombytes(tf_map[start * 2:(start + count) * 2])
+        return docs, tfs
+
+    def search(self, query_terms: List[str], limit: int, role: Optional[str] = None,
+               max_doc: Optional[int] = None) -> List[Tuple[int, float]]:
+        """
+        BM25 检索
+
+        Args:
+            query_terms: 检索词
+            limit: 最多返回的结果数
+            role: 只返回该角色的消息
+            max_doc: 只返回序号小于该值的消息（调用方读取记录时的快照）
+
+        Returns:
+            [(文档号, 得分)]，按得分降序
+        """
+        with self.lock:
+            n = self.next_doc
+            if n == 0:
+                return []
+            avg_len = max(self.total_len / n, 1.0)
+            role_code = _ROLE_CODES.get(role) if role else None
+            scores: Dict[int, float] = defaultdict(float)
+            postings = []
+            for term in set(query_terms):
+                docs, tfs = self._base_postings(term)
+                delta = self.delta.get(term, [])
+                df = len(docs) + len(delta)
+                if df:
+                    postings.append((df, term, docs, tfs, delta))
+            # 出现在过半消息中的词几乎没有区分度，有其他词时跳过以控制耗时
+            if len(postings) > 1:
+                postings = [p for p in postings if p[0] <= n * 0.5] or postings
+            doc_lens = self.doc_lens
+            for df, term, docs, tfs, delta in postings:
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                for doc, tf in zip(docs, tfs):
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lens[doc] / avg_len)
+                    scores[doc] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+                for doc, tf in delta:
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lens[doc] / avg_len)
+                    scores[doc] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+            if role_code is not None or max_doc is not None:
+                scores = {d: s for d, s in scores.items()
+                          if (role_code is None or self.doc_roles[d] == role_code)
+                          and (max_doc is None or d < max_doc)}
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+            return ranked[:limit]
+
+    def doc_info(self, doc: int) -> Dict[str, Any]:
+        """文档表中的位置信息"""
+        with self.lock:
+            return {
+                "offset": self.doc_offsets[doc],
+                "length": self.doc_lengths[doc],
+                "role": _ROLE_NAMES.get(self.doc_roles[doc], "system"),
+            }
+
+    def merge(self) -> None:
+        """
+        把增量合并进基础索引
+
+        在锁内取快照，锁外写出新一代倒排表与文档表，再在锁内切换词典与 mmap，
+        并从内存与增量日志中去掉已合并的部分；合并期间新增的消息保留在增量中
+        """
+        with self.merge_lock:
+            with self.lock:
+                if not self.loaded or not self.delta_docs:
+                    return
+                epoch = self._epoch
+                upto = self.next_doc
+                total_len = self.total_len
+                generation = self.generation + 1
+                old_terms, old_postings, old_tfs = self.terms, self._postings, self._tfs
+                delta = {term: list(items) for term, items in self.delta.items()}
+                doc_table = (self.doc_offsets[:upto], self.doc_lengths[:upto], self.doc_lens[:upto],
+                             bytes(self.doc_roles[:upto]))
+
+            os.makedirs(self.dir, exist_ok=True)
+            names = [_generation_name(name, generation) for name in ("postings.bin", "tf.bin", "docs.bin")]
+            try:
+                terms = {}
+                pos = 0
+                with open(self._path(names[0]), "wb") as fp, open(self._path(names[1]), "wb") as ft:
+                    for term in sorted(set(old_terms) | set(delta)):
+                        docs, tfs = self._base_postings(term, old_terms, old_postings, old_tfs)
+                        for doc, tf in delta.get(term, ()):
+                            docs.append(doc)
+                            tfs.append(min(tf, 0xFFFF))
+                        docs.tofile(fp)
+                        tfs.tofile(ft)
+                        terms[term] = [pos, len(docs)]
+                        pos += len(docs)
+                    for f in (fp, ft):
+                        f.flush()
+                        os.fsync(f.fileno())
+                with open(self._path(names[2]), "wb") as f:
+                    f.write(b"".join(_DOC_STRUCT.pack(*row) for row in zip(*doc_table)))
+                    f.flush()
+                    os.fsync(f.fileno())
+            except Exception as e:
+                # 合并期间索引被清空（mmap 已关闭）或写盘失败：放弃本次合并
+                for name in names:
+                    try:
+                        os.unlink(self._path(name))
+                    except OSError:
+                        pass
+                if self._epoch == epoch:
+                    logger.error(f"合并历史检索索引失败 {self.dir}: {e}")
+                return
+
+            with self.lock:
+                if self._epoch != epoch:
+                    for name in names:
+                        try:
+                            os.unlink(self._path(name))
+                        except OSError:
+                            pass
+                    return
+                # 词典是提交点：写入后才使用新一代文件
+                atomic_write_json(self._path("lexicon.json"), {
+                    "generation": generation, "next_doc": upto, "total_len": total_len, "terms": terms
+                })
+                self.terms = {t: tuple(v) for t, v in terms.items()}
+                self.generation = generation
+                self.base_docs = upto
+                self.delta = defaultdict(list)
+                for term, items in self.delta_items_after(upto):
+                    self.delta[term] = items
+                self.delta_docs = self.next_doc - upto
+                self._pending = [item for item in self._pending if item[0] >= upto]
+                self._compact_delta_log(upto)
+                for handle in (old_postings, old_tfs):
+                    if handle is not None:
+                        handle.close()
+                self._postings = self._map(names[0])
+                self._tfs = self._map(names[1])
+                self._remove_stale_generations()
+
+    def delta_items_after(self, upto: int):
+        """增量中序号不小于 upto 的部分（调用方持有锁）"""
+        for term, items in self.delta.items():
+            kept = [item for item in items if item[0] >= upto]
+            if kept:
+                yield term, kept
+
+    def _compact_delta_log(self, upto: int) -> None:
+        """从增量日志中去掉已合并的行（调用方持有锁；未合并的部分不超过合并期间新增的消息）"""
+        if self._delta_file is not None:
+            self._delta_file.close()
+            self._delta_file = None
+        delta_file = self._path("delta.log")
+        if not os.path.exists(delta_file):
+            return
+        kept = []
+        with open(delta_file, "rb") as f:
+            for raw in f:
+                try:
+                    if raw.endswith(b"\n") and json.loads(raw.decode("utf-8")).get("d", -1) >= upto:
+                        kept.append(raw)
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    break
+        tmp = delta_file + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(b"".join(kept))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, delta_file)
+
+    def clear(self) -> None:
+        """删除整个索引"""
+        with self.lock:
+            self._reset_state()
+            if os.path.isdir(self.dir):
+                for name in os.listdir(self.dir):
+                    if name == "lexicon.json" or name.startswith("delta.log") or name.endswith(".bin"):
+                        try:
+                            os.unlink(self._path(name))
+                        except OSError:
+                            pass
+            self.loaded = True
+
+    def close(self) -> None:
+        """关闭增量日志与 mmap"""
+        with self.lock:
+            for handle in (self._delta_file, self._postings, self._tfs):
+                if handle is not None:
+                    handle.close()
+            self._delta_file = self._postings = self._tfs = None
+
+
+class HistorySearchIndex:
+    """
+    历史记录检索索引（按角色分目录）
+
+    增量写入先缓冲在内存，随历史日志的成组写盘一起追加到增量日志；
+    增量达到 merge_threshold 条时在后台线程合并进基础索引，查询不必线性扫描大量增量。
+    索引可由历史日志重建，丢失增量尾部时由调用方按 next_doc 从日志补齐。
+    """
+
+    def __init__(self, index_dir: str, merge_threshold: int = 2000):
+        """
+        初始化检索索引
+
+        Args:
+            index_dir: 索引根目录
+            merge_threshold: 增量条数达到该值时合并
+        """
+        self.index_dir = index_dir
+        self.merge_threshold = max(1, int(merge_threshold))
+        self._indexes: Dict[str, _CharacterIndex] = {}
+        self._merging = set()
+        self._lock = threading.Lock()
+
+    def get(self, character_id: str) -> _CharacterIndex:
+        """获取角色索引（首次使用时加载，增量较多时安排后台合并）"""
+        with self._lock:
+            index = self._indexes.get(character_id)
+            if index is None:
+                index = _CharacterIndex(os.path.join(self.index_dir, character_id))
+                self._indexes[character_id] = index
+        if not index.loaded:
+            index.load()
+            self._maybe_merge(character_id, index)
+        return index
+
+    def add(self, character_id: str, doc: int, record: Dict[str, Any], offset: int, length: int) -> None:
+        """索引一条新消息"""
+        try:
+            index = self.get(character_id)
+            index.add(doc, record.get("content", ""), record.get("role", ""), offset, length)
+            self._maybe_merge(character_id, index)
+        except Exception as e:
+            logger.error(f"更新历史检索索引失败: {e}")
+
+    def _maybe_merge(self, character_id: str, index: _CharacterIndex) -> None:
+        """增量达到阈值时启动后台合并（每个角色同时只有一个）"""
+        if index.delta_docs < self.merge_threshold:
+            return
+        with self._lock:
+            if character_id in self._merging:
+                return
+            self._merging.add(character_id)
+
+        def _run():
+            try:
+                index.merge()
+            except Exception as e:
+                logger.error(f"合并历史检索索引失败: {e}")
+            finally:
+                with self._lock:
+                    self._merging.discard(character_id)
+
+        threading.Thread(target=_run, name=f"history-index-merge-{character_id}", daemon=True).start()
+
+    def flush(self, character_id: str, size: Optional[int] = None) -> None:
+        """
+        写出角色缓冲中的增量行（由历史日志写盘后调用）
+
+        Args:
+            character_id: 角色ID
+            size: 历史日志已写盘的大小，None 表示全部写出
+        """
+        index = self._indexes.get(character_id)
+        if index is not None:
+            try:
+                index.flush_delta(size)
+            except Exception as e:
+                logger.error(f"写出历史检索增量失败: {e}")
+
+    def clear(self, character_id: str) -> None:
+        """删除角色索引"""
+        self.get(character_id).clear()
+
+    def flush_all(self) -> None:
+        """写出增量日志并合并增量较多的索引（用于正常退出）"""
+        for index in list(self._indexes.values()):
+            try:
+                index.flush_delta(fsync=True)
+                if index.delta_docs >= self.merge_threshold:
+                    index.merge()
+            except Exception as e:
+                logger.error(f"合并历史检索索引失败: {e}")
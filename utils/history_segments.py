@@ -0,0 +1,308 @@
+"""
+历史记录分段存储模块
+活动日志超过大小阈值后滚动为只读分段，分段可选压缩（gzip/zstd），读取时透明解压；
+每个分段记录每隔 stride 条消息的字节偏移，按消息序号分页读取时直接定位到对应分段与偏移
+"""
+import io
+import os
+import gzip
+import json
+import shutil
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from utils.persist_utils import atomic_write_json
+
+logger = logging.getLogger(__name__)
+
+# 压缩方式 -> 分段文件扩展名
+_SUFFIXES = {"": "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def open_segment(path: str):
+    """
+    以二进制方式打开分段文件，按扩展名透明解压
+
+    Args:
+        path: 分段文件路径
+
+    Returns:
+        可 seek（向前）与逐行迭代的文件对象
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"读取 {path} 需要安装 zstandard")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+    return open(path, "rb")
+
+
+def iter_records_range(f, offsets: List[int], start: int, end: int, stride: int) -> Iterator[Tuple[int, int, Dict[str, Any]]]:
+    """
+    从JSONL文件中依次读取第 start 到 end-1 条有效记录（序号从0开始）
+
+    先 seek 到不晚于 start 的最近一个索引偏移，再顺序跳过余下的记录，
+    读取量与 stride 和页大小相关，与文件总长度无关；无效行不计入序号
+
+    Args:
+        f: 二进制文件对象
+        offsets: offsets[i] 为第 i*stride 条记录的起始字节偏移
+        start: 起始序号（包含）
+        end: 结束序号（不包含）
+        stride: 偏移索引的间隔
+
+    Returns:
+        (字节偏移, 字节长度, 记录) 的迭代器
+    """
+    if end <= start:
+        return
+    slot = min(start // stride, len(offsets) - 1) if offsets else -1
+    index = slot * stride if slot >= 0 else 0
+    pos = offsets[slot] if slot >= 0 else 0
+    f.seek(pos)
+    for raw in f:
+        line_pos, pos = pos, pos + len(raw)
+        if not raw.endswith(b"\n"):
+            break
+        try:
+            record = json.loads(raw.decode("utf-8"))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            continue
+        if index >= start:
+            yield line_pos, len(raw), record
+        index += 1
+        if index >= end:
+            break
+
+
+def read_records_range(f, offsets: List[int], start: int, end: int, stride: int) -> List[Dict[str, Any]]:
+    """读取第 start 到 end-1 条有效记录，参数同 iter_records_range"""
+    return [record for _, _, record in iter_records_range(f, offsets, start, end, stride)]
+
+
+def read_record_at(f, offset: int) -> Optional[Dict[str, Any]]:
+    """读取指定字节偏移处的一条记录，无效时返回None"""
+    f.seek(offset)
+    raw = f.readline()
+    try:
+        return json.loads(raw.decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        return None
+
+
+class HistorySegmentStore:
+    """
+    历史记录分段存储
+
+    目录结构：<history_dir>/segments/<角色ID>/ 下存放 000001.jsonl[.gz|.zst] 等分段文件，
+    以及 index.json（每个分段的起始序号、消息数、偏移索引、最后时间与最后一句）。
+    分段一经写入即只读；压缩在后台线程完成，完成后原子替换索引中的文件名。
+    """
+
+    def __init__(self, history_dir: str, compression: str = "gzip"):
+        """
+        初始化分段存储
+
+        Args:
+            history_dir: 历史记录目录
+            compression: 分段压缩方式：gzip、zstd 或空字符串（不压缩）
+        """
+        self.root = os.path.join(history_dir, "segments")
+        compression = (compression or "").lower()
+        if compression == "zstd" and zstandard is None:
+            logger.warning("未安装 zstandard，历史记录分段改用 gzip 压缩")
+            compression = "gzip"
+        if compression not in _SUFFIXES:
+            logger.warning(f"未知的历史记录分段压缩方式 {compression}，不压缩")
+            compression = ""
+        self.compression = compression
+        self._lock = threading.RLock()
+        self._indexes: Dict[str, List[Dict[str, Any]]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-compress")
+
+    def _segment_dir(self, character_id: str) -> str:
+        return os.path.join(self.root, character_id)
+
+    def _index_file(self, character_id: str) -> str:
+        return os.path.join(self._segment_dir(character_id), "index.json")
+
+    def segments(self, character_id: str) -> List[Dict[str, Any]]:
+        """
+        获取角色的分段索引（按序号升序）
+
+        Args:
+            character_id: 角色ID
+
+        Returns:
+            分段信息列表
+        """
+        with self._lock:
+            index = self._indexes.get(character_id)
+            if index is None:
+                index = []
+                index_file = self._index_file(character_id)
+                if os.path.exists(index_file):
+                    try:
+                        with open(index_file, "r", encoding="utf-8") as f:
+                            index = json.load(f).get("segments", [])
+                    except Exception as e:
+                        logger.error(f"读取历史记录分段索引失败 {index_file}: {e}")
+                self._indexes[character_id] = index
+            return index
+
+    def total(self, character_id: str) -> int:
+        """分段中的消息总数（也即活动日志第一条消息的全局序号）"""
+        index = self.segments(character_id)
+        return index[-1]["start"] + index[-1]["count"] if index else 0
+
+    def last_entry(self, character_id: str) -> Optional[Dict[str, Any]]:
+        """最新一个分段的信息，没有分段时返回None"""
+        index = self.segments(character_id)
+        return index[-1] if index else None
+
+    def next_segment_path(self, character_id: str) -> str:
+        """下一个分段的（未压缩）文件路径"""
+        index = self.segments(character_id)
+        seq = int(index[-1]["name"].split(".", 1)[0]) + 1 if index else 1
+        os.makedirs(self._segment_dir(character_id), exist_ok=True)
+        return os.path.join(self._segment_dir(character_id), f"{seq:06d}.jsonl")
+
+    def register(self, character_id: str, path: str, meta: Dict[str, Any], stride: int) -> None:
+        """
+        登记一个已写入的分段，并在后台压缩
+
+        Args:
+            character_id: 角色ID
+            path: 分段文件路径（由 next_segment_path 得到）
+            meta: 滚动前活动日志的侧写（count、size、offsets、last_timestamp、last_assistant_sentence）
+            stride: 侧写偏移索引的间隔
+        """
+        with self._lock:
+            index = self.segments(character_id)
+            entry = {
+                "name": os.path.basename(path),
+                "start": self.total(character_id),
+                "count": meta.get("count", 0),
+                "bytes": meta.get("size", 0),
+                "stride": stride,
+                "offsets": list(meta.get("offsets", [])),
+                "last_timestamp": meta.get("last_timestamp"),
+                "last_assistant_sentence": meta.get("last_assistant_sentence", ""),
+            }
+            index.append(entry)
+            self._save_index(character_id)
+        if self.compression:
+            self._executor.submit(self._compress, character_id, entry["name"])
+
+    def _save_index(self, character_id: str) -> None:
+        atomic_write_json(self._index_file(character_id), {"segments": self.segments(character_id)})
+
+    def _compress(self, character_id: str, name: str) -> None:
+        """压缩分段：写临时文件后原子替换，再更新索引并删除原文件"""
+        src = os.path.join(self._segment_dir(character_id), name)
+        dest = src + _SUFFIXES[self.compression]
+        tmp = dest + ".tmp"
+        try:
+            with open(src, "rb") as fin, open(tmp, "wb") as raw:
+                if self.compression == "zstd":
+                    with zstandard.ZstdCompressor(level=10).stream_writer(raw, closefd=False) as fout:
+                        shutil.copyfileobj(fin, fout)
+                else:
+                    with gzip.GzipFile(fileobj=raw, mode="wb") as fout:
+                        shutil.copyfileobj(fin, fout)
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(tmp, dest)
+            with self._lock:
+                for entry in self.segments(character_id):
+                    if entry["name"] == name:
+                        entry["name"] = os.path.basename(dest)
+                self._save_index(character_id)
+                # 读取在锁内完成，此时没有读者打开原文件
+                os.unlink(src)
+        except Exception as e:
+            logger.error(f"压缩历史记录分段失败 {src}: {e}")
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def locate(self, character_id: str, index: int) -> Optional[Dict[str, Any]]:
+        """
+        查找包含指定全局序号的分段
+
+        Returns:
+            分段信息；序号位于活动日志中时返回None
+        """
+        segments = self.segments(character_id)
+        lo, hi = 0, len(segments)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if segments[mid]["start"] + segments[mid]["count"] <= index:
+                lo = mid + 1
+            else:
+                hi = mid
+        return segments[lo] if lo < len(segments) and segments[lo]["start"] <= index else None
+
+    def segment_path(self, character_id: str, entry: Dict[str, Any]) -> str:
+        """分段文件的当前路径（压缩完成后文件名会变化，需在锁内使用）"""
+        return os.path.join(self._segment_dir(character_id), entry["name"])
+
+    def read_at(self, character_id: str, entry: Dict[str, Any], offsets: Iterable[int]) -> Dict[int, Optional[Dict[str, Any]]]:
+        """
+        读取分段中指定字节偏移处的记录（按偏移升序读取，压缩分段只需向前解压一遍）
+
+        Returns:
+            {字节偏移: 记录}
+        """
+        with self._lock:
+            with open_segment(self.segment_path(character_id, entry)) as f:
+                return {offset: read_record_at(f, offset) for offset in sorted(set(offsets))}
+
+    def iter_range(self, character_id: str, start: int, end: int) -> Iterator[Tuple[int, Dict[str, Any], int, int, Dict[str, Any]]]:
+        """
+        按全局序号依次读取分段中的消息及其位置
+
+        Returns:
+            (全局序号, 分段信息, 字节偏移, 字节长度, 记录) 的迭代器
+        """
+        with self._lock:
+            for entry in list(self.segments(character_id)):
+                seg_start, seg_end = entry["start"], entry["start"] + entry["count"]
+                if seg_end <= start or seg_start >= end:
+                    continue
+                local_start = max(start, seg_start) - seg_start
+                with open_segment(self.segment_path(character_id, entry)) as f:
+                    items = iter_records_range(
+                        f, entry["offsets"], local_start, min(end, seg_end) - seg_start, entry["stride"]
+                    )
+                    for i, (offset, length, record) in enumerate(items):
+                        yield seg_start + local_start + i, entry, offset, length, record
+
+    def read(self, character_id: str, start: int, end: int) -> List[Dict[str, Any]]:
+        """
+        按全局序号读取分段中的消息
+
+        Args:
+            character_id: 角色ID
+            start: 起始序号（包含）
+            end: 结束序号（不包含）
+
+        Returns:
+            消息记录列表
+        """
+        return [record for _, _, _, _, record in self.iter_range(character_id, start, end)]
+
+    def clear(self, character_id: str) -> None:
+        """删除角色的全部分段"""
+        with self._lock:
+            self._indexes.pop(character_id, None)
+            shutil.rmtree(self._segment_dir(character_id), ignore_errors=True)
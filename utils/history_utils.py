@@ -7,10 +7,242 @@ import json
 import time
 import collections
 import re
+import atexit
+import threading
 from datetime import datetime
-from typing import List, Dict, Any, Optional, Deque
+from typing import List, Dict, Any, Optional, Deque, Tuple
 from pathlib import Path
 from config import get_app_config
+from utils.persist_utils import DebouncedPersister, atomic_write_json
+from utils.history_segments import HistorySegmentStore, iter_records_range, read_record_at, read_records_range
+from utils.history_search import HistorySearchIndex, make_snippet, tokenize
+
+# 侧写文件中每隔多少条消息记录一次字节偏移
+META_OFFSET_STRIDE = 256
+
+# 补齐检索索引时每块读取与分词的消息数（每块直接合并进基础索引）
+BACKFILL_CHUNK = 20000
+
+
+def read_tail_records(file_path: str, count: Optional[int] = None, block_size: int = 64 * 1024) -> List[Dict[str, Any]]:
+    """
+    从JSONL文件末尾反向按块读取，只解析最后 count 条完整记录
+
+    读取量只与 count 相关，与文件总长度无关；末尾不完整的行（写入中断）和无效行会被跳过
+
+    Args:
+        file_path: 文件路径
+        count: 需要的记录数，None 或不大于0表示读取全部
+        block_size: 每次向前读取的字节数
+
+    Returns:
+        记录列表，按文件中的顺序（从旧到新）
+    """
+    if count is not None and count <= 0:
+        count = None
+    records: List[Dict[str, Any]] = []
+
+    def _parse(raw: bytes) -> None:
+        raw = raw.strip()
+        if not raw:
+            return
+        try:
+            records.append(json.loads(raw.decode("utf-8")))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            # 忽略无效的JSON行
+            pass
+
+    with open(file_path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        remainder = b""
+        while pos > 0 and (count is None or len(records) < count):
+            size = min(block_size, pos)
+            pos -= size
+            f.seek(pos)
+            # 换行符不会出现在UTF-8多字节字符内部，按字节切分是安全的
+            lines = (f.read(size) + remainder).split(b"\n")
+            # 块的第一段可能是上一行的后半截，留到下一轮拼接
+            remainder = lines.pop(0)
+            for raw in reversed(lines):
+                _parse(raw)
+                if count is not None and len(records) >= count:
+                    break
+        if pos == 0 and (count is None or len(records) < count):
+            _parse(remainder)
+
+    records.reverse()
+    return records
+
+
+def extract_last_assistant_sentence(raw: str) -> str:
+    """
+    从assistant原始回复（JSON或纯文本）中提取最后一句话
+
+    Args:
+        raw: 历史记录中保存的原始回复
+
+    Returns:
+        最后一句话，无内容时为空字符串
+    """
+    text = ""
+    if raw:
+        text = str(raw)
+        try:
+            obj = json.loads(raw)
+            if isinstance(obj, dict) and isinstance(obj.get("content"), str):
+                text = obj["content"]
+            elif isinstance(obj, str):
+                text = obj
+        except Exception:
+            pass
+    text = re.sub(r"\s+", " ", text).strip()
+    if not text:
+        return ""
+    sentence_endings = ['。', '！', '？', '!', '?', '.', '…', '♪', '...']
+    escaped = ''.join(re.escape(ch) for ch in sentence_endings)
+    m = re.search(rf"([^ {escaped}]+(?:[{escaped}]+)?)$", text)
+    return m.group(1).strip() if m else text
+
+
+def get_history_meta_file(history_dir: str, character_id: str) -> str:
+    """角色历史记录侧写文件路径"""
+    return os.path.join(history_dir, f"{character_id}_history.meta.json")
+
+
+def load_history_metadata(history_dir: str, character_id: str) -> Optional[Dict[str, Any]]:
+    """
+    读取角色历史记录侧写（O(1)，不读取历史日志本身）
+
+    Args:
+        history_dir: 历史记录存储目录
+        character_id: 角色ID
+
+    Returns:
+        侧写字典（count、last_timestamp、last_assistant_sentence、size、offsets）；
+        侧写不存在或与日志文件大小不一致（已过期）时返回None
+    """
+    history_file = os.path.join(history_dir, f"{character_id}_history.log")
+    try:
+        with open(get_history_meta_file(history_dir, character_id), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        size = os.path.getsize(history_file) if os.path.exists(history_file) else 0
+        return meta if meta.get("size") == size else None
+    except (OSError, ValueError):
+        return None
+
+
+class HistoryAppender:
+    """
+    单个历史日志的长期追加写入器
+
+    保持文件句柄打开，消息先进入内存缓冲，按持久化策略成组写盘：
+    累计 flush_records 条、由外部定时器在 flush_ms 后触发，或 durable 写入（如assistant回复完成）时立即写盘并 fsync。
+    """
+
+    def __init__(self, path: str, flush_records: int = 16, on_flush=None):
+        """
+        初始化写入器
+
+        Args:
+            path: 日志文件路径
+            flush_records: 缓冲达到多少条时立即写盘
+            on_flush: 写盘后的回调，参数为写盘后的文件大小
+        """
+        self.path = path
+        self.flush_records = max(1, int(flush_records))
+        self.on_flush = on_flush
+        self._lock = threading.RLock()
+        self._buffer: List[bytes] = []
+        self._file = None
+        self._disk_size = os.path.getsize(path) if os.path.exists(path) else 0
+        self._size = self._disk_size
+
+    @property
+    def size(self) -> int:
+        """逻辑大小：已写盘字节数加缓冲中的字节数"""
+        return self._size
+
+    @property
+    def pending(self) -> int:
+        """缓冲中的记录数"""
+        return len(self._buffer)
+
+    def append(self, data: bytes, durable: bool = False) -> int:
+        """
+        追加一条记录
+
+        Args:
+            data: 完整的一行（含换行符）
+            durable: 是否立即写盘并 fsync
+
+        Returns:
+            该记录在文件中的起始字节偏移
+        """
+        with self._lock:
+            offset = self._size
+            self._buffer.append(data)
+            self._size += len(data)
+            need_flush = durable or len(self._buffer) >= self.flush_records
+        if need_flush:
+            self.flush(fsync=durable)
+        return offset
+
+    def flush(self, fsync: bool = False) -> None:
+        """把缓冲写入文件；fsync 为 True 时同时落到磁盘"""
+        with self._lock:
+            flushed = self._flush_locked(fsync)
+        # 回调在释放写入锁后执行，避免与调用方持有的锁形成环
+        if flushed is not None and self.on_flush is not None:
+            self.on_flush(flushed)
+
+    def _flush_locked(self, fsync: bool) -> Optional[int]:
+        """写出缓冲（调用方已持有锁），返回写盘后的文件大小；没有数据写出时返回None"""
+        if not self._buffer:
+            if fsync and self._file is not None:
+                os.fsync(self._file.fileno())
+            return None
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "ab")
+        self._file.write(b"".join(self._buffer))
+        self._buffer.clear()
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+        self._disk_size = self._size
+        return self._disk_size
+
+    def truncate(self) -> None:
+        """丢弃缓冲并清空文件"""
+        with self._lock:
+            self._buffer.clear()
+            self.close()
+            with open(self.path, "w", encoding="utf-8"):
+                pass
+            self._disk_size = self._size = 0
+
+    def rotate(self, dest: str) -> None:
+        """写出缓冲并把当前文件整体移动为 dest，随后从空文件继续追加"""
+        with self._lock:
+            self._flush_locked(fsync=True)
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            os.replace(self.path, dest)
+            # 立即创建空的活动日志，保留“有历史记录”的文件状态
+            with open(self.path, "w", encoding="utf-8"):
+                pass
+            self._disk_size = self._size = 0
+
+    def close(self) -> None:
+        """写出缓冲并关闭文件句柄"""
+        with self._lock:
+            self._flush_locked(fsync=False)
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
 
 class HistoryManager:
     """历史记录管理器"""
@@ -26,6 +258,36 @@ class HistoryManager:
         self._ensure_history_dir()
         # 缓存各角色的历史记录
         self.history_cache: Dict[str, Deque[Dict[str, Any]]] = {}
+        # 各角色历史记录侧写（消息数、最后时间、最后一句、字节偏移）
+        self._meta_cache: Dict[str, Dict[str, Any]] = {}
+        self._meta_lock = threading.RLock()
+
+        # 各角色的追加写入器与持久化策略
+        app_config = get_app_config()
+        self.flush_records = int(app_config.get("history_flush_records", 16))
+        self.fsync_on_assistant = bool(app_config.get("history_fsync_on_assistant", True))
+        self._appenders: Dict[str, HistoryAppender] = {}
+        self._appenders_lock = threading.Lock()
+        # 定时写盘：某角色缓冲首次变脏后 history_flush_ms 毫秒内写出；进程退出时全部写出
+        self._flusher = DebouncedPersister(
+            delay=float(app_config.get("history_flush_ms", 200)) / 1000.0,
+            max_pending=max(self.flush_records, 1) * 4
+        )
+        atexit.register(self.flush_all)
+
+        # 活动日志超过该大小后滚动为分段（0 表示不分段）
+        self.segment_bytes = int(app_config.get("history_segment_bytes", 4 * 1024 * 1024))
+        self.segments = HistorySegmentStore(
+            self.history_dir, compression=app_config.get("history_segment_compression", "gzip")
+        )
+
+        # 全文检索索引（随 save_message 增量更新）
+        self.search_index = None
+        if app_config.get("history_search_enabled", True):
+            self.search_index = HistorySearchIndex(
+                os.path.join(self.history_dir, "index"),
+                merge_threshold=int(app_config.get("history_index_merge_threshold", 2000))
+            )
     
     def _ensure_history_dir(self):
         """确保历史记录目录存在"""
@@ -43,6 +305,44 @@ class HistoryManager:
         """
         return os.path.join(self.history_dir, f"{character_id}_history.log")
     
+    def _get_appender(self, character_id: str) -> HistoryAppender:
+        """获取（必要时创建）角色的追加写入器"""
+        appender = self._appenders.get(character_id)
+        if appender is None:
+            with self._appenders_lock:
+                appender = self._appenders.get(character_id)
+                if appender is None:
+                    appender = HistoryAppender(
+                        self._get_character_history_file(character_id),
+                        flush_records=self.flush_records,
+                        on_flush=lambda size, cid=character_id: self._on_flushed(cid, size)
+                    )
+                    self._appenders[character_id] = appender
+        return appender
+
+    def flush(self, character_id: str, fsync: bool = False) -> None:
+        """
+        把角色缓冲中的消息写入日志文件
+
+        Args:
+            character_id: 角色ID
+            fsync: 是否同时 fsync
+        """
+        appender = self._appenders.get(character_id)
+        if appender is not None:
+            appender.flush(fsync=fsync)
+
+    def flush_all(self) -> None:
+        """写出并 fsync 所有角色的缓冲（用于正常退出）"""
+        self._flusher.flush()
+        for appender in list(self._appenders.values()):
+            try:
+                appender.flush(fsync=True)
+            except Exception as e:
+                print(f"写出历史记录失败: {e}")
+        if self.search_index is not None:
+            self.search_index.flush_all()
+
     def _initialize_cache(self, character_id: str, max_size: int) -> None:
         """
         初始化角色历史记录缓存
@@ -56,26 +356,20 @@ class HistoryManager:
             
         # 获取历史记录文件路径
         history_file = self._get_character_history_file(character_id)
+        # 先写出缓冲，保证从文件读到全部消息
+        self.flush(character_id)
         
-        # 如果文件不存在，创建空缓存
-        if not os.path.exists(history_file):
-            self.history_cache[character_id] = collections.deque(maxlen=max_size)
-            return
-        
-        # 读取历史记录
-        messages = []
+        # 从文件末尾读取最近的max_size条消息，耗时与历史总长度无关
         try:
-            with open(history_file, "r", encoding="utf-8") as f:
-                for line in f:
-                    line = line.strip()
-                    if line:
-                        try:
-                            message = json.loads(line)
-                            # 保留完整消息记录
-                            messages.append(message)
-                        except json.JSONDecodeError:
-                            # 忽略无效的JSON行
-                            continue
+            messages = []
+            if os.path.exists(history_file):
+                messages = read_tail_records(history_file, max_size if max_size > 0 else None)
+            # 活动日志刚滚动过时，不足的部分从最新的分段补齐
+            if max_size > 0 and len(messages) < max_size:
+                base = self.segments.total(character_id)
+                if base > 0:
+                    need = max_size - len(messages)
+                    messages = self.segments.read(character_id, max(0, base - need), base) + messages
         except Exception as e:
             print(f"加载历史记录失败: {e}")
             messages = []
@@ -125,17 +419,311 @@ class HistoryManager:
             "content": content
         }
         
-        # 获取历史记录文件路径
-        history_file = self._get_character_history_file(character_id)
-        
-        # 写入历史记录文件
-        with open(history_file, "a", encoding="utf-8") as f:
-            f.write(json.dumps(message_record, ensure_ascii=False) + "\n")
+        # 写入历史记录（成组写盘；assistant回复完成时按策略立即 fsync）
+        line = (json.dumps(message_record, ensure_ascii=False) + "\n").encode("utf-8")
+        appender = self._get_appender(character_id)
+        with self._meta_lock:
+            # 先更新侧写再追加，写盘回调看到的侧写已包含本条消息
+            offset = appender.size
+            self._update_metadata(character_id, message_record, offset, offset + len(line))
+            # 先计入检索索引，增量行与本条记录在同一次写盘中写出
+            if self.search_index is not None:
+                meta = self._meta_cache.get(character_id)
+                if meta is not None and meta.get("size") == offset + len(line):
+                    doc = self.segments.total(character_id) + meta["count"] - 1
+                    self.search_index.add(character_id, doc, message_record, offset, len(line))
+            appender.append(line, durable=self.fsync_on_assistant and role == "assistant")
+            if self.segment_bytes > 0 and appender.size >= self.segment_bytes:
+                self._rotate(character_id, appender)
+        if appender.pending:
+            self._flusher.mark_dirty(character_id, lambda: appender.flush())
         
         # 更新内存缓存
         if character_id in self.history_cache:
             self.history_cache[character_id].append(message_record)
     
+    def get_metadata(self, character_id: str) -> Dict[str, Any]:
+        """
+        获取角色历史记录侧写；侧写缺失或过期时全量扫描一次日志重建
+
+        Args:
+            character_id: 角色ID
+
+        Returns:
+            侧写字典：count、last_timestamp、last_assistant_sentence、size、offsets
+            （offsets[i] 为第 i*META_OFFSET_STRIDE 条消息的起始字节偏移）
+        """
+        with self._meta_lock:
+            meta = self._meta_cache.get(character_id)
+            appender = self._appenders.get(character_id)
+            if appender is not None:
+                size = appender.size
+            else:
+                history_file = self._get_character_history_file(character_id)
+                size = os.path.getsize(history_file) if os.path.exists(history_file) else 0
+            if meta is None or meta.get("size") != size:
+                self.flush(character_id)
+                meta = load_history_metadata(self.history_dir, character_id) or self._rebuild_metadata(character_id)
+                self._meta_cache[character_id] = meta
+            return dict(meta)
+
+    def _rebuild_metadata(self, character_id: str) -> Dict[str, Any]:
+        """全量扫描日志重建侧写并写入侧写文件"""
+        meta = {"count": 0, "last_timestamp": None, "last_assistant_sentence": "", "size": 0, "offsets": []}
+        last_segment = self.segments.last_entry(character_id)
+        if last_segment is not None:
+            meta["last_timestamp"] = last_segment.get("last_timestamp")
+            meta["last_assistant_sentence"] = last_segment.get("last_assistant_sentence", "")
+        history_file = self._get_character_history_file(character_id)
+        if os.path.exists(history_file):
+            with open(history_file, "rb") as f:
+                offset = 0
+                for raw in f:
+                    line_offset, offset = offset, offset + len(raw)
+                    if not raw.endswith(b"\n"):
+                        break  # 不完整的末行不计入，下次写入后会再次校验
+                    try:
+                        record = json.loads(raw.decode("utf-8"))
+                    except (UnicodeDecodeError, json.JSONDecodeError):
+                        meta["size"] = offset
+                        continue
+                    self._apply_record(meta, record, line_offset, offset)
+            meta["size"] = os.path.getsize(history_file)
+        self._write_metadata(character_id, meta)
+        return meta
+
+    @staticmethod
+    def _apply_record(meta: Dict[str, Any], record: Dict[str, Any], offset: int, end: int) -> None:
+        """把一条消息计入侧写"""
+        if meta["count"] % META_OFFSET_STRIDE == 0:
+            meta["offsets"].append(offset)
+        meta["count"] += 1
+        meta["size"] = end
+        if record.get("timestamp"):
+            meta["last_timestamp"] = record["timestamp"]
+        if record.get("role") == "assistant":
+            meta["last_assistant_sentence"] = extract_last_assistant_sentence(record.get("content", ""))
+
+    def _update_metadata(self, character_id: str, record: Dict[str, Any], offset: int, end: int) -> None:
+        """追加消息后增量更新内存中的侧写；侧写文件在日志写盘后同步写出"""
+        try:
+            with self._meta_lock:
+                meta = self._meta_cache.get(character_id)
+                if meta is None:
+                    meta = load_history_metadata(self.history_dir, character_id)
+                if meta is None or meta.get("size") != offset:
+                    # 侧写缺失或与日志不一致（如外部修改）：写出缓冲后重建一次
+                    self.flush(character_id)
+                    meta = self._rebuild_metadata(character_id)
+                    self._meta_cache[character_id] = meta
+                    if meta.get("size") != offset:
+                        return
+                self._apply_record(meta, record, offset, end)
+                self._meta_cache[character_id] = meta
+        except Exception as e:
+            print(f"更新历史记录侧写失败: {e}")
+
+    def _rotate(self, character_id: str, appender: HistoryAppender) -> None:
+        """把活动日志滚动为只读分段，侧写从空日志重新开始（保留最后时间与最后一句）"""
+        try:
+            with self._meta_lock:
+                meta = self._meta_cache.get(character_id)
+                if meta is None or meta.get("size") != appender.size:
+                    return
+                path = self.segments.next_segment_path(character_id)
+                appender.rotate(path)
+                # 滚动时缓冲已全部写盘，对应的检索增量也全部写出（之后的偏移属于新的活动日志）
+                if self.search_index is not None:
+                    self.search_index.flush(character_id)
+                self.segments.register(character_id, path, meta, META_OFFSET_STRIDE)
+                meta = {
+                    "count": 0, "last_timestamp": meta.get("last_timestamp"),
+                    "last_assistant_sentence": meta.get("last_assistant_sentence", ""),
+                    "size": 0, "offsets": []
+                }
+                self._meta_cache[character_id] = meta
+                self._write_metadata(character_id, meta)
+            print(f"{character_id} 的历史记录已滚动为分段 {os.path.basename(path)}")
+        except Exception as e:
+            print(f"滚动历史记录分段失败: {e}")
+
+    def read_page(self, character_id: str, before: Optional[int] = None, limit: int = 20) -> Dict[str, Any]:
+        """
+        分页读取历史记录（按全局消息序号，从新到旧翻页）
+
+        直接定位到对应分段与偏移读取，不加载整个历史
+
+        Args:
+            character_id: 角色ID
+            before: 只返回序号小于该值的消息，None 表示从最新一条开始
+            limit: 每页消息数
+
+        Returns:
+            {"messages": [...], "start": 本页第一条的序号, "total": 消息总数, "has_more": 是否还有更早的消息}
+        """
+        # 与 search() 相同：_meta_lock 只用于取快照，读取与解压分段在锁外进行，不阻塞写入
+        active = None
+        with self._meta_lock:
+            self.flush(character_id)
+            meta = self.get_metadata(character_id)
+            base = self.segments.total(character_id)
+            total = base + meta["count"]
+            before = total if before is None else max(0, min(int(before), total))
+            start = max(0, before - max(1, int(limit)))
+            if before > base:
+                # 偏移表随写入增长、滚动后被替换，取副本；打开的句柄在活动日志被滚动为分段后仍指向同一份数据
+                offsets = list(meta["offsets"])
+                active = open(self._get_character_history_file(character_id), "rb")
+
+        messages = []
+        try:
+            if start < base:
+                messages.extend(self.segments.read(character_id, start, min(before, base)))
+            if active is not None:
+                messages.extend(read_records_range(
+                    active, offsets, max(start, base) - base, before - base, META_OFFSET_STRIDE
+                ))
+        finally:
+            if active is not None:
+                active.close()
+        for i, message in enumerate(messages):
+            message["index"] = start + i
+        return {"messages": messages, "start": start, "total": total, "has_more": start > 0}
+
+    def search(self, character_id: str, query: str, limit: int = 20, role: Optional[str] = None) -> Dict[str, Any]:
+        """
+        全文检索历史记录
+
+        Args:
+            character_id: 角色ID
+            query: 检索文本
+            limit: 最多返回的结果数
+            role: 只检索该角色的消息（user/assistant），None 表示不限
+
+        Returns:
+            {"hits": [{"index", "score", "role", "timestamp", "snippet", "segment", "offset", "length"}], "total": 消息总数}
+            segment 为所在分段文件名，位于活动日志时为None；offset/length 为记录在该文件中的字节位置
+        """
+        terms = tokenize(query)
+        if self.search_index is None or not terms:
+            return {"hits": [], "total": 0}
+        index = self.search_index.get(character_id)
+        # _meta_lock 只用于取快照（写入也需要它），补齐、排序与读取记录都在锁外进行
+        active = None
+        with self._meta_lock:
+            self.flush(character_id)
+            meta = self.get_metadata(character_id)
+            base = self.segments.total(character_id)
+            total = base + meta["count"]
+            if index.next_doc > total:
+                # 历史记录被外部清空或替换，索引作废
+                index.clear()
+            if total > base:
+                # 打开的句柄在活动日志随后被滚动为分段时仍指向同一份数据
+                active = open(self._get_character_history_file(character_id), "rb")
+        try:
+            if index.next_doc < total:
+                self._backfill_index(character_id, index, base, total, meta, active)
+            ranked = index.search(terms, limit, role, max_doc=total)
+
+            # 按所在文件分组，每个文件只打开一次读取命中的记录
+            groups: Dict[Optional[str], List[Tuple[int, float, Dict[str, Any]]]] = collections.defaultdict(list)
+            entries = {}
+            for doc, score in ranked:
+                entry = self.segments.locate(character_id, doc) if doc < base else None
+                name = entry["name"] if entry else None
+                entries[name] = entry
+                groups[name].append((doc, score, index.doc_info(doc)))
+            records: Dict[Tuple[Optional[str], int], Optional[Dict[str, Any]]] = {}
+            for name, items in groups.items():
+                offsets = [info["offset"] for _, _, info in items]
+                if name is None:
+                    found = {offset: read_record_at(active, offset) for offset in sorted(offsets)} if active else {}
+                else:
+                    found = self.segments.read_at(character_id, entries[name], offsets)
+                for offset, record in found.items():
+                    records[(name, offset)] = record
+        finally:
+            if active is not None:
+                active.close()
+
+        lowered_terms = sorted(set(terms), key=len, reverse=True)
+        hits = []
+        for name, items in groups.items():
+            for doc, score, info in items:
+                record = records.get((name, info["offset"])) or {}
+                hits.append({
+                    "index": doc,
+                    "score": round(score, 4),
+                    "role": record.get("role", info["role"]),
+                    "timestamp": record.get("timestamp"),
+                    "snippet": make_snippet(record.get("content", ""), lowered_terms),
+                    "segment": name,
+                    "offset": info["offset"],
+                    "length": info["length"],
+                })
+        hits.sort(key=lambda hit: (-hit["score"], -hit["index"]))
+        return {"hits": hits, "total": total}
+
+    def _backfill_index(self, character_id: str, index, base: int, total: int,
+                        meta: Dict[str, Any], active) -> None:
+        """
+        从历史日志补齐检索索引中缺失的消息（首次启用或增量尾部丢失时）
+
+        不持有 _meta_lock：按 BACKFILL_CHUNK 分块读取与分词，每块直接合并进基础索引（不写增量日志）；
+        同一角色的补齐由 index.backfill_lock 串行。补齐期间新写入的消息暂不入索引，下次检索时接着补齐。
+
+        Args:
+            character_id: 角色ID
+            index: 角色检索索引
+            base: 快照时分段中的消息数
+            total: 快照时的消息总数
+            meta: 快照时的活动日志侧写
+            active: 快照时打开的活动日志句柄（total > base 时）
+        """
+        with index.backfill_lock:
+            start = index.next_doc
+            if start >= total:
+                return
+            print(f"补齐 {character_id} 的历史检索索引: {start} -> {total}")
+            offsets = list(meta["offsets"])
+            while start < total:
+                end = min(total, start + BACKFILL_CHUNK)
+                # 先读出整块再分词，读取分段时持有的分段锁不会阻塞滚动
+                items = []
+                if start < base:
+                    items.extend(
+                        (doc, record.get("content", ""), record.get("role", ""), offset, length)
+                        for doc, _, offset, length, record in self.segments.iter_range(character_id, start, min(end, base))
+                    )
+                if end > base and active is not None:
+                    local_start = max(start, base) - base
+                    for i, (offset, length, record) in enumerate(iter_records_range(
+                            active, offsets, local_start, end - base, META_OFFSET_STRIDE)):
+                        items.append((base + local_start + i, record.get("content", ""),
+                                      record.get("role", ""), offset, length))
+                if not items or not index.add_batch(items):
+                    # 日志与侧写对不上或索引被并发清空：停止，下次检索时重试
+                    break
+                index.merge()
+                start = index.next_doc
+
+    def _on_flushed(self, character_id: str, size: int) -> None:
+        """日志写盘后写出与之一致的侧写（侧写的 size 必须等于文件大小）"""
+        with self._meta_lock:
+            meta = self._meta_cache.get(character_id)
+            if meta is not None and meta.get("size") == size:
+                self._write_metadata(character_id, meta)
+        # 检索增量随同一次成组写盘写出，只写记录已落盘的部分
+        if self.search_index is not None:
+            self.search_index.flush(character_id, size)
+
+    def _write_metadata(self, character_id: str, meta: Dict[str, Any]) -> None:
+        try:
+            atomic_write_json(get_history_meta_file(self.history_dir, character_id), meta)
+        except Exception as e:
+            print(f"写入历史记录侧写失败: {e}")
+
     def save_message_to_file(self, file_path: str, role: str, content: str) -> None:
         """
         保存消息到指定文件
@@ -178,24 +766,12 @@ class HistoryManager:
         if not os.path.exists(file_path):
             return []
         
-        # 读取历史记录
-        messages = []
+        # 从文件末尾读取最近的count条消息
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                for line in f:
-                    line = line.strip()
-                    if line:
-                        try:
-                            message = json.loads(line)
-                            messages.append(message)
-                        except json.JSONDecodeError:
-                            continue
+            return read_tail_records(file_path, count if count > 0 else None)
         except Exception as e:
             print(f"加载历史记录失败: {e}")
             return []
-        
-        # 返回最近的count条消息
-        return messages[-count:] if count > 0 and len(messages) > count else messages
     
     def load_history(self, character_id: str, count: int = 10, max_cache_size: int = 100) -> List[Dict[str, Any]]:
         """
@@ -239,20 +815,52 @@ class HistoryManager:
         # 获取历史记录文件路径
         history_file = self._get_character_history_file(character_id)
         
-        # 如果文件不存在，返回True
-        if not os.path.exists(history_file):
+        appender = self._appenders.get(character_id)
+        
+        # 删除已滚动的分段与检索索引
+        self.segments.clear(character_id)
+        if self.search_index is not None:
+            self.search_index.clear(character_id)
+        
+        # 如果文件不存在且没有待写消息，返回True
+        if not os.path.exists(history_file) and (appender is None or not appender.pending):
             return True
         
-        # 清空文件
+        # 清空文件（连同尚未写盘的缓冲）
         try:
-            with open(history_file, "w", encoding="utf-8") as f:
-                pass
+            if appender is not None:
+                appender.truncate()
+            else:
+                with open(history_file, "w", encoding="utf-8") as f:
+                    pass
             
             # 清空缓存
             if character_id in self.history_cache:
                 self.history_cache[character_id].clear()
+            with self._meta_lock:
+                meta = {"count": 0, "last_timestamp": None, "last_assistant_sentence": "", "size": 0, "offsets": []}
+                self._meta_cache[character_id] = meta
+                self._write_metadata(character_id, meta)
                 
             return True
         except Exception as e:
             print(f"清空历史记录失败: {e}")
-            return False
\ No newline at end of file
+            return False
+
+
+def create_history_manager(history_dir: str):
+    """
+    按 STORAGE_CONFIG 创建历史记录管理器
+
+    Args:
+        history_dir: 历史记录目录（文件后端使用）
+
+    Returns:
+        HistoryManager，或选择 sqlite 后端时的 SQLiteHistoryManager
+    """
+    from utils.sqlite_storage import SQLiteHistoryManager, get_storage
+
+    storage = get_storage()
+    if storage is not None:
+        return SQLiteHistoryManager(storage)
+    return HistoryManager(history_dir)
@@ -0,0 +1,525 @@
+"""
+上游模型调用的准入控制
+按服务商（base_url + API密钥）限制并发数与请求速率（令牌桶），请求按优先级排队：
+对话 > 选项生成 > 记忆写入 > 批量建库。等待队列有上限，排不上或等待超时的请求立即失败，
+高优先级请求到来而队列已满时挤掉最低优先级的等待者，避免请求堆积和 429 重试风暴。
+"""
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+from urllib.parse import urlparse
+from pathlib import Path
+import sys
+
+# 添加项目根目录到系统路径
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from config import get_governor_config
+
+# 优先级（数值越小越优先）
+PRIORITIES = {"chat": 0, "options": 1, "ingest": 2, "bulk": 3}
+
+# 当前调用链的优先级：嵌入/精排等共用客户端按调用场景区分（对话中的召回为 chat，写入记忆为 ingest）
+_current_priority: ContextVar[str] = ContextVar("llm_priority", default="chat")
+
+
+class GovernorRejected(Exception):
+    """请求未获准入（队列已满、等待超时或被更高优先级请求挤掉）"""
+
+    def __init__(self, message: str, provider: str = "", priority: str = ""):
+        self.message = message
+        self.provider = provider
+        self.priority = priority
+        super().__init__(message)
+
+
+class TokenBucket:
+    """令牌桶：rate 为每秒补充的令牌数，burst 为桶容量"""
+
+    def __init__(self, rate: float, burst: float):
+        """
+        初始化令牌桶
+
+        Args:
+            rate: 每秒补充令牌数（<=0 表示不限速）
+            burst: 桶容量
+        """
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        """距离可取得一个令牌还需等待的秒数（0 表示现在即可）"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        """取走一个令牌（调用前 wait_time 须为 0）"""
+        if self.rate > 0:
+            self.tokens -= 1
+
+    def pause(self, now: float, seconds: float) -> None:
+        """服务商返回 429 后暂停发放令牌"""
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0.0
+        self.updated = now
+
+
+class _Waiter:
+    """排队中的请求；异步等待者带有事件循环与 future，由限流器跨线程唤醒"""
+    __slots__ = ("priority", "enqueued", "granted", "rejected", "loop", "future")
+
+    def __init__(self, priority: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.rejected: Optional[str] = None
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+
+
+def _resolve(future: "asyncio.Future") -> None:
+    """在事件循环线程中结束 future（已取消或已完成时忽略）"""
+    if not future.done():
+        future.set_result(None)
+
+
+class Permit:
+    """准入凭证：持有期间占用一个并发名额，release() 后归还（可重复调用）"""
+
+    def __init__(self, limiter: "ProviderLimiter"):
+        self._limiter = limiter
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._limiter.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class ProviderLimiter:
+    """单个服务商的并发、速率与优先级队列"""
+
+    def __init__(self, name: str, config: Dict[str, Any]):
+        """
+        初始化限流器
+
+        Args:
+            name: 服务商标识
+            config: 限流配置（见 config.GOVERNOR_CONFIG）
+        """
+        self.name = name
+        self.max_concurrency = max(1, int(config.get("max_concurrency", 8)))
+        self.bucket = TokenBucket(config.get("rate", 5.0), config.get("burst", 10))
+        self.queue_limits = {p: int(n) for p, n in config.get("queue_limits", {}).items()}
+        self.max_wait = {p: float(s) for p, s in config.get("max_wait", {}).items()}
+        self.max_queue = int(config.get("max_queue", 64))
+        self.cooldown = float(config.get("cooldown_on_429", 5))
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        self._queues = {p: deque() for p in PRIORITIES.values()}
+        self._names = {v: k for k, v in PRIORITIES.items()}
+        # 统计
+        self.admitted = {p: 0 for p in PRIORITIES}
+        self.rejected = {p: 0 for p in PRIORITIES}
+        self.shed = {p: 0 for p in PRIORITIES}
+        self.rate_limited = 0
+        self._queue_times = {p: deque(maxlen=200) for p in PRIORITIES}
+
+    def _waiting(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def _head(self) -> Optional[_Waiter]:
+        """当前最应获得准入的等待者（最高优先级队列的队首）"""
+        for p in sorted(self._queues):
+            if self._queues[p]:
+                return self._queues[p][0]
+        return None
+
+    def _shed_lower(self, priority: int) -> bool:
+        """挤掉一个比 priority 低的最新等待者，成功返回True"""
+        for p in sorted(self._queues, reverse=True):
+            if p <= priority:
+                return False
+            if self._queues[p]:
+                victim = self._queues[p].pop()
+                victim.rejected = "被更高优先级的请求挤出队列"
+                self.shed[self._names[p]] += 1
+                self._wake(victim)
+                return True
+        return False
+
+    def _wake(self, waiter: _Waiter) -> None:
+        """唤醒已获准或被拒绝的等待者（调用方持有锁）"""
+        if waiter.future is None:
+            self._cond.notify_all()
+            return
+        try:
+            waiter.loop.call_soon_threadsafe(_resolve, waiter.future)
+        except RuntimeError:
+            # 事件循环已关闭，等待的协程不会再运行：收回已发放的名额
+            if waiter.granted:
+                waiter.granted = False
+                self.in_flight = max(0, self.in_flight - 1)
+
+    def _dispatch(self) -> Optional[float]:
+        """
+        按优先级顺序向队首发放准入，直到并发或令牌用尽（调用方持有锁）
+
+        Returns:
+            队首因速率限制需要等待的秒数；没有等待者或受并发限制时为None
+        """
+        now = time.monotonic()
+        while self.in_flight < self.max_concurrency:
+            head = self._head()
+            if head is None:
+                return None
+            wait = self.bucket.wait_time(now)
+            if wait > 0:
+                return wait
+            self._queues[head.priority].popleft()
+            self.bucket.take()
+            self.in_flight += 1
+            name = self._names[head.priority]
+            self.admitted[name] += 1
+            self._queue_times[name].append(now - head.enqueued)
+            head.granted = True
+            self._wake(head)
+        return None
+
+    def _enqueue(self, waiter: _Waiter, priority: str) -> None:
+        """检查队列上限后加入队列（调用方持有锁）"""
+        queue = self._queues[waiter.priority]
+        if len(queue) >= self.queue_limits.get(priority, self.max_queue):
+            self.rejected[priority] += 1
+            raise GovernorRejected(f"上游请求排队已满（{self.name}，{priority}）", self.name, priority)
+        if self._waiting() >= self.max_queue and not self._shed_lower(waiter.priority):
+            self.rejected[priority] += 1
+            raise GovernorRejected(f"上游请求排队已满（{self.name}）", self.name, priority)
+        queue.append(waiter)
+
+    def _give_up(self, waiter: _Waiter, priority: str, count_rejected: bool) -> None:
+        """等待者放弃排队（超时或被取消）：移出队列；已获准时归还名额（调用方持有锁）"""
+        if waiter.granted:
+            waiter.granted = False
+            self.in_flight = max(0, self.in_flight - 1)
+        else:
+            try:
+                self._queues[waiter.priority].remove(waiter)
+            except ValueError:
+                pass
+            if count_rejected:
+                self.rejected[priority] += 1
+        self._dispatch()
+        self._cond.notify_all()
+
+    def acquire(self, priority: str = "chat", timeout: Optional[float] = None) -> Permit:
+        """
+        申请一次上游调用的准入，阻塞直到获准
+
+        Args:
+            priority: 优先级名称（chat、options、ingest、bulk）
+            timeout: 最长等待秒数，None 时使用该优先级的配置
+
+        Returns:
+            准入凭证，调用结束后须 release()
+
+        Raises:
+            GovernorRejected: 队列已满、等待超时或被挤出队列
+        """
+        level = PRIORITIES.get(priority, PRIORITIES["chat"])
+        if timeout is None:
+            timeout = self.max_wait.get(priority, 30.0)
+        waiter = _Waiter(level)
+        deadline = waiter.enqueued + max(0.0, timeout)
+        with self._cond:
+            self._enqueue(waiter, priority)
+            while True:
+                wait = self._dispatch()
+                if waiter.granted:
+                    return Permit(self)
+                if waiter.rejected:
+                    self.rejected[priority] += 1
+                    raise GovernorRejected(f"{waiter.rejected}（{self.name}，{priority}）", self.name, priority)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._give_up(waiter, priority, True)
+                    raise GovernorRejected(f"等待上游准入超时（{self.name}，{priority}，{timeout:g}秒）", self.name, priority)
+                self._cond.wait(min(remaining, wait) if wait else remaining)
+
+    async def acquire_async(self, priority: str = "chat", timeout: Optional[float] = None) -> Permit:
+        """
+        acquire() 的协程版本：排队期间只挂起协程，不占用线程；release()/速率令牌通过
+        call_soon_threadsafe 唤醒。协程被取消时移出队列，已发放的名额立即归还
+
+        Args:
+            priority: 优先级名称
+            timeout: 最长等待秒数，None 时使用该优先级的配置
+
+        Returns:
+            准入凭证，调用结束后须 release()
+
+        Raises:
+            GovernorRejected: 队列已满、等待超时或被挤出队列
+        """
+        level = PRIORITIES.get(priority, PRIORITIES["chat"])
+        if timeout is None:
+            timeout = self.max_wait.get(priority, 30.0)
+        waiter = _Waiter(level, asyncio.get_running_loop())
+        deadline = waiter.enqueued + max(0.0, timeout)
+        with self._cond:
+            self._enqueue(waiter, priority)
+            wait = self._dispatch()
+        try:
+            while True:
+                if waiter.granted:
+                    return Permit(self)
+                if waiter.rejected:
+                    with self._cond:
+                        self.rejected[priority] += 1
+                    raise GovernorRejected(f"{waiter.rejected}（{self.name}，{priority}）", self.name, priority)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    with self._cond:
+                        if not waiter.granted:
+                            self._give_up(waiter, priority, True)
+                            raise GovernorRejected(
+                                f"等待上游准入超时（{self.name}，{priority}，{timeout:g}秒）", self.name, priority)
+                    continue
+                # 受速率限制时按令牌到达时间醒来重新发放；其余情况等待唤醒或超时
+                await asyncio.wait([waiter.future], timeout=min(remaining, wait) if wait else remaining)
+                with self._cond:
+                    wait = self._dispatch()
+        except BaseException:
+            # 取消（如客户端断开）或其他异常：不能留下排队项或未归还的名额
+            if not waiter.rejected:
+                with self._cond:
+                    if waiter.granted or waiter in self._queues[level]:
+                        self._give_up(waiter, priority, False)
+            raise
+
+    def release(self) -> None:
+        """归还并发名额"""
+        with self._cond:
+            self.in_flight = max(0, self.in_flight - 1)
+            self._dispatch()
+            self._cond.notify_all()
+
+    def report_rate_limited(self, retry_after: Optional[float] = None) -> None:
+        """
+        服务商返回 429 时调用：在 retry_after（或配置的冷却时间）内暂停发放准入
+
+        Args:
+            retry_after: 服务商给出的重试等待秒数
+        """
+        with self._cond:
+            self.rate_limited += 1
+            self.bucket.pause(time.monotonic(), retry_after if retry_after else self.cooldown)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        """限流器统计：并发、排队数与各优先级的准入/拒绝/挤出次数及排队耗时"""
+        with self._cond:
+            classes = {}
+            for name, level in PRIORITIES.items():
+                times = sorted(self._queue_times[name])
+                classes[name] = {
+                    "waiting": len(self._queues[level]),
+                    "admitted": self.admitted[name],
+                    "rejected": self.rejected[name],
+                    "shed": self.shed[name],
+                    "queue_ms_avg": round(sum(times) / len(times) * 1000, 1) if times else 0.0,
+                    "queue_ms_p95": round(times[min(len(times) - 1, int(len(times) * 0.95))] * 1000, 1) if times else 0.0,
+                    "queue_ms_max": round(times[-1] * 1000, 1) if times else 0.0,
+                }
+            return {
+                "in_flight": self.in_flight,
+                "max_concurrency": self.max_concurrency,
+                "waiting": self._waiting(),
+                "rate_limited": self.rate_limited,
+                "classes": classes,
+            }
+
+
+class LLMGovernor:
+    """按服务商管理限流器的全局入口"""
+
+    def __init__(self, config: Dict[str, Any]):
+        """
+        初始化调用治理器
+
+        Args:
+            config: 治理配置（config.GOVERNOR_CONFIG）
+        """
+        self.config = config
+        self.enabled = bool(config.get("enabled", True))
+        self._limiters: Dict[str, ProviderLimiter] = {}
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger("LLMGovernor")
+
+        # 设置日志格式
+        if not self.logger.handlers:
+            handler = logging.StreamHandler()
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            handler.setFormatter(formatter)
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+
+    @staticmethod
+    def provider_key(base_url: Optional[str], api_key: Optional[str] = None) -> str:
+        """
+        由 base_url 与 API 密钥得到服务商标识（同一服务商的不同密钥分别限流，密钥只取摘要）
+
+        Args:
+            base_url: 接口地址
+            api_key: API密钥
+
+        Returns:
+            服务商标识，如 "api.siliconflow.cn#3f2a9c1d"
+        """
+        host = urlparse(base_url or "").netloc or (base_url or "default")
+        if not api_key:
+            return host
+        return f"{host}#{hashlib.sha1(api_key.encode('utf-8')).hexdigest()[:8]}"
+
+    def limiter(self, provider: str) -> ProviderLimiter:
+        """获取（必要时创建）服务商的限流器；host 级覆盖配置见 providers"""
+        with self._lock:
+            limiter = self._limiters.get(provider)
+            if limiter is None:
+                cfg = dict(self.config)
+                overrides = self.config.get("providers", {}).get(provider.split("#")[0], {})
+                cfg.update(overrides)
+                limiter = ProviderLimiter(provider, cfg)
+                self._limiters[provider] = limiter
+            return limiter
+
+    def acquire(self, provider: str, priority: Optional[str] = None, timeout: Optional[float] = None) -> Permit:
+        """
+        申请准入（流式调用在读完或关闭流后再 release）
+
+        Args:
+            provider: 服务商标识（provider_key）
+            priority: 优先级，None 时取当前调用链的优先级
+            timeout: 最长等待秒数
+
+        Returns:
+            准入凭证
+
+        Raises:
+            GovernorRejected: 未获准入
+        """
+        priority = priority or _current_priority.get()
+        if not self.enabled:
+            return Permit(_NullLimiter)
+        try:
+            return self.limiter(provider).acquire(priority, timeout)
+        except GovernorRejected as e:
+            self.logger.warning(e.message)
+            raise
+
+    async def acquire_async(self, provider: str, priority: Optional[str] = None,
+                            timeout: Optional[float] = None) -> Permit:
+        """
+        acquire() 的协程版本（供 asgi.py 的异步流式接口使用，排队不占用线程）
+
+        Args:
+            provider: 服务商标识（provider_key）
+            priority: 优先级，None 时取当前调用链的优先级
+            timeout: 最长等待秒数
+
+        Returns:
+            准入凭证
+
+        Raises:
+            GovernorRejected: 未获准入
+        """
+        priority = priority or _current_priority.get()
+        if not self.enabled:
+            return Permit(_NullLimiter)
+        try:
+            return await self.limiter(provider).acquire_async(priority, timeout)
+        except GovernorRejected as e:
+            self.logger.warning(e.message)
+            raise
+
+    @contextmanager
+    def slot(self, provider: str, priority: Optional[str] = None, timeout: Optional[float] = None):
+        """在代码块内占用一次准入，429 时自动通知限流器后继续抛出"""
+        permit = self.acquire(provider, priority, timeout)
+        try:
+            yield permit
+        except Exception as e:
+            self.check_rate_limited(provider, e)
+            raise
+        finally:
+            permit.release()
+
+    @contextmanager
+    def priority(self, name: str):
+        """在代码块内（含其中发起的嵌入/精排等调用）使用指定优先级"""
+        token = _current_priority.set(name)
+        try:
+            yield
+        finally:
+            _current_priority.reset(token)
+
+    def check_rate_limited(self, provider: str, error: Exception) -> None:
+        """
+        若异常为 429（openai.RateLimitError 或 requests 的 HTTPError），暂停该服务商的准入
+
+        Args:
+            provider: 服务商标识
+            error: 调用异常
+        """
+        response = getattr(error, "response", None)
+        status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+        if status != 429 or not self.enabled:
+            return
+        retry_after = None
+        try:
+            retry_after = float(response.headers.get("retry-after"))
+        except Exception:
+            pass
+        self.logger.warning(f"上游限流(429)：{provider}，暂停 {retry_after or self.config.get('cooldown_on_429', 5)} 秒")
+        self.limiter(provider).report_rate_limited(retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        """全部服务商的统计"""
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {name: limiter.stats() for name, limiter in limiters.items()}
+
+
+class _NullLimiterType:
+    """未启用治理时的空限流器"""
+
+    def release(self) -> None:
+        pass
+
+
+_NullLimiter = _NullLimiterType()
+
+# 创建全局调用治理实例
+llm_governor = LLMGovernor(get_governor_config())
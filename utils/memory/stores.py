@@ -4,14 +4,20 @@ Provide minimal, file-based implementations to avoid new heavy deps.
 """
 from __future__ import annotations
 import json
+import math
 import os
-from collections import deque
+import threading
+import zlib
+from collections import defaultdict, deque
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Deque, Dict, List, Optional, Tuple, Any
 
 # Reuse existing vector DB implementation
 from utils.memory_utils import ChatHistoryVectorDB
+from utils.dedup_utils import shingles
+from utils.persist_utils import atomic_write_json, atomic_write_text, get_persister
+from utils.sqlite_storage import get_storage
 from config import get_RAG_config, get_memory_config
 
 
@@ -30,63 +36,267 @@ class ShortTermBufferStore:
         self.path = Path(root_dir) / scope_id / "buffer.json"
         self.path.parent.mkdir(parents=True, exist_ok=True)
         self._buffer: Deque[ChatTurn] = deque(maxlen=self.buffer_size)
+        self._lock = threading.Lock()
+        # SQLite backend when selected in STORAGE_CONFIG, otherwise buffer.json
+        self._db = get_storage()
         self._load()
 
     def _load(self):
-        if self.path.exists():
-            try:
+        try:
+            if self._db is not None:
+                data = self._db.get_document(self.scope_id, "buffer") or []
+            elif self.path.exists():
                 data = json.loads(self.path.read_text(encoding="utf-8"))
-                turns = [ChatTurn(**x) for x in data]
-                self._buffer = deque(turns, maxlen=self.buffer_size)
-            except Exception:
-                # corrupted file, ignore
-                self._buffer = deque(maxlen=self.buffer_size)
+            else:
+                return
+            turns = [ChatTurn(**x) for x in data]
+            self._buffer = deque(turns, maxlen=self.buffer_size)
+        except Exception:
+            # corrupted file, ignore
+            self._buffer = deque(maxlen=self.buffer_size)
 
     def _save(self):
-        try:
-            data = [vars(t) for t in self._buffer]
-            self.path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-        except Exception:
-            pass
+        # coalesced: the shared persister writes the latest snapshot after a short debounce
+        get_persister().mark_dirty(str(self.path), self._flush)
+
+    def _flush(self):
+        with self._lock:
+            data = [vars(t).copy() for t in self._buffer]
+        if self._db is not None:
+            self._db.put_document(self.scope_id, "buffer", data)
+        else:
+            atomic_write_json(self.path, data)
+
+    def flush(self):
+        """Write pending changes now."""
+        get_persister().flush(str(self.path))
 
     def add_turn(self, user: str, assistant: str, timestamp: Optional[str] = None):
-        self._buffer.append(ChatTurn(user=user, assistant=assistant, timestamp=timestamp))
+        with self._lock:
+            self._buffer.append(ChatTurn(user=user, assistant=assistant, timestamp=timestamp))
         self._save()
 
     def get_recent(self, n: Optional[int] = None) -> List[ChatTurn]:
+        with self._lock:
+            turns = list(self._buffer)
         if n is None:
-            return list(self._buffer)
-        return list(self._buffer)[-n:]
+            return turns
+        return turns[-n:]
 
 
 class SummaryStore:
-    """Hold conversation summaries as lightweight long-term memory."""
+    """Hold conversation summaries as lightweight long-term memory.
+
+    Stored as an append-only op log (summaries.jsonl): each write is one
+    appended line, and the log is rewritten only when dead records pile up.
+    An in-memory lexical + hashed n-gram index ranks summaries per query.
+    """
+    VECTOR_DIMS = 512
+    # weight of the lexical score vs the hashed n-gram cosine
+    LEXICAL_WEIGHT = 0.6
+
     def __init__(self, root_dir: str, scope_id: str):
         self.scope_id = scope_id
-        self.path = Path(root_dir) / scope_id / "summaries.json"
+        self.path = Path(root_dir) / scope_id / "summaries.jsonl"
+        self.legacy_path = Path(root_dir) / scope_id / "summaries.json"
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        self._items: List[Dict[str, Any]] = []
+        self._lock = threading.RLock()
+        self._items: Dict[int, Dict[str, Any]] = {}
+        self._next_id = 0
+        self._log_records = 0
+        # inverted index: term -> ids, plus per-item term sets and sparse vectors
+        self._postings: Dict[str, set] = defaultdict(set)
+        self._terms: Dict[int, set] = {}
+        self._vectors: Dict[int, Dict[int, float]] = {}
+        # with the SQLite backend each op is a row write instead of a log line
+        self._db = get_storage()
         self._load()
 
+    # ---- persistence -------------------------------------------------
     def _load(self):
-        if self.path.exists():
+        if self._db is not None:
             try:
-                self._items = json.loads(self.path.read_text(encoding="utf-8"))
+                for it in self._db.load_summaries(self.scope_id):
+                    self._apply({"op": "add", **it})
             except Exception:
-                self._items = []
+                self._items = {}
+            return
+        if not self.path.exists() and self.legacy_path.exists():
+            self._migrate_legacy()
+            return
+        if not self.path.exists():
+            return
+        try:
+            with self.path.open("r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        rec = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn tail line from a crash
+                    self._log_records += 1
+                    self._apply(rec)
+        except Exception:
+            self._items = {}
 
-    def _save(self):
+    def _migrate_legacy(self):
+        """One-time conversion of the old summaries.json array."""
         try:
-            self.path.write_text(json.dumps(self._items, ensure_ascii=False, indent=2), encoding="utf-8")
+            items = json.loads(self.legacy_path.read_text(encoding="utf-8"))
         except Exception:
+            items = []
+        for x in items if isinstance(items, list) else []:
+            self._apply({"op": "add", "id": self._next_id, "text": x.get("text", ""), "meta": x.get("meta") or {}})
+        self._compact()
+        try:
+            self.legacy_path.replace(self.legacy_path.with_suffix(".json.bak"))
+        except OSError:
             pass
 
-    def add_summary(self, text: str, meta: Optional[Dict[str, Any]] = None):
-        self._items.append({"text": text, "meta": meta or {}})
-        self._save()
+    def _apply(self, rec: Dict[str, Any]):
+        op, sid = rec.get("op"), rec.get("id")
+        if sid is None:
+            return
+        sid = int(sid)
+        if op == "add":
+            self._items[sid] = {"id": sid, "text": rec.get("text", ""), "meta": rec.get("meta") or {}}
+            self._index(sid)
+            self._next_id = max(self._next_id, sid + 1)
+        elif op == "meta" and sid in self._items:
+            self._items[sid]["meta"].update(rec.get("meta") or {})
+        elif op == "del" and sid in self._items:
+            self._unindex(sid)
+            del self._items[sid]
+
+    def _append(self, rec: Dict[str, Any]):
+        if self._db is not None:
+            self._write_row(rec)
+            return
+        try:
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self._log_records += 1
+        except Exception:
+            pass
+        # rewrite once most of the log no longer describes live items
+        if self._log_records > 2 * len(self._items) + 64:
+            self._compact()
+
+    def _write_row(self, rec: Dict[str, Any]):
+        """Mirror an op into the summaries table (the op is already applied in memory)."""
+        try:
+            sid = int(rec["id"])
+            if rec["op"] == "del":
+                self._db.delete_summary(self.scope_id, sid)
+            elif sid in self._items:
+                it = self._items[sid]
+                self._db.put_summary(self.scope_id, sid, it["text"], it["meta"])
+        except Exception:
+            pass
+
+    def _compact(self):
+        """Rewrite the log as one add record per live item (temp file + rename)."""
+        try:
+            lines = [json.dumps({"op": "add", **it}, ensure_ascii=False) + "\n" for it in self._items.values()]
+            atomic_write_text(self.path, "".join(lines))
+            self._log_records = len(self._items)
+        except Exception:
+            pass
+
+    # ---- index -------------------------------------------------------
+    @classmethod
+    def _vectorize(cls, text: str) -> Dict[int, float]:
+        compact = "".join(text.lower().split())
+        vec: Dict[int, float] = defaultdict(float)
+        for n in (2, 3):
+            for i in range(len(compact) - n + 1):
+                vec[zlib.crc32(compact[i:i + n].encode("utf-8")) % cls.VECTOR_DIMS] += 1.0
+        norm = math.sqrt(sum(v * v for v in vec.values()))
+        return {k: v / norm for k, v in vec.items()} if norm else {}
+
+    def _index(self, sid: int):
+        text = self._items[sid]["text"]
+        terms = set(shingles(text))
+        self._terms[sid] = terms
+        for t in terms:
+            self._postings[t].add(sid)
+        self._vectors[sid] = self._vectorize(text)
+
+    def _unindex(self, sid: int):
+        for t in self._terms.pop(sid, set()):
+            ids = self._postings.get(t)
+            if ids is not None:
+                ids.discard(sid)
+                if not ids:
+                    del self._postings[t]
+        self._vectors.pop(sid, None)
+
+    def _scores(self, query: str) -> Dict[int, float]:
+        n = len(self._items)
+        q_terms = set(shingles(query))
+        idf = {t: math.log(1 + n / len(self._postings[t])) for t in q_terms if t in self._postings}
+        total_idf = sum(math.log(1 + n) for _ in q_terms) or 1.0
+        scores: Dict[int, float] = defaultdict(float)
+        for t, w in idf.items():
+            for sid in self._postings[t]:
+                scores[sid] += self.LEXICAL_WEIGHT * w / total_idf
+        q_vec = self._vectorize(query)
+        if q_vec:
+            for sid, vec in self._vectors.items():
+                cos = sum(w * vec.get(k, 0.0) for k, w in q_vec.items())
+                if cos > 0:
+                    scores[sid] += (1 - self.LEXICAL_WEIGHT) * cos
+        return scores
 
-    def top(self, k: int = 3) -> List[str]:
-        return [x.get("text", "") for x in self._items[-k:]]
+    # ---- public API --------------------------------------------------
+    def add_summary(self, text: str, meta: Optional[Dict[str, Any]] = None) -> int:
+        with self._lock:
+            sid = self._next_id
+            rec = {"op": "add", "id": sid, "text": text, "meta": meta or {}}
+            self._apply(rec)
+            self._append(rec)
+            return sid
+
+    def set_pinned(self, sid: int, pinned: bool = True):
+        with self._lock:
+            if sid in self._items:
+                rec = {"op": "meta", "id": sid, "meta": {"pinned": bool(pinned)}}
+                self._apply(rec)
+                self._append(rec)
+
+    def remove(self, sid: int):
+        with self._lock:
+            if sid in self._items:
+                rec = {"op": "del", "id": sid}
+                self._apply(rec)
+                self._append(rec)
+
+    def top(self, query: Optional[str] = None, k: int = 3, min_score: float = 0.1) -> List[str]:
+        """Most relevant summaries for the query, pinned ones first.
+
+        Without a query this falls back to the k most recent summaries.
+        """
+        with self._lock:
+            items = list(self._items.values())
+            pinned = [it for it in reversed(items) if it["meta"].get("pinned")]
+            picked = pinned[:k]
+            if len(picked) < k:
+                rest = [it for it in items if not it["meta"].get("pinned")]
+                if query:
+                    scores = self._scores(query)
+                    ranked = sorted(
+                        (it for it in rest if scores.get(it["id"], 0.0) >= min_score),
+                        key=lambda it: (-scores[it["id"]], -it["id"]),
+                    )
+                else:
+                    ranked = list(reversed(rest))
+                picked += ranked[:k - len(picked)]
+            return [it.get("text", "") for it in picked]
+
+    def __len__(self) -> int:
+        return len(self._items)
 
 
 class ProfileStore:
@@ -94,43 +304,65 @@ class ProfileStore:
     def __init__(self, root_dir: str, scope_id: str):
         self.path = Path(root_dir) / scope_id / "profile.json"
         self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.scope_id = scope_id
         self._data: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._db = get_storage()
         self._load()
 
     def _load(self):
-        if self.path.exists():
-            try:
+        try:
+            if self._db is not None:
+                self._data = self._db.get_document(self.scope_id, "profile") or {}
+            elif self.path.exists():
                 self._data = json.loads(self.path.read_text(encoding="utf-8"))
-            except Exception:
-                self._data = {}
+        except Exception:
+            self._data = {}
 
     def _save(self):
-        try:
-            self.path.write_text(json.dumps(self._data, ensure_ascii=False, indent=2), encoding="utf-8")
-        except Exception:
-            pass
+        # coalesced: the shared persister writes the latest snapshot after a short debounce
+        get_persister().mark_dirty(str(self.path), self._flush)
+
+    def _flush(self):
+        with self._lock:
+            data = dict(self._data)
+        if self._db is not None:
+            self._db.put_document(self.scope_id, "profile", data)
+        else:
+            atomic_write_json(self.path, data)
+
+    def flush(self):
+        """Write pending changes now."""
+        get_persister().flush(str(self.path))
 
     def set(self, key: str, value: Any):
-        self._data[key] = value
+        with self._lock:
+            self._data[key] = value
         self._save()
 
     def get(self, key: str, default: Any = None) -> Any:
-        return self._data.get(key, default)
+        with self._lock:
+            return self._data.get(key, default)
 
     def to_prompt(self) -> str:
-        if not self._data:
+        with self._lock:
+            items = list(self._data.items())
+        if not items:
             return ""
-        pairs = [f"- {k}: {v}" for k, v in self._data.items()]
+        pairs = [f"- {k}: {v}" for k, v in items]
         return "[已知的长期档案/偏好]\n" + "\n".join(pairs)
 
 
 class VectorStoreAdapter:
     """Adapter wrapping the existing ChatHistoryVectorDB as a vector store."""
-    def __init__(self, scope_id: str):
+    def __init__(self, scope_id: str, db: Optional[ChatHistoryVectorDB] = None):
         self.scope_id = scope_id
-        self.db = ChatHistoryVectorDB(RAG_config=get_RAG_config(), character_name=scope_id)
-        # Ensure underlying DB exists
-        self.db.initialize_database()
+        if db is None:
+            db = ChatHistoryVectorDB(RAG_config=get_RAG_config(), character_name=scope_id)
+            # Ensure underlying DB exists
+            db.initialize_database()
+        # share the caller's instance when given, so writes and deletions are visible to recall
+        self.db = db
 
     def add_chat_turn(self, user: str, assistant: str):
         self.db.add_chat_turn(user, assistant)
@@ -139,5 +371,12 @@ class VectorStoreAdapter:
         except Exception:
             pass
 
-    def search(self, query: str, top_k: int, timeout: int) -> str:
-        return self.db.get_relevant_memory(query, top_k, timeout)
+    def search(self, query: str, top_k: int, timeout: int, deadline=None) -> str:
+        return self.db.get_relevant_memory(query, top_k, timeout, deadline=deadline)
+
+    def search_items(self, query: str, top_k: int, timeout: int, deadline=None) -> List[str]:
+        """Return ranked hit texts (best first) instead of a pre-formatted prompt."""
+        try:
+            return [r["text"] for r in self.db.search(query, top_k, timeout, deadline=deadline)]
+        except Exception:
+            return []
@@ -1,19 +1,19 @@
 import json
 import os
-import signal
 import logging
+import threading
 from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 import traceback
 from .RAG import RAG
+from .deadline_utils import Deadline, DeadlineExceeded
+from .dedup_utils import SimHashIndex, simhash
+from config import get_memory_config
 import sys
 sys.path.append(r'utils\RAG')
-class TimeoutError(Exception):
-    """超时异常"""
-    pass
 
-def timeout_handler(signum, frame):
-    """超时处理函数"""
-    raise TimeoutError("操作超时")
+# 兼容旧名称：超时异常现由协作式截止时间抛出
+TimeoutError = DeadlineExceeded
 
 class ChatHistoryVectorDB:
     def __init__(self, RAG_config: dict, model: str = None, character_name: str = "default"):
@@ -44,6 +44,21 @@ class ChatHistoryVectorDB:
         os.makedirs(self.data_memory, exist_ok=True)    
         
         self.rag = RAG(RAG_config)
+
+        # 写操作（添加/删除/压缩/保存）互斥；查询不加锁
+        self._lock = threading.RLock()
+
+        # 文档元数据（按文档id）：写入时间、最近出现时间、引用次数、SimHash指纹
+        self.doc_meta = {}
+        memory_config = get_memory_config()
+        self.dedup_enabled = bool(memory_config.get("dedup_enabled", True))
+        self.fingerprints = SimHashIndex(memory_config.get("dedup_max_distance", 3))
+        # 文本到文档id的反查表（记录召回命中用），文档映射变化后重建
+        self._text_ids: Dict[str, List[int]] = {}
+        self._text_ids_key = None
+        # 有效文档数与估算字节数的累计值（写入/删除时增减，加载与压缩时重新统计）
+        self._live_count = 0
+        self._live_bytes = 0
         
     def add_text(self, text: str):
         """
@@ -53,32 +68,29 @@ class ChatHistoryVectorDB:
             text: 要添加的文本
             metadata: 可选的元数据字典
         """
-        self.rag.add(text)
+        with self._lock:
+            self.rag.add(text)
+            self._live_count += 1
+            self._live_bytes += self.document_bytes(text)
     
-    def search(self, query: str, top_k: int = 5, timeout: int = 10):
+    def search(self, query: str, top_k: int = 5, timeout: int = 10, deadline: Deadline = None):
         """
         搜索与查询文本最相似的文本（带超时）
         
         参数:
             query: 查询文本
             top_k: 返回的最相似结果数量
-            timeout: 超时时间（秒）
+            timeout: 超时时间（秒），仅在未传入deadline时使用
+            deadline: 协作式截止时间，贯穿召回、嵌入与精排请求；可在任意线程/asyncio中使用
             
         返回:
-            包含相似结果和元数据的字典列表
-            
-        异常:
-            TimeoutError: 当操作超时时
+            包含相似结果和元数据的字典列表；超时返回空列表
         """
-        
-        # 设置超时处理（仅在非Windows系统上）
-        if os.name != 'nt':  # 非Windows系统
-            signal.signal(signal.SIGALRM, timeout_handler)
-            signal.alarm(timeout)
+        deadline = Deadline.coerce(deadline, timeout)
         
         try:
             # 获取最相似的top_k个结果
-            top_indices = self.rag.req(query=query, top_k=top_k)
+            top_indices = self.rag.req(query=query, top_k=top_k, deadline=deadline)
             
             results = []
             for text in top_indices:
@@ -86,6 +98,7 @@ class ChatHistoryVectorDB:
                     'text': text
                 }
                 results.append(result)
+            self.record_hits(top_indices)
             
             # 记录检索结果到日志
             if results:
@@ -98,13 +111,9 @@ class ChatHistoryVectorDB:
                 
             return results
             
-        except TimeoutError:
-            self.logger.warning(f"记忆检索超时 ({timeout}秒)")
+        except DeadlineExceeded as e:
+            self.logger.warning(f"记忆检索超时 ({timeout}秒): {e}")
             return []
-        finally:
-            # 取消超时设置（仅在非Windows系统上）
-            if os.name != 'nt':
-                signal.alarm(0)
     
     def save_to_file(self, file_path: str = None):
         """
@@ -115,16 +124,18 @@ class ChatHistoryVectorDB:
         """
         if file_path is None:
             file_path = self.data_memory
-        rag_save = self.rag.save_to_file(file_path)
-        data = {
-            'character_name': self.character_name,
-            'model': self.model,
-            'rag': rag_save,
-            'last_updated': datetime.now().isoformat()
-        }
-        
-        with open(os.path.join(file_path, f"{self.character_name}_memory.json"), 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        with self._lock:
+            rag_save = self.rag.save_to_file(file_path)
+            data = {
+                'character_name': self.character_name,
+                'model': self.model,
+                'rag': rag_save,
+                'doc_meta': self._dump_doc_meta(),
+                'last_updated': datetime.now().isoformat()
+            }
+            
+            with open(os.path.join(file_path, f"{self.character_name}_memory.json"), 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=4)
             
         self.logger.info(f"向量数据库已保存到 {file_path}")
 
@@ -151,6 +162,8 @@ class ChatHistoryVectorDB:
             self.model = data.get('model', self.model)
             self.logger.info(f"加载RAG缓存")
             self.rag.load_from_file(data.get('rag', None))
+            self._load_doc_meta(data.get('doc_meta') or {})
+            self._recount()
             self.logger.info(f"向量数据库加载完成，角色: {self.character_name}")
         except Exception as e:
             self.logger.error(f"加载数据库失败: {e}")
@@ -199,23 +212,249 @@ class ChatHistoryVectorDB:
     #                 print(f"跳过无法解析的行: {line}")
     #                 continue
     
-    def add_chat_turn(self, user_message: str, assistant_message: str, timestamp: str = None):
+    def record_hits(self, texts: Iterable[str]):
+        """
+        记录召回命中次数与最近命中时间（用于容量淘汰时评估记忆价值）
+
+        参数:
+            texts: 被召回的文档文本
+        """
+        if not self.doc_meta:
+            return
+        id_to_doc = self.rag.retriever.id_to_doc
+        key = (id(id_to_doc), len(id_to_doc))
+        if key != self._text_ids_key:
+            text_ids: Dict[str, List[int]] = {}
+            for doc_id, text in list(id_to_doc.items()):
+                text_ids.setdefault(text, []).append(doc_id)
+            self._text_ids, self._text_ids_key = text_ids, key
+        now = datetime.now().isoformat()
+        for text in texts:
+            for doc_id in self._text_ids.get(text, []):
+                meta = self.doc_meta.get(doc_id)
+                if meta is not None:
+                    meta['hits'] = int(meta.get('hits', 0)) + 1
+                    meta['last_hit'] = now
+
+    def document_bytes(self, text: str) -> int:
+        """单条文档的估算存储字节数：文本UTF-8长度加向量存储（维度×4字节）"""
+        vector_dim = self.config.get('Multi_Recall', {}).get('Cosine_Similarity', {}).get('vector_dim', 1024)
+        return len(text.encode('utf-8')) + 4 * int(vector_dim)
+
+    def footprint(self) -> Tuple[int, int]:
+        """
+        当前有效（未删除）文档的数量与估算字节数（读取累计值，不遍历文档）
+
+        返回:
+            (文档数, 字节数)
+        """
+        return self._live_count, self._live_bytes
+
+    def _recount(self):
+        """遍历文档重新统计有效文档数与字节数（加载和压缩后调用）"""
+        with self._lock:
+            retriever = self.rag.retriever
+            id_to_doc, tombstones = retriever.id_to_doc, retriever.tombstones
+            count = 0
+            size = 0
+            for doc_id, text in list(id_to_doc.items()):
+                if doc_id in tombstones:
+                    continue
+                count += 1
+                size += self.document_bytes(text)
+            self._live_count, self._live_bytes = count, size
+
+    def add_chat_turn(self, user_message: str, assistant_message: str, timestamp: str = None,
+                      importance: float = None) -> int:
         """
         添加一轮对话到向量数据库
+
+        与已有对话近似重复（SimHash汉明距离在阈值内）时不再建立索引，
+        只更新已有文档的引用次数和最近出现时间
         
         参数:
             user_message: 用户消息
             assistant_message: 助手回复
             timestamp: 时间戳，如果为None则使用当前时间
+            importance: 重要性评分（0~1），容量淘汰时参考
+
+        返回:
+            对话所在的文档id（近似重复时为已有文档的id）
         """
         if timestamp is None:
             timestamp = datetime.now().isoformat()
         
         # 将用户消息和助手回复组合成一个对话单元（用于向量化）
         conversation_text = f"用户: {user_message}\n助手: {assistant_message}"
-    
-        self.add_text(conversation_text)
-        self.logger.info(f"添加对话记录到向量数据库: {user_message[:50]}...")
+        fingerprint = simhash(conversation_text)
+
+        with self._lock:
+            if self.dedup_enabled:
+                duplicate_id = self.fingerprints.find(fingerprint)
+                if duplicate_id is not None:
+                    meta = self.doc_meta.setdefault(duplicate_id, {'ts': timestamp, 'ref_count': 1})
+                    meta['ref_count'] = int(meta.get('ref_count', 1)) + 1
+                    meta['last_seen'] = timestamp
+                    if importance is not None:
+                        meta['importance'] = max(float(meta.get('importance', 0.0)), importance)
+                    self.logger.info(f"对话与已有记录近似重复，合并到文档 {duplicate_id}（引用 {meta['ref_count']} 次）: {user_message[:50]}...")
+                    return duplicate_id
+
+            doc_id = len(self.rag.retriever.id_to_doc)
+            self.add_text(conversation_text)
+            self.doc_meta[doc_id] = {
+                'ts': timestamp,
+                'last_seen': timestamp,
+                'ref_count': 1,
+                'fp': fingerprint
+            }
+            if importance is not None:
+                self.doc_meta[doc_id]['importance'] = importance
+            self.fingerprints.add(doc_id, fingerprint)
+            self.logger.info(f"添加对话记录到向量数据库: {user_message[:50]}...")
+            return doc_id
+
+    def find_documents(self, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                       predicate: Optional[Callable[[int, str, dict], bool]] = None) -> List[int]:
+        """
+        查找符合条件的（未删除）文档id
+
+        参数:
+            since: 写入时间下限（含），没有写入时间的旧文档不匹配时间条件
+            until: 写入时间上限（含）
+            predicate: 自定义条件，参数为 (文档id, 文本, 元数据)
+
+        返回:
+            文档id列表
+        """
+        retriever = self.rag.retriever
+        id_to_doc, tombstones = retriever.id_to_doc, retriever.tombstones
+        matched = []
+        for doc_id, text in list(id_to_doc.items()):
+            if doc_id in tombstones:
+                continue
+            meta = self.doc_meta.get(doc_id, {})
+            if since is not None or until is not None:
+                try:
+                    ts = datetime.fromisoformat(meta['ts'])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if (since is not None and ts < since) or (until is not None and ts > until):
+                    continue
+            if predicate is not None and not predicate(doc_id, text, meta):
+                continue
+            matched.append(doc_id)
+        return matched
+
+    def delete_documents(self, ids: Iterable[int]) -> int:
+        """
+        按文档id删除（记为墓碑，查询立即跳过，空间在压缩时回收）
+
+        参数:
+            ids: 文档id
+
+        返回:
+            实际删除的数量
+        """
+        ids = [int(i) for i in ids]
+        with self._lock:
+            retriever = self.rag.retriever
+            id_to_doc, tombstones = retriever.id_to_doc, retriever.tombstones
+            live = {doc_id: id_to_doc[doc_id] for doc_id in ids if doc_id in id_to_doc and doc_id not in tombstones}
+            deleted = self.rag.delete(ids)
+            self._live_count = max(0, self._live_count - len(live))
+            self._live_bytes = max(0, self._live_bytes - sum(self.document_bytes(text) for text in live.values()))
+            for doc_id in ids:
+                self.fingerprints.remove(doc_id)
+            if deleted:
+                self.logger.info(f"删除 {deleted} 条记忆，待压缩比例 {self.dead_ratio():.0%}")
+            return deleted
+
+    def pin_documents(self, ids: Iterable[int], pinned: bool = True) -> int:
+        """
+        标记（或取消）文档置顶；置顶文档在容量淘汰时保留
+
+        参数:
+            ids: 文档id
+            pinned: True 置顶，False 取消置顶
+
+        返回:
+            状态发生变化的文档数量
+        """
+        changed = 0
+        with self._lock:
+            retriever = self.rag.retriever
+            id_to_doc, tombstones = retriever.id_to_doc, retriever.tombstones
+            for doc_id in ids:
+                doc_id = int(doc_id)
+                if doc_id not in id_to_doc or doc_id in tombstones:
+                    continue
+                meta = self.doc_meta.setdefault(doc_id, {'ref_count': 1})
+                if bool(meta.get('pinned')) != pinned:
+                    if pinned:
+                        meta['pinned'] = True
+                    else:
+                        meta.pop('pinned', None)
+                    changed += 1
+        return changed
+
+    def dead_ratio(self) -> float:
+        """已删除但尚未压缩的文档比例"""
+        return self.rag.retriever.dead_ratio()
+
+    def compact(self) -> int:
+        """
+        压缩索引：重写向量、倒排与文档映射，去掉已删除的文档，并按新id整理元数据
+
+        返回:
+            回收的文档数量
+        """
+        with self._lock:
+            before = len(self.rag.retriever.id_to_doc)
+            remap = self.rag.compact()
+            if len(remap) == before:
+                return 0
+            self.doc_meta = {remap[old]: meta for old, meta in self.doc_meta.items() if old in remap}
+            self.fingerprints = SimHashIndex(self.fingerprints.max_distance)
+            for doc_id, meta in self.doc_meta.items():
+                if 'fp' in meta:
+                    self.fingerprints.add(doc_id, meta['fp'])
+            self._recount()
+            return before - len(remap)
+
+    def _dump_doc_meta(self) -> dict:
+        """导出文档元数据；指纹存为十六进制字符串，避免超出JSON整数范围"""
+        dumped = {}
+        for doc_id, meta in self.doc_meta.items():
+            item = dict(meta)
+            if 'fp' in item:
+                item['fp'] = format(item['fp'], '016x')
+            dumped[str(doc_id)] = item
+        return dumped
+
+    def _load_doc_meta(self, data: dict):
+        """
+        加载文档元数据并重建指纹索引
+
+        参数:
+            data: save_to_file 写入的 doc_meta；旧数据没有该字段时，按现有文档补算指纹
+        """
+        self.doc_meta = {}
+        for doc_id, meta in data.items():
+            item = dict(meta)
+            if isinstance(item.get('fp'), str):
+                item['fp'] = int(item['fp'], 16)
+            self.doc_meta[int(doc_id)] = item
+
+        self.fingerprints = SimHashIndex(self.fingerprints.max_distance)
+        tombstones = self.rag.retriever.tombstones
+        for doc_id, text in self.rag.retriever.id_to_doc.items():
+            if doc_id in tombstones:
+                continue
+            meta = self.doc_meta.setdefault(doc_id, {'ref_count': 1})
+            if 'fp' not in meta:
+                meta['fp'] = simhash(text)
+            self.fingerprints.add(doc_id, meta['fp'])
     
     def initialize_database(self):
         """
@@ -224,7 +463,8 @@ class ChatHistoryVectorDB:
         self.load_from_file()
         self.logger.info(f"记忆数据库初始化完成，角色: {self.character_name}")
     
-    def get_relevant_memory(self, query: str, top_k: int = 5, timeout: int = 10, min_similarity: float = 0.3) -> str:
+    def get_relevant_memory(self, query: str, top_k: int = 5, timeout: int = 10, min_similarity: float = 0.3,
+                            deadline: Deadline = None) -> str:
         """
         获取相关记忆并格式化为提示词
         
@@ -233,12 +473,13 @@ class ChatHistoryVectorDB:
             top_k: 返回的最相似结果数量
             timeout: 超时时间（秒）
             min_similarity: 最小相似度阈值
+            deadline: 可选的协作式截止时间
             
         返回:
             格式化的记忆提示词
         """
         try:
-            results = self.search(query, top_k, timeout)
+            results = self.search(query, top_k, timeout, deadline=deadline)
             
             if not results:
                 return ""
@@ -0,0 +1,169 @@
+"""
+持久化工具模块
+提供原子写文件，以及合并多次修改、延迟批量落盘的持久化器
+"""
+import os
+import json
+import atexit
+import logging
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+def atomic_write_text(path: Union[str, Path], text: str, encoding: str = "utf-8") -> None:
+    """
+    原子写入文本文件：先写同目录临时文件并 fsync，再 os.replace 替换
+
+    进程在写入中途退出时，目标文件保持旧内容而不会出现半截文件
+
+    Args:
+        path: 目标文件路径
+        text: 文件内容
+        encoding: 编码
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=str(path.parent))
+    try:
+        with os.fdopen(fd, "w", encoding=encoding) as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def atomic_write_json(path: Union[str, Path], data: Any, indent: Optional[int] = None) -> None:
+    """
+    原子写入JSON文件
+
+    Args:
+        path: 目标文件路径
+        data: 可序列化的数据
+        indent: 缩进，默认紧凑格式
+    """
+    atomic_write_text(path, json.dumps(data, ensure_ascii=False, indent=indent))
+
+
+class DebouncedPersister:
+    """
+    合并写入的持久化器
+
+    存储在修改后调用 mark_dirty 登记写盘函数，持久化器在短暂的防抖延迟后统一落盘；
+    同一存储在延迟内的多次修改只写一次。待写修改数达到阈值时立即落盘。
+    进程退出时（atexit）以及显式调用 flush() 时同步写出全部待写数据。
+    """
+
+    def __init__(self, delay: float = 0.5, max_pending: int = 32):
+        """
+        初始化持久化器
+
+        Args:
+            delay: 防抖延迟（秒），从某个存储首次变脏开始计时
+            max_pending: 累计待写修改数达到该值时立即落盘
+        """
+        self.delay = float(delay)
+        self.max_pending = int(max_pending)
+        self._cond = threading.Condition()
+        # key -> (写盘函数, 首次变脏时间, 累计修改数)
+        self._dirty: Dict[str, tuple] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._flush_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def mark_dirty(self, key: str, flush_fn: Callable[[], None]) -> None:
+        """
+        登记一次修改
+
+        Args:
+            key: 存储的唯一标识（通常是文件路径）
+            flush_fn: 写盘函数，落盘时在后台线程调用，需自行对存储数据加锁取快照
+        """
+        with self._cond:
+            _, since, count = self._dirty.get(key, (None, time.monotonic(), 0))
+            self._dirty[key] = (flush_fn, since, count + 1)
+            self._ensure_thread()
+            self._cond.notify()
+
+    def flush(self, key: Optional[str] = None) -> None:
+        """
+        立即同步写出待写数据
+
+        Args:
+            key: 只写出指定存储，None 表示全部
+        """
+        with self._cond:
+            if key is None:
+                batch = self._dirty
+                self._dirty = {}
+            else:
+                item = self._dirty.pop(key, None)
+                batch = {key: item} if item else {}
+        self._write(batch)
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="debounced-persister", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._dirty:
+                    self._cond.wait()
+                pending = sum(count for _, _, count in self._dirty.values())
+                if pending < self.max_pending:
+                    oldest = min(since for _, since, _ in self._dirty.values())
+                    wait = oldest + self.delay - time.monotonic()
+                    if wait > 0:
+                        self._cond.wait(wait)
+                        continue
+                    now = time.monotonic()
+                    batch = {k: v for k, v in self._dirty.items() if now - v[1] >= self.delay}
+                    for k in batch:
+                        del self._dirty[k]
+                else:
+                    batch = self._dirty
+                    self._dirty = {}
+            self._write(batch)
+
+    def _write(self, batch: Dict[str, tuple]) -> None:
+        # 串行写盘，避免后台线程与 flush() 同时写同一文件
+        with self._flush_lock:
+            for key, (flush_fn, _, _) in batch.items():
+                try:
+                    flush_fn()
+                except Exception as e:
+                    logger.error(f"持久化失败 {key}: {e}")
+
+
+_persister: Optional[DebouncedPersister] = None
+_persister_lock = threading.Lock()
+
+
+def get_persister() -> DebouncedPersister:
+    """获取全局共享的持久化器（按 MEMORY_CONFIG 的防抖参数懒创建）"""
+    global _persister
+    if _persister is None:
+        with _persister_lock:
+            if _persister is None:
+                try:
+                    from config import get_memory_config
+                    cfg = get_memory_config()
+                except Exception:
+                    cfg = {}
+                _persister = DebouncedPersister(
+                    delay=float(cfg.get("persist_debounce_ms", 500)) / 1000.0,
+                    max_pending=int(cfg.get("persist_max_pending", 32))
+                )
+    return _persister
@@ -0,0 +1,306 @@
+"""
+服务器运行工具
+生产模式下用 waitress 运行 Flask 应用：记录进行中的请求与 SSE 流，提供运行状态，
+并在收到退出信号时停止接收新连接、等待进行中的流结束后再退出
+"""
+import time
+import signal
+import logging
+import threading
+import _thread
+from typing import Any, Callable, Dict, List, Optional
+
+
+class ServerMonitor:
+    """
+    WSGI 中间件 + 运行状态
+
+    - 统计进行中的请求与 SSE 流（text/event-stream），流在响应迭代器关闭时才算结束
+    - 为事件流补上禁止缓冲的响应头，避免反向代理（nginx、frp 等）攒包
+    - 持有 waitress 服务器对象，用于读取工作线程数与任务队列深度
+    - 统计客户端中途断开而取消的对话，以及因此少生成的 token（估算）
+    """
+
+    def __init__(self):
+        """初始化服务器监控"""
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self.active_requests = 0
+        self.active_streams = 0
+        self.total_requests = 0
+        self.total_streams = 0
+        self.cancelled_streams = 0
+        self.cancelled_tokens = 0
+        self.saved_tokens = 0
+        self.aborted_tool_calls = 0
+        # 完整回复 token 数的滑动平均，用于估算取消节省的 token
+        self.reply_tokens_avg = 0.0
+        self.started_at = time.time()
+        self.draining = False
+        self.server = None
+        self.mode = "development"
+        self.logger = logging.getLogger("ServerMonitor")
+
+        # 设置日志格式
+        if not self.logger.handlers:
+            handler = logging.StreamHandler()
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            handler.setFormatter(formatter)
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+
+    def wrap(self, app: Callable) -> Callable:
+        """
+        包装 WSGI 应用
+
+        Args:
+            app: WSGI 应用
+
+        Returns:
+            包装后的 WSGI 应用
+        """
+        def middleware(environ, start_response):
+            is_stream = []
+
+            def _start_response(status, headers, exc_info=None):
+                content_type = next((v for k, v in headers if k.lower() == "content-type"), "")
+                if content_type.startswith("text/event-stream"):
+                    is_stream.append(True)
+                    names = {k.lower() for k, _ in headers}
+                    headers = [(k, v) for k, v in headers if k.lower() != "content-length"]
+                    if "cache-control" not in names:
+                        headers.append(("Cache-Control", "no-cache"))
+                    if "x-accel-buffering" not in names:
+                        headers.append(("X-Accel-Buffering", "no"))
+                return start_response(status, headers, exc_info)
+
+            self._enter()
+            try:
+                result = app(environ, _start_response)
+            except Exception:
+                self._leave(stream=False)
+                raise
+            if is_stream:
+                with self._lock:
+                    self.active_streams += 1
+                    self.total_streams += 1
+            return _TrackedIterable(result, lambda: self._leave(stream=bool(is_stream)))
+
+        return middleware
+
+    def _enter(self) -> None:
+        with self._lock:
+            self.active_requests += 1
+            self.total_requests += 1
+
+    def _leave(self, stream: bool) -> None:
+        with self._lock:
+            self.active_requests -= 1
+            if stream:
+                self.active_streams -= 1
+            if self.active_requests <= 0:
+                self._idle.notify_all()
+
+    def record_reply(self, tokens: int) -> None:
+        """
+        记录一次完整回复的 token 数
+
+        Args:
+            tokens: 回复 token 数
+        """
+        with self._lock:
+            if self.reply_tokens_avg <= 0:
+                self.reply_tokens_avg = float(tokens)
+            else:
+                self.reply_tokens_avg += 0.1 * (tokens - self.reply_tokens_avg)
+
+    def record_cancel(self, generated_tokens: int, aborted_tool_calls: int = 0) -> int:
+        """
+        记录一次因客户端断开而取消的对话
+
+        Args:
+            generated_tokens: 取消前本轮已生成的 token 数
+            aborted_tool_calls: 放弃执行的工具调用数
+
+        Returns:
+            估算节省的 token 数（完整回复的平均长度减去已生成部分）
+        """
+        with self._lock:
+            saved = max(0, int(self.reply_tokens_avg) - generated_tokens)
+            self.cancelled_streams += 1
+            self.cancelled_tokens += generated_tokens
+            self.saved_tokens += saved
+            self.aborted_tool_calls += aborted_tool_calls
+        return saved
+
+    def wait_idle(self, timeout: float) -> bool:
+        """
+        等待进行中的请求（含 SSE 流）全部结束
+
+        Args:
+            timeout: 最长等待秒数
+
+        Returns:
+            是否在超时前全部结束
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self.active_requests > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+            return True
+
+    def status(self) -> Dict[str, Any]:
+        """
+        获取运行状态
+
+        Returns:
+            状态字典：模式、进行中的请求与流、工作线程数与任务队列深度等
+        """
+        with self._lock:
+            data = {
+                "mode": self.mode,
+                "uptime": round(time.time() - self.started_at, 1),
+                "draining": self.draining,
+                "active_requests": self.active_requests,
+                "active_streams": self.active_streams,
+                "total_requests": self.total_requests,
+                "total_streams": self.total_streams,
+                "cancelled_streams": self.cancelled_streams,
+                "cancelled_tokens": self.cancelled_tokens,
+                "saved_tokens_est": self.saved_tokens,
+                "aborted_tool_calls": self.aborted_tool_calls,
+            }
+        dispatcher = getattr(self.server, "task_dispatcher", None)
+        if dispatcher is not None:
+            adj = getattr(self.server, "adj", None)
+            data.update({
+                "threads": len(getattr(dispatcher, "threads", ())),
+                "busy_threads": getattr(dispatcher, "active_count", 0),
+                "queue_depth": len(getattr(dispatcher, "queue", ())),
+                "connections": sum(len(listener.active_channels) for listener in self._listeners()),
+                "connection_limit": getattr(adj, "connection_limit", None),
+            })
+        else:
+            data["threads"] = threading.active_count()
+        return data
+
+    def _listeners(self) -> List[Any]:
+        """
+        waitress 的监听服务器列表：单个监听地址时 create_server 直接返回监听服务器，
+        多个地址（如 localhost 同时解析到 IPv4/IPv6）时返回 MultiSocketServer，监听服务器在其 map 中
+
+        Returns:
+            监听服务器（BaseWSGIServer）列表
+        """
+        from waitress.server import BaseWSGIServer
+
+        if isinstance(self.server, BaseWSGIServer):
+            return [self.server]
+        return [d for d in list(getattr(self.server, "map", {}).values()) if isinstance(d, BaseWSGIServer)]
+
+    def serve(self, app: Callable, host: str, port: int, config: Dict[str, Any],
+              on_shutdown: Optional[Callable[[], None]] = None) -> None:
+        """
+        以生产模式运行（waitress），阻塞直到退出
+
+        第一次 Ctrl+C / SIGTERM：停止接收新连接，最多等待 shutdown_timeout 秒让进行中的流结束；
+        第二次信号立即退出。退出前调用 on_shutdown（写出历史与记忆缓冲）。
+
+        Args:
+            app: WSGI 应用
+            host: 监听地址
+            port: 端口
+            config: 服务器配置（SERVER_CONFIG）
+            on_shutdown: 退出前的清理回调
+        """
+        from waitress import create_server
+        from waitress.adjustments import Adjustments
+
+        options = {
+            "host": host,
+            "port": port,
+            "threads": int(config.get("threads", 16)),
+            "connection_limit": int(config.get("connection_limit", 200)),
+            # SSE 连接在模型思考或工具调用期间可能长时间没有输出
+            "channel_timeout": int(config.get("channel_timeout", 600)),
+            "backlog": int(config.get("backlog", 1024)),
+            "ident": "CABM",
+        }
+        # 旧版 waitress 攒够 send_bytes 才发送，会让 SSE 事件滞留在缓冲区
+        if "send_bytes" in dict(Adjustments._params):
+            options["send_bytes"] = 1
+        # 处理请求期间继续读取连接，客户端断开时 environ["waitress.client_disconnected"]() 返回 True
+        if "channel_request_lookahead" in dict(Adjustments._params):
+            options["channel_request_lookahead"] = int(config.get("channel_request_lookahead", 5))
+
+        self.mode = "production"
+        self.server = create_server(self.wrap(app), **options)
+        shutdown_timeout = float(config.get("shutdown_timeout", 30))
+        self.logger.info(
+            f"waitress 已启动: 线程数 {options['threads']}，连接上限 {options['connection_limit']}，"
+            f"通道超时 {options['channel_timeout']}s"
+        )
+
+        def _drain():
+            if not self.wait_idle(shutdown_timeout):
+                self.logger.warning(f"等待超过 {shutdown_timeout:.0f}s，仍有 {self.active_streams} 个流未结束，强制退出")
+            _thread.interrupt_main()
+
+        def _on_signal(signum, frame):
+            if self.draining:
+                raise KeyboardInterrupt
+            self.draining = True
+            # 停止接收新连接（waitress 的监听 socket 仅在 accepting 时可读）
+            for listener in self._listeners():
+                listener.accepting = False
+            self.logger.info(f"正在停止：等待 {self.active_requests} 个进行中的请求结束（再次按 Ctrl+C 立即退出）...")
+            threading.Thread(target=_drain, name="server-drain", daemon=True).start()
+
+        previous = {}
+        for sig in (signal.SIGINT, getattr(signal, "SIGTERM", None)):
+            if sig is not None:
+                previous[sig] = signal.signal(sig, _on_signal)
+        try:
+            self.server.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+            try:
+                self.server.close()
+                self.server.task_dispatcher.shutdown(timeout=5)
+            except Exception as e:
+                self.logger.warning(f"关闭服务器失败: {e}")
+            if on_shutdown:
+                on_shutdown()
+            self.logger.info("服务器已停止")
+
+
+class _TrackedIterable:
+    """响应迭代器包装：关闭（流结束或客户端断开）时回调一次"""
+
+    def __init__(self, iterable, on_close: Callable[[], None]):
+        self._iterable = iterable
+        self._on_close = on_close
+        self._closed = False
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def close(self):
+        try:
+            close = getattr(self._iterable, "close", None)
+            if close:
+                close()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._on_close()
+
+
+# 创建全局服务器监控实例
+server_monitor = ServerMonitor()
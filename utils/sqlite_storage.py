@@ -0,0 +1,370 @@
+"""
+SQLite 存储引擎模块
+可选的持久化后端（STORAGE_CONFIG["backend"] = "sqlite"）：历史记录、短期缓冲、摘要与档案存放在同一个
+WAL 模式的数据库中，对外保持 HistoryManager 与各记忆存储的接口不变
+"""
+import json
+import atexit
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from config import get_app_config, get_storage_config
+from utils.history_search import make_snippet, tokenize
+from utils.history_utils import extract_last_assistant_sentence
+from utils.persist_utils import DebouncedPersister
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    character TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    ts TEXT,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_character_seq ON messages(character, seq);
+CREATE INDEX IF NOT EXISTS idx_messages_character_ts ON messages(character, ts);
+CREATE TABLE IF NOT EXISTS history_meta (
+    character TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    last_timestamp TEXT,
+    last_assistant_sentence TEXT
+);
+CREATE TABLE IF NOT EXISTS documents (
+    scope TEXT NOT NULL,
+    name TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated_at TEXT,
+    PRIMARY KEY (scope, name)
+);
+CREATE TABLE IF NOT EXISTS summaries (
+    scope TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    meta TEXT NOT NULL,
+    PRIMARY KEY (scope, id)
+);
+"""
+
+
+class SQLiteStorage:
+    """
+    SQLite 存储
+
+    - 每个线程一个连接（sqlite3 连接不宜跨线程共享），WAL 模式下读写互不阻塞，也可被多个进程同时打开
+    - SQL 均为固定语句，由 sqlite3 的语句缓存复用预编译结果
+    - transaction() 以 BEGIN IMMEDIATE 开启写事务，一次提交只 fsync 一次
+    """
+
+    def __init__(self, path: str, synchronous: str = "FULL"):
+        """
+        初始化存储
+
+        Args:
+            path: 数据库文件路径
+            synchronous: PRAGMA synchronous（WAL 下 FULL 为每次提交 fsync，NORMAL 为检查点时 fsync）
+        """
+        self.path = str(path)
+        self.synchronous = synchronous
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """写事务：正常退出时提交，异常时回滚"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def query(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        """执行只读查询"""
+        return self._conn().execute(sql, params).fetchall()
+
+    # ---- 文档（短期缓冲、档案等整体读写的JSON） ----------------------------
+    def get_document(self, scope: str, name: str) -> Optional[Any]:
+        """
+        读取文档
+
+        Args:
+            scope: 作用域（角色ID）
+            name: 文档名（如 buffer、profile）
+
+        Returns:
+            反序列化后的数据，不存在时返回None
+        """
+        rows = self.query("SELECT data FROM documents WHERE scope = ? AND name = ?", (scope, name))
+        return json.loads(rows[0]["data"]) if rows else None
+
+    def put_document(self, scope: str, name: str, data: Any) -> None:
+        """写入（覆盖）文档"""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO documents(scope, name, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(scope, name) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (scope, name, json.dumps(data, ensure_ascii=False), datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            )
+
+    # ---- 摘要 ------------------------------------------------------------
+    def load_summaries(self, scope: str) -> List[Dict[str, Any]]:
+        """按id顺序读取作用域内的全部摘要"""
+        rows = self.query("SELECT id, text, meta FROM summaries WHERE scope = ? ORDER BY id", (scope,))
+        return [{"id": row["id"], "text": row["text"], "meta": json.loads(row["meta"])} for row in rows]
+
+    def put_summary(self, scope: str, sid: int, text: str, meta: Dict[str, Any]) -> None:
+        """写入或更新一条摘要"""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO summaries(scope, id, text, meta) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(scope, id) DO UPDATE SET text = excluded.text, meta = excluded.meta",
+                (scope, sid, text, json.dumps(meta, ensure_ascii=False))
+            )
+
+    def delete_summary(self, scope: str, sid: int) -> None:
+        """删除一条摘要"""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM summaries WHERE scope = ? AND id = ?", (scope, sid))
+
+    def close(self) -> None:
+        """关闭当前线程的连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class SQLiteHistoryManager:
+    """
+    基于 SQLite 的历史记录管理器，接口与 HistoryManager 一致
+
+    消息先进入内存中的待写队列，AI回复完成（或累计条数、定时器到期）时在一个事务里批量写入，
+    一轮对话（用户消息 + AI回复）只有一次提交。读操作前先写出待写队列。
+    """
+
+    def __init__(self, storage: SQLiteStorage):
+        """
+        初始化历史记录管理器
+
+        Args:
+            storage: SQLite 存储
+        """
+        self.storage = storage
+        app_config = get_app_config()
+        self.flush_records = int(app_config.get("history_flush_records", 16))
+        self.fsync_on_assistant = bool(app_config.get("history_fsync_on_assistant", True))
+        self._lock = threading.RLock()
+        self._pending: List[tuple] = []
+        self._flusher = DebouncedPersister(
+            delay=float(app_config.get("history_flush_ms", 200)) / 1000.0,
+            max_pending=max(self.flush_records, 1) * 4
+        )
+        atexit.register(self.flush_all)
+
+    def save_message(self, character_id: str, role: str, content: str) -> None:
+        """
+        保存消息到历史记录
+
+        Args:
+            character_id: 角色ID
+            role: 消息角色
+            content: 消息内容
+        """
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            self._pending.append((character_id, timestamp, role, content))
+            pending = len(self._pending)
+        if (self.fsync_on_assistant and role == "assistant") or pending >= self.flush_records:
+            self.flush(character_id)
+        else:
+            self._flusher.mark_dirty("history", self.flush_all)
+
+    def flush(self, character_id: Optional[str] = None, fsync: bool = False) -> None:
+        """把待写队列在一个事务中写入数据库（参数仅为与 HistoryManager 保持一致）"""
+        with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, []
+            try:
+                self._write_batch(batch)
+            except Exception:
+                # 写入失败时放回队列，下次重试
+                self._pending = batch + self._pending
+                raise
+
+    def _write_batch(self, batch: List[tuple]) -> None:
+        """在一个事务中写入一批消息并更新概要"""
+        with self.storage.transaction() as conn:
+            for character, timestamp, role, content in batch:
+                row = conn.execute(
+                    "SELECT count, last_assistant_sentence FROM history_meta WHERE character = ?", (character,)
+                ).fetchone()
+                seq = row["count"] if row else 0
+                sentence = row["last_assistant_sentence"] if row else ""
+                if role == "assistant":
+                    sentence = extract_last_assistant_sentence(content)
+                conn.execute(
+                    "INSERT INTO messages(character, seq, ts, role, content) VALUES (?, ?, ?, ?, ?)",
+                    (character, seq, timestamp, role, content)
+                )
+                conn.execute(
+                    "INSERT INTO history_meta(character, count, last_timestamp, last_assistant_sentence) "
+                    "VALUES (?, ?, ?, ?) ON CONFLICT(character) DO UPDATE SET count = excluded.count, "
+                    "last_timestamp = excluded.last_timestamp, last_assistant_sentence = excluded.last_assistant_sentence",
+                    (character, seq + 1, timestamp, sentence)
+                )
+
+    def flush_all(self) -> None:
+        """写出全部待写消息"""
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"写出历史记录失败: {e}")
+
+    def get_metadata(self, character_id: str) -> Dict[str, Any]:
+        """获取角色历史记录概要：count、last_timestamp、last_assistant_sentence"""
+        self.flush()
+        rows = self.storage.query(
+            "SELECT count, last_timestamp, last_assistant_sentence FROM history_meta WHERE character = ?",
+            (character_id,)
+        )
+        if not rows:
+            return {"count": 0, "last_timestamp": None, "last_assistant_sentence": ""}
+        return {
+            "count": rows[0]["count"],
+            "last_timestamp": rows[0]["last_timestamp"],
+            "last_assistant_sentence": rows[0]["last_assistant_sentence"] or "",
+        }
+
+    def load_history(self, character_id: str, count: int = 10, max_cache_size: int = 100) -> List[Dict[str, Any]]:
+        """
+        加载最近的历史记录
+
+        Args:
+            character_id: 角色ID
+            count: 加载的消息数量（不大于0表示全部）
+            max_cache_size: 为与 HistoryManager 保持一致而保留
+
+        Returns:
+            历史记录列表，按时间从旧到新排序
+        """
+        self.flush()
+        limit = count if count > 0 else -1
+        rows = self.storage.query(
+            "SELECT role, content FROM messages WHERE character = ? ORDER BY seq DESC LIMIT ?",
+            (character_id, limit)
+        )
+        return [{"role": row["role"], "content": row["content"]} for row in reversed(rows)]
+
+    def read_page(self, character_id: str, before: Optional[int] = None, limit: int = 20) -> Dict[str, Any]:
+        """分页读取历史记录，参数与返回值同 HistoryManager.read_page"""
+        total = self.get_metadata(character_id)["count"]
+        before = total if before is None else max(0, min(int(before), total))
+        start = max(0, before - max(1, int(limit)))
+        rows = self.storage.query(
+            "SELECT seq, ts, role, content FROM messages WHERE character = ? AND seq >= ? AND seq < ? ORDER BY seq",
+            (character_id, start, before)
+        )
+        messages = [{"timestamp": row["ts"], "role": row["role"], "content": row["content"], "index": row["seq"]}
+                    for row in rows]
+        return {"messages": messages, "start": start, "total": total, "has_more": start > 0}
+
+    def search(self, character_id: str, query: str, limit: int = 20, role: Optional[str] = None) -> Dict[str, Any]:
+        """
+        全文检索历史记录，返回格式同 HistoryManager.search
+
+        按命中的检索词个数排序（LIKE 匹配），segment/offset/length 在该后端下为None
+        """
+        terms = sorted(set(tokenize(query)), key=len, reverse=True)[:16]
+        total = self.get_metadata(character_id)["count"]
+        if not terms:
+            return {"hits": [], "total": total}
+        score_sql = " + ".join("(lower(content) LIKE ?)" for _ in terms)
+        params: List[Any] = [f"%{t}%" for t in terms] + [character_id]
+        role_sql = ""
+        if role:
+            role_sql = " AND role = ?"
+            params.append(role)
+        params.append(int(limit))
+        rows = self.storage.query(
+            f"SELECT * FROM (SELECT seq, ts, role, content, ({score_sql}) AS score FROM messages "
+            f"WHERE character = ?{role_sql}) WHERE score > 0 ORDER BY score DESC, seq DESC LIMIT ?",
+            tuple(params)
+        )
+        hits = [{
+            "index": row["seq"],
+            "score": float(row["score"]),
+            "role": row["role"],
+            "timestamp": row["ts"],
+            "snippet": make_snippet(row["content"], terms),
+            "segment": None,
+            "offset": None,
+            "length": None,
+        } for row in rows]
+        return {"hits": hits, "total": total}
+
+    def clear_history(self, character_id: str) -> bool:
+        """
+        清空历史记录
+
+        Args:
+            character_id: 角色ID
+
+        Returns:
+            是否成功清空
+        """
+        try:
+            with self._lock:
+                self._pending = [item for item in self._pending if item[0] != character_id]
+                with self.storage.transaction() as conn:
+                    conn.execute("DELETE FROM messages WHERE character = ?", (character_id,))
+                    conn.execute("DELETE FROM history_meta WHERE character = ?", (character_id,))
+            return True
+        except Exception as e:
+            print(f"清空历史记录失败: {e}")
+            return False
+
+
+_storage: Optional[SQLiteStorage] = None
+_storage_lock = threading.Lock()
+
+
+def get_storage() -> Optional[SQLiteStorage]:
+    """
+    获取全局 SQLite 存储
+
+    Returns:
+        STORAGE_CONFIG 选择 sqlite 后端时返回存储实例，否则返回None（使用文件存储）
+    """
+    global _storage
+    cfg = get_storage_config()
+    if cfg.get("backend", "file") != "sqlite":
+        return None
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = SQLiteStorage(cfg.get("sqlite_path", "data/cabm.db"),
+                                         synchronous=cfg.get("sqlite_synchronous", "FULL"))
+    return _storage
@@ -7,6 +7,7 @@ import json
 from datetime import datetime
 from typing import Optional
 from pathlib import Path
+from utils.history_utils import load_history_metadata, read_tail_records
 
 class TimeTracker:
     """时间跟踪器"""
@@ -48,24 +49,15 @@ class TimeTracker:
             return None
         
         try:
-            # 读取文件最后一行
-            with open(history_file, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-                if not lines:
-                    return None
-                
-                # 从最后一行开始查找
-                for line in reversed(lines):
-                    line = line.strip()
-                    if line:
-                        try:
-                            message = json.loads(line)
-                            timestamp_str = message.get("timestamp")
-                            if timestamp_str:
-                                return datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
-                        except (json.JSONDecodeError, ValueError):
-                            continue
-            
+            # 优先读取历史记录侧写；侧写缺失或过期时只从文件末尾读取最后一条消息
+            meta = load_history_metadata(self.history_dir, character_id)
+            if meta is not None:
+                timestamp_str = meta.get("last_timestamp")
+            else:
+                records = read_tail_records(history_file, 1)
+                timestamp_str = records[-1].get("timestamp") if records else None
+            if timestamp_str:
+                return datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
             return None
             
         except Exception as e:
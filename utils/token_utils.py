@@ -0,0 +1,119 @@
+"""
+Token 计数工具模块
+使用 tiktoken 精确计算文本 token 数，并按文本缓存计数结果
+"""
+import re
+import logging
+import threading
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# 与主流对话模型接近的通用编码；不同模型的分词略有差异，但用于预算估算足够
+DEFAULT_ENCODING = "cl100k_base"
+
+_encoder = None
+_encoder_failed = False
+_encoder_lock = threading.Lock()
+
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+def _get_encoder():
+    """懒加载编码器；tiktoken 不可用（未安装或无法下载词表）时返回None"""
+    global _encoder, _encoder_failed
+    if _encoder is not None or _encoder_failed:
+        return _encoder
+    with _encoder_lock:
+        if _encoder is None and not _encoder_failed:
+            if tiktoken is None:
+                _encoder_failed = True
+                logger.info("tiktoken未安装，token计数使用近似估算")
+            else:
+                try:
+                    _encoder = tiktoken.get_encoding(DEFAULT_ENCODING)
+                except Exception as e:
+                    _encoder_failed = True
+                    logger.warning(f"tiktoken编码器加载失败，token计数使用近似估算: {e}")
+    return _encoder
+
+
+def _estimate_tokens(text: str) -> int:
+    """近似估算：中日韩字符约1字1 token，其余约4字符1 token"""
+    cjk = len(_CJK_PATTERN.findall(text))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    """
+    计算单段文本的 token 数（带缓存，同一文本只分词一次）
+
+    Args:
+        text: 文本
+
+    Returns:
+        token 数
+    """
+    if not text:
+        return 0
+    encoder = _get_encoder()
+    if encoder is None:
+        return _estimate_tokens(text)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def count_messages_tokens(messages: Iterable[Dict[str, str]]) -> int:
+    """
+    计算对话消息列表的 token 数（含每条消息约4个 token 的格式开销）
+
+    Args:
+        messages: [{"role": ..., "content": ...}, ...]
+
+    Returns:
+        token 总数
+    """
+    total = 0
+    for msg in messages:
+        total += 4 + count_tokens(msg.get("role", "")) + count_tokens(msg.get("content") or "")
+    return total + 2
+
+
+def pack_by_budget(items: List[Dict], budget: int, separator_tokens: int = 1,
+                   group_costs: Optional[Dict[str, int]] = None) -> List[Dict]:
+    """
+    按优先级与得分把条目整条装入预算（不截断单个条目）
+
+    Args:
+        items: 条目列表，每项至少包含 text、priority（越小越优先）、score（越大越优先），可选 group
+        budget: token 预算
+        separator_tokens: 每个条目附加的分隔符开销
+        group_costs: 分组的一次性开销（如小节标题），该组首个条目入选时计入
+
+    Returns:
+        被选中的条目（保持原列表顺序），每项附带 tokens 字段
+    """
+    group_costs = group_costs or {}
+    for item in items:
+        item["tokens"] = count_tokens(item["text"]) + separator_tokens
+    order = sorted(range(len(items)), key=lambda i: (items[i].get("priority", 0), -items[i].get("score", 0.0)))
+    chosen = set()
+    opened = set()
+    used = 0
+    for i in order:
+        group = items[i].get("group")
+        cost = items[i]["tokens"]
+        if group not in opened:
+            cost += group_costs.get(group, 0)
+        if used + cost <= budget:
+            chosen.add(i)
+            opened.add(group)
+            used += cost
+    return [item for i, item in enumerate(items) if i in chosen]